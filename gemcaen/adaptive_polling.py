@@ -0,0 +1,90 @@
+import numpy as np
+from prompt_logger import logger as logging
+import metrics
+
+## CAEN channel Status bitfield (SY4527 family)
+STATUS_BITS = {0:"ON",1:"RUP",2:"RDW",3:"OVC",4:"OVV",5:"UNV",6:"EXTTRIP",7:"MAXV",8:"EXTDIS",9:"INTTRIP",10:"CALERR",11:"UNPLUGGED",13:"OVVPROT",14:"POWERFAIL",15:"TEMPERR"}
+## bits that call for fast polling: ramps, over/under current and voltage, trips
+ACTIVE_STATUS = sum( 1 << bit for bit,name in STATUS_BITS.items() if name in ("RUP","RDW","OVC","OVV","UNV","EXTTRIP","MAXV","INTTRIP") )
+
+def decode_status(status:int):
+    ## i.e. decode_status(3) -> ["ON","RUP"]
+    return [ name for bit,name in STATUS_BITS.items() if int(status) >> bit & 1 ]
+
+
+class AdaptiveRate:
+    """ Polling period of a device driven by the state of its channels.
+        The device is polled every fast seconds while any channel has an active Status bit (ACTIVE_STATUS) or moves faster
+        than max_dvdt V/s or max_didt uA/s, and for hold seconds after that. Otherwise every slow seconds.
+        Uses the Status, VMon and IMon arrays of the poll, if monitored.
+    """
+    def __init__(self,name,channels,fast=1.,slow=30.,max_dvdt=1.,max_didt=1.,hold=60.,status_mask=ACTIVE_STATUS):
+        self.name = name
+        self.channels = channels ## board channel of each element of the arrays
+        self.fast = fast
+        self.slow = slow
+        self.max_dvdt = max_dvdt
+        self.max_didt = max_didt
+        self.hold = hold
+        self.status_mask = status_mask
+        self.period = fast ## till the state of the channels is known
+        self.n_switches = 0
+        self._active_until = 0. ## timestamp till which the device is polled fast
+        self._layout = None ## (quantity,channels) of the Status, VMon and IMon arrays the buffers are allocated for
+        self._last_time = None ## timestamp of the previous poll
+
+    def _prepare(self,layout):
+        ## buffers of the array layout, allocated once: the rate is updated on every poll (as DeadbandFilter, see sample.py)
+        self._layout = layout
+        self._last_time = None
+        n_channels = layout[0][1] if layout else 0
+        self._previous = { quantity:np.full(length,np.nan) for quantity,length in layout if quantity != "Status" } ## arrays of the previous poll
+        self._status = np.empty(n_channels,dtype=np.int64)
+        self._values = np.empty(n_channels)
+        self._flagged = np.empty(n_channels,dtype=bool)
+        self._active = np.empty(n_channels,dtype=bool)
+
+    def active_channels(self,monitored_arrays,timestamp):
+        ## returns the mask of the active channels (valid till the next call) and the reasons
+        layout = tuple( (quantity,len(monitored_arrays[quantity])) for quantity in ("Status","VMon","IMon") if quantity in monitored_arrays )
+        if layout != self._layout: self._prepare(layout)
+        active,reasons = None,[]
+        status = monitored_arrays.get("Status")
+        if status is not None:
+            np.copyto(self._values,status) ## float: failed reads are NaN
+            np.nan_to_num(self._values,copy=False,nan=0.)
+            np.copyto(self._status,self._values,casting="unsafe")
+            np.bitwise_and(self._status,self.status_mask,out=self._status)
+            active = np.not_equal(self._status,0,out=self._active)
+            if active.any(): reasons.append("Status " + ",".join(decode_status(np.bitwise_or.reduce(self._status[active]))))
+        if self._last_time is not None and timestamp > self._last_time:
+            dt = timestamp - self._last_time
+            for quantity,limit in (("VMon",self.max_dvdt),("IMon",self.max_didt)):
+                if quantity not in self._previous: continue
+                values,flagged = self._values,self._flagged
+                np.subtract(monitored_arrays[quantity],self._previous[quantity],out=values)
+                np.abs(values,out=values)
+                np.divide(values,dt,out=values)
+                with np.errstate(invalid="ignore"): ## failed reads (NaN) never flag a channel
+                    np.greater(values,limit,out=flagged)
+                if active is None:
+                    np.copyto(self._active,flagged)
+                    active = self._active
+                else: np.logical_or(active,flagged,out=active)
+                if flagged.any(): reasons.append(f"d{quantity}/dt")
+        return active,reasons
+
+    def update(self,monitored_arrays,timestamp):
+        ## returns the period till the next poll
+        active,reasons = self.active_channels(monitored_arrays,timestamp)
+        for quantity,previous in self._previous.items(): np.copyto(previous,monitored_arrays[quantity])
+        self._last_time = timestamp
+        if active is not None and active.any(): self._active_until = timestamp + self.hold
+        period = self.fast if timestamp < self._active_until else self.slow
+        if period != self.period:
+            self.n_switches += 1
+            if period == self.fast: logging.info(f"{self.name}: {' '.join(reasons)} on channels {[ self.channels[i] for i in np.flatnonzero(active) ]}. Polling every {period} s")
+            else: logging.info(f"{self.name}: channels stable for {self.hold:g} s. Polling every {period} s")
+            metrics.set_gauge("gemcaen_poll_period_seconds",period,help_text="Current polling period of the device",device=self.name)
+        self.period = period
+        return period
@@ -0,0 +1,273 @@
+import contextlib
+import math
+import subprocess
+import numbers
+import threading
+from typing import NamedTuple, Optional
+import numpy as np
+from prompt_logger import logger as logging
+from adaptive_polling import STATUS_BITS
+from backends import BackendError
+import metrics
+
+## Alarm and interlock rules, evaluated on every sample of a device before it is published or pushed to the DB: a trip or an
+## over-current is acted upon within the poll that sees it. Declared in the optional Alarms block of a setup:
+##   Alarms:
+##     Hook: [notify-send, gemcaen]   ## Optional. Command run (not waited for) by the notify actions, the alarm message appended
+##     Rules:
+##       - {Name: overcurrent, Quantity: IMon, Above: 2, Actions: [log, notify]}
+##       - {Name: trip, Status: [OVC, EXTTRIP, INTTRIP], Actions: [log, safe], Safe: {V0Set: 0}}
+## A rule fires on a channel (all, or the ones in Channels) when, for its Quantity:
+##   Above/Below: the value is above/below the threshold;
+##   Rate: |d(Quantity)/dt| between two samples is above Rate (per second);
+##   Deviation: |Quantity - Reference| is above Deviation. Reference defaults to the median of the channels (i.e. Ieq along a divider);
+##   Status: one of the listed Status bits is set (Quantity defaults to Status).
+## Actions run when a channel enters the alarm, and once more only after it cleared: log (default), notify (the Hook and the functions
+## registered with add_hook, called with the Alarm), safe (the Safe setpoints, V0Set, I0Set or Pw, written to the firing channels).
+## A failed read (NaN) keeps the state of the alarm. The rules are compiled once per sample layout and evaluated together, with
+## vectorized comparisons over [rule,channel] arrays: the per-channel work only happens for the channels entering or leaving an alarm.
+
+ACTIONS = ("log","notify","safe")
+SAFE_QUANTITIES = ("V0Set","I0Set","Pw")
+_RULE_KEYS = ("Name","Quantity","Above","Below","Rate","Deviation","Reference","Status","Channels","Actions","Safe")
+_STATUS_NAMES = { name:bit for bit,name in STATUS_BITS.items() }
+
+class AlarmRule(NamedTuple):
+    name: str
+    quantity: str
+    kind: str ## threshold, rate, deviation or status
+    above: float = math.inf ## fires when the evaluated value is above
+    below: float = -math.inf ## or below
+    reference: Optional[float] = None ## deviation rules. None: median of the channels
+    status_mask: int = 0
+    channels: Optional[tuple] = None ## None: all the channels of the device
+    actions: tuple = ("log",)
+    safe: Optional[dict] = None
+
+class Alarm(NamedTuple):
+    device: str
+    rule: str
+    channel: int
+    quantity: str
+    value: Optional[float] ## None for a failed read
+    timestamp: float
+    state: str ## raised or cleared
+
+    def message(self):
+        return f"{self.device}: alarm {self.rule} {self.state} on channel {self.channel} ({self.quantity} = {self.value})"
+
+
+## functions called with the Alarm by the notify actions, shared by all the devices of the process
+_hooks = []
+_hooks_lock = threading.Lock()
+
+def add_hook(function):
+    with _hooks_lock:
+        _hooks.append(function)
+
+def remove_hook(function):
+    with _hooks_lock:
+        if function in _hooks: _hooks.remove(function)
+
+
+def _number(value,where):
+    if isinstance(value,bool) or not isinstance(value,numbers.Number):
+        raise ValueError(f"{where}: expected a number, found {value!r}")
+    return float(value)
+
+def parse_rule(cfg_rule,monitorables,where="Alarms.Rules"):
+    ## AlarmRule from its config. Raises ValueError
+    if not isinstance(cfg_rule,dict):
+        raise ValueError(f"{where}: expected a rule, found {cfg_rule!r}")
+    unknown = [ key for key in cfg_rule if key not in _RULE_KEYS ]
+    if unknown:
+        raise ValueError(f"{where}: unknown keys {unknown}. Valid keys are {list(_RULE_KEYS)}")
+    kinds = [ kind for kind,keys in (("threshold",("Above","Below")),("rate",("Rate",)),("deviation",("Deviation",)),("status",("Status",))) if any( key in cfg_rule for key in keys ) ]
+    if len(kinds) != 1:
+        raise ValueError(f"{where}: expected one condition among Above/Below, Rate, Deviation and Status, found {kinds or 'none'}")
+    kind = kinds[0]
+    quantity = cfg_rule.get("Quantity","Status" if kind == "status" else None)
+    if quantity not in monitorables:
+        raise ValueError(f"{where}: Quantity {quantity} is not monitored. Monitorables are {monitorables}")
+    rule = dict(kind=kind,quantity=quantity)
+    if kind == "threshold":
+        if "Above" in cfg_rule: rule["above"] = _number(cfg_rule["Above"],f"{where}.Above")
+        if "Below" in cfg_rule: rule["below"] = _number(cfg_rule["Below"],f"{where}.Below")
+        condition = " ".join( f"{key.lower()} {cfg_rule[key]}" for key in ("Above","Below") if key in cfg_rule )
+    elif kind == "rate":
+        rule["above"] = _number(cfg_rule["Rate"],f"{where}.Rate")
+        condition = f"rate above {cfg_rule['Rate']}/s"
+    elif kind == "deviation":
+        rule["above"] = _number(cfg_rule["Deviation"],f"{where}.Deviation")
+        if "Reference" in cfg_rule: rule["reference"] = _number(cfg_rule["Reference"],f"{where}.Reference")
+        condition = f"deviation above {cfg_rule['Deviation']}"
+    else:
+        bits = cfg_rule["Status"] if isinstance(cfg_rule["Status"],list) else [cfg_rule["Status"]]
+        invalid = [ bit for bit in bits if bit not in _STATUS_NAMES ]
+        if invalid:
+            raise ValueError(f"{where}.Status: unknown bits {invalid}. Valid bits are {list(_STATUS_NAMES)}")
+        rule["status_mask"] = sum( 1 << _STATUS_NAMES[bit] for bit in bits )
+        rule["above"] = 0.
+        condition = "|".join(bits)
+    if "Channels" in cfg_rule:
+        if not isinstance(cfg_rule["Channels"],list) or not all( isinstance(ch,int) for ch in cfg_rule["Channels"] ):
+            raise ValueError(f"{where}.Channels: expected a list of channel numbers")
+        rule["channels"] = tuple(cfg_rule["Channels"])
+    actions = cfg_rule.get("Actions",["log"])
+    actions = actions if isinstance(actions,list) else [actions]
+    if not all( action in ACTIONS for action in actions ):
+        raise ValueError(f"{where}.Actions: expected a list among {list(ACTIONS)}, found {actions}")
+    rule["actions"] = tuple(actions)
+    if "safe" in actions or "Safe" in cfg_rule:
+        safe = cfg_rule.get("Safe")
+        if "safe" not in actions or not isinstance(safe,dict) or not safe or not all( quantity in SAFE_QUANTITIES for quantity in safe ):
+            raise ValueError(f"{where}: the safe action needs Safe setpoints among {list(SAFE_QUANTITIES)}, i.e. Safe: {{V0Set: 0}}")
+        rule["safe"] = { quantity:_number(value,f"{where}.Safe.{quantity}") for quantity,value in safe.items() }
+    return AlarmRule(name=str(cfg_rule.get("Name",f"{quantity} {condition}")),**rule)
+
+def parse_alarms(cfg_alarms,monitorables):
+    ## (rules,hook command) of an Alarms config block. Raises ValueError
+    if not isinstance(cfg_alarms,dict) or not isinstance(cfg_alarms.get("Rules"),list):
+        raise ValueError("Alarms: expected a block with a Rules list")
+    unknown = [ key for key in cfg_alarms if key not in ("Rules","Hook") ]
+    if unknown:
+        raise ValueError(f"Alarms: unknown keys {unknown}. Valid keys are ['Rules', 'Hook']")
+    hook = cfg_alarms.get("Hook")
+    if hook is not None:
+        hook = hook if isinstance(hook,list) else [hook]
+        if not hook or not all( isinstance(arg,str) for arg in hook ):
+            raise ValueError(f"Alarms.Hook: expected a command, found {cfg_alarms['Hook']!r}")
+    rules = [ parse_rule(cfg_rule,monitorables,f"Alarms.Rules[{index}]") for index,cfg_rule in enumerate(cfg_alarms["Rules"]) ]
+    return rules,hook
+
+
+def _median(values):
+    ## median of each row of values, ignoring the NaN (NaN if all are): np.nanmedian without its per-row python loop and warnings
+    ordered = np.sort(values,axis=1) ## NaN last
+    n_valid = np.count_nonzero(~np.isnan(values),axis=1)
+    rows = np.arange(len(values))
+    middle = (ordered[rows,np.maximum(n_valid - 1,0) // 2] + ordered[rows,n_valid // 2]) / 2
+    return np.where(n_valid > 0,middle,np.nan)
+
+
+class AlarmEngine:
+    """ Evaluates the rules of a device on its samples and runs the actions of the channels entering (leaving) an alarm """
+    def __init__(self,device_name,rules,hook=None):
+        self.device_name = device_name
+        self.rules = list(rules)
+        self.hook = hook ## command of the notify actions
+        self.n_raised = 0
+        self._schema = None
+
+    def _compile(self,schema):
+        ## [rule,channel] arrays of the sample layout, allocated once
+        rules = self.rules
+        shape = (len(rules),len(schema.channels))
+        self._schema = schema
+        self._rows = np.array([ schema.quantity_index[rule.quantity] for rule in rules ],dtype=np.intp)
+        self._above = np.array([ rule.above for rule in rules ])[:,None]
+        self._below = np.array([ rule.below for rule in rules ])[:,None]
+        self._channel_mask = np.array([ [ rule.channels is None or ch in rule.channels for ch in schema.channels ] for rule in rules ],dtype=bool).reshape(shape)
+        self._rate = np.flatnonzero([ rule.kind == "rate" for rule in rules ])
+        self._deviation = np.flatnonzero([ rule.kind == "deviation" for rule in rules ])
+        self._reference = np.array([ np.nan if rules[index].reference is None else rules[index].reference for index in self._deviation ])
+        self._median_reference = bool(np.isnan(self._reference).any())
+        self._status = np.flatnonzero([ rule.kind == "status" for rule in rules ])
+        self._status_mask = np.array([ rules[index].status_mask for index in self._status ],dtype=np.int64)[:,None]
+        self._values = np.empty(shape)
+        self._x = np.empty(shape)
+        self._previous = np.full((len(self._rate),shape[1]),np.nan) ## values of the rate rules at the previous sample
+        self._last_timestamp = None
+        self._failed = np.empty(shape,dtype=bool)
+        self._below_mask = np.empty(shape,dtype=bool)
+        self.firing = np.zeros(shape,dtype=bool)
+        self.active = np.zeros(shape,dtype=bool) ## alarms in progress
+        self._raised = np.empty(shape,dtype=bool)
+        self._cleared = np.empty(shape,dtype=bool)
+
+    def evaluate(self,sample):
+        ## one pass over all the rules. Returns the masks [rule,channel] of the alarms raised and cleared by sample (valid till the next call)
+        if sample.schema != self._schema: self._compile(sample.schema)
+        values,x,firing = self._values,self._x,self.firing
+        np.take(sample.buffer,self._rows,axis=0,out=values)
+        np.copyto(x,values)
+        with np.errstate(invalid="ignore",divide="ignore"):
+            if len(self._rate):
+                dt = sample.timestamp - self._last_timestamp if self._last_timestamp is not None else 0.
+                current = values[self._rate]
+                x[self._rate] = np.abs(current - self._previous) / dt if dt > 0 else np.nan
+                self._previous[:] = current
+                self._last_timestamp = sample.timestamp
+            if len(self._deviation):
+                current = values[self._deviation]
+                reference = self._reference
+                if self._median_reference:
+                    reference = np.where(np.isnan(reference),_median(current),reference)
+                x[self._deviation] = np.abs(current - reference[:,None])
+            if len(self._status):
+                current = values[self._status]
+                bits = (current.astype(np.int64) & self._status_mask).astype(np.float64) ## NaN casts to garbage, restored below
+                bits[np.isnan(current)] = np.nan
+                x[self._status] = bits
+            np.greater(x,self._above,out=firing)
+            np.less(x,self._below,out=self._below_mask)
+        np.logical_or(firing,self._below_mask,out=firing)
+        np.logical_and(firing,self._channel_mask,out=firing)
+        np.isnan(x,out=self._failed)
+        np.copyto(firing,self.active,where=self._failed) ## a failed read keeps the state
+        np.greater(firing,self.active,out=self._raised)
+        np.less(firing,self.active,out=self._cleared)
+        np.copyto(self.active,firing)
+        return self._raised,self._cleared
+
+    def check(self,sample,board=None,lock=None):
+        ## evaluates the rules on sample and runs the actions. board (and the mainframe lock) are needed by the safe actions.
+        ## Returns the raised and cleared Alarm
+        raised,cleared = self.evaluate(sample)
+        if not raised.any() and not cleared.any(): return []
+        alarms = []
+        for rule_index in np.flatnonzero(raised.any(axis=1) | cleared.any(axis=1)):
+            rule = self.rules[rule_index]
+            rule_alarms = []
+            for mask,state in ((raised,"raised"),(cleared,"cleared")):
+                for channel_index in np.flatnonzero(mask[rule_index]):
+                    rule_alarms.append(Alarm(self.device_name,rule.name,self._schema.channels[channel_index],rule.quantity,
+                                             sample.value(self._rows[rule_index],channel_index),sample.timestamp,state))
+            raised_channels = [ alarm.channel for alarm in rule_alarms if alarm.state == "raised" ]
+            if raised_channels:
+                self.n_raised += len(raised_channels)
+                metrics.inc("gemcaen_alarms_total",len(raised_channels),help_text="Alarms raised",device=self.device_name,rule=rule.name)
+                if "safe" in rule.actions: self.apply_safe(rule,raised_channels,board,lock)
+            for alarm in rule_alarms:
+                if "log" in rule.actions:
+                    if alarm.state == "raised": logging.warning(alarm.message())
+                    else: logging.info(alarm.message())
+                if "notify" in rule.actions: self.notify(alarm)
+            alarms += rule_alarms
+        return alarms
+
+    def apply_safe(self,rule,channels,board,lock):
+        if board is None:
+            logging.error(f"{self.device_name}: alarm {rule.name} can't apply the safe setpoints {rule.safe}, no board")
+            return
+        try:
+            with lock if lock is not None else contextlib.nullcontext():
+                for quantity,value in rule.safe.items():
+                    board.set_channels_value(quantity,{ ch:value for ch in channels })
+            logging.warning(f"{self.device_name}: alarm {rule.name}, safe setpoints {rule.safe} applied to channels {channels}")
+        except (BackendError,ValueError) as e:
+            logging.error(f"{self.device_name}: alarm {rule.name}, exception {e} caught while applying the safe setpoints {rule.safe} to channels {channels}")
+
+    def notify(self,alarm):
+        with _hooks_lock:
+            hooks = list(_hooks)
+        for hook in hooks:
+            try:
+                hook(alarm)
+            except Exception as e:
+                logging.error(f"{self.device_name}: exception {e} caught in the alarm hook {hook}")
+        if self.hook is not None:
+            try: ## not waited for: the hook can't hold the acquisition
+                subprocess.Popen(self.hook + [alarm.message()],stdin=subprocess.DEVNULL,stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+            except OSError as e:
+                logging.error(f"{self.device_name}: exception {e} caught while running the alarm hook {self.hook}")
@@ -0,0 +1,300 @@
+from ctypes import c_float, c_uint, c_ushort, c_short, c_int, c_char, c_char_p, c_void_p, byref, cast, ArgumentError, Structure, Union, POINTER, CDLL
+import select
+import socket
+import time
+from prompt_logger import logger as logging
+import metrics
+
+## Backends implement the few CAEN HV wrapper calls used by caen_classes.
+## The mainframe config selects them with the optional key BACKEND (pycaenhv by default, or simulated)
+
+class BackendError(Exception):
+    """ Communication error raised by any backend """
+    pass
+
+class BulkNotSupported(BackendError):
+    """ The backend or the board rejects multi-channel parameter access: callers switch to one call per channel """
+    pass
+
+class SubscriptionNotSupported(BackendError):
+    """ The backend or the mainframe can't push parameter change events: acquisition falls back to polling """
+    pass
+
+
+class BaseBackend:
+    """ Interface to a CAEN HV system. All the methods are blocking calls to the mainframe """
+    name = None
+
+    def init_system(self,system_type:str,link_type:str,address:str,user:str,password:str):
+        raise NotImplementedError
+    def deinit_system(self,handle):
+        raise NotImplementedError
+    def get_crate_map(self,handle):
+        raise NotImplementedError
+    def get_channel_name(self,handle,slot:int,channel:int):
+        raise NotImplementedError
+    def get_channel_parameters(self,handle,slot:int,channel:int):
+        raise NotImplementedError
+    def get_channel_parameter(self,handle,slot:int,channel:int,param_name:str):
+        raise NotImplementedError
+    def get_channels_parameter(self,handle,slot:int,channels:list,param_name:str,numeric=True):
+        ## one parameter for a list of channels, with a single call when the backend supports it
+        return [ self.get_channel_parameter(handle,slot,ch,param_name) for ch in channels ]
+    def set_channel_parameter(self,handle,slot:int,channel:int,param_name:str,value):
+        raise NotImplementedError
+    def set_channels_parameter(self,handle,slot:int,channels:list,param_name:str,value,numeric=True):
+        ## the same value to a list of channels, with a single call when the backend supports it
+        for ch in channels: self.set_channel_parameter(handle,slot,ch,param_name,value)
+    ## parameter change events (event_acquisition.py)
+    def subscribe_channel_parameters(self,handle,slot:int,channels:list,param_names:list):
+        raise SubscriptionNotSupported(f"Backend {self.name} does not support parameter subscriptions")
+    def unsubscribe_channel_parameters(self,handle,slot:int,channels:list,param_names:list):
+        raise SubscriptionNotSupported(f"Backend {self.name} does not support parameter subscriptions")
+    def get_events(self,handle,timeout:float):
+        ## waits up to timeout seconds for events. Returns [(slot,channel,param_name,value)]
+        raise SubscriptionNotSupported(f"Backend {self.name} does not support parameter subscriptions")
+
+
+## CAENHV_GetEventData structures (CAENHVWrapper.h)
+class _IDValue(Union):
+    _fields_ = [("StringValue",c_char*1024),("FloatValue",c_float),("IntValue",c_int)]
+
+class _EventData(Structure):
+    _fields_ = [("Type",c_int),("SystemHandle",c_int),("BoardIndex",c_int),("ChannelIndex",c_int),("ItemID",c_char*20),("Value",_IDValue)]
+
+class _SystemStatus(Structure):
+    _fields_ = [("System",c_int),("Board",c_int*16)]
+
+## dladdr (dlfcn.h): shared object a symbol comes from
+class _DlInfo(Structure):
+    _fields_ = [("dli_fname",c_char_p),("dli_fbase",c_void_p),("dli_sname",c_char_p),("dli_saddr",c_void_p)]
+
+
+class PyCaenBackend(BaseBackend):
+    """ Real hardware, through pycaenhv and libcaenhvwrapper """
+    name = "pycaenhv"
+    ## pycaenhv does not wrap the event calls: CAENHV_SubscribeChannelParams, CAENHV_GetEventData and friends are bound with ctypes
+    ## on the library pycaenhv loaded. The mainframe pushes the events over a TCP connection to a port opened here (MAINFRAME.EVENT_PORT,
+    ## default any free port), that it must be able to reach. Only SY4527/SY5527 events are supported: the other systems raise
+    ## SubscriptionNotSupported and the acquisition falls back to polling
+    EVENT_SYSTEMS = ("SY4527","SY5527")
+    ## return codes of the event calls meaning that the mainframe doesn't support them: FUNCTIONNOTAVAILABLE, NOTYETIMPLEMENTED
+    EVENT_UNSUPPORTED_CODES = (27,30)
+    ## return codes (CAENHVRESULT) of CAENHV_GetChParam/CAENHV_SetChParam meaning that multi-channel access is not supported:
+    ## GETPROPNOTIMPL, SETPROPNOTIMPL, INVALIDPARAMETER, FUNCTIONNOTAVAILABLE, NOTYETIMPLEMENTED. Other codes are communication errors
+    BULK_UNSUPPORTED_CODES = (12,13,26,27,30)
+
+    def __init__(self):
+        ## imported here so that the other backends work where the CAEN library is not installed
+        import pycaenhv.wrappers
+        import pycaenhv.functions
+        import pycaenhv.enums
+        import pycaenhv.errors
+        self._wrappers = pycaenhv.wrappers
+        self._functions = pycaenhv.functions
+        self._enums = pycaenhv.enums
+        self._CAENHVError = pycaenhv.errors.CAENHVError
+        self._event_calls = {} ## name -> ctypes function
+        self._system_types = {} ## handle -> system type given to init_system
+        self._event_sockets = {} ## handle -> [listening socket, connection from the mainframe or None]
+        self._event_types = {} ## (handle,slot,param_name) -> CAEN parameter type, that gives the type of the event values
+        self._addresses = {} ## handle -> mainframe address
+        self.event_ports = {} ## mainframe address -> MAINFRAME.EVENT_PORT, any free port if missing
+
+    def _call(self,function,*args):
+        try:
+            return function(*args)
+        except self._CAENHVError as e:
+            raise BackendError(str(e)) from e
+
+    def init_system(self,system_type,link_type,address,user,password):
+        handle = self._call(self._wrappers.init_system,self._enums.CAENHV_SYSTEM_TYPE[system_type],self._enums.LinkType[link_type],address,user,password)
+        self._system_types[handle] = system_type
+        self._addresses[handle] = address
+        return handle
+    def deinit_system(self,handle):
+        self._close_events(handle)
+        self._system_types.pop(handle,None)
+        self._addresses.pop(handle,None)
+        return self._call(self._wrappers.deinit_system,handle)
+    def get_crate_map(self,handle):
+        return self._call(self._wrappers.get_crate_map,handle)
+    def get_channel_name(self,handle,slot,channel):
+        return self._call(self._wrappers.get_channel_name,handle,slot,channel)
+    def get_channel_parameters(self,handle,slot,channel):
+        return self._call(self._wrappers.get_channel_parameters,handle,slot,channel)
+    def get_channel_parameter(self,handle,slot,channel,param_name):
+        return self._call(self._wrappers.get_channel_parameter,handle,slot,channel,param_name)
+    def set_channel_parameter(self,handle,slot,channel,param_name,value):
+        return self._call(self._wrappers.set_channel_parameter,handle,slot,channel,param_name,value)
+
+    def get_channels_parameter(self,handle,slot,channels,param_name,numeric=True):
+        ## pycaenhv.wrappers.get_channel_parameter only passes a 1-element channel list (and queries the parameter property each time)
+        n_channels = len(channels)
+        ch_list = (c_ushort * n_channels)(*channels)
+        values = (c_float * n_channels)() if numeric else (c_uint * n_channels)()
+        try:
+            err = self._functions.CAENHV_GetChParam(handle, slot, param_name.encode(), n_channels, ch_list, values)
+        except (AttributeError,ArgumentError) as e: ## binding not available in this pycaenhv version
+            raise BulkNotSupported(f"CAENHV_GetChParam not usable: {e}") from e
+        if err != 0:
+            error = BulkNotSupported if err in self.BULK_UNSUPPORTED_CODES else BackendError
+            raise error(f"CAENHV_GetChParam({param_name}) on slot {slot} failed with code {err}")
+        return list(values)
+
+    def set_channels_parameter(self,handle,slot,channels,param_name,value,numeric=True):
+        ## CAENHV_SetChParam takes a channel list and one value for all of them
+        n_channels = len(channels)
+        ch_list = (c_ushort * n_channels)(*channels)
+        c_value = c_float(value) if numeric else c_uint(int(value))
+        try:
+            err = self._functions.CAENHV_SetChParam(handle, slot, param_name.encode(), n_channels, ch_list, byref(c_value))
+        except (AttributeError,ArgumentError) as e: ## binding not available in this pycaenhv version
+            raise BulkNotSupported(f"CAENHV_SetChParam not usable: {e}") from e
+        if err != 0:
+            error = BulkNotSupported if err in self.BULK_UNSUPPORTED_CODES else BackendError
+            raise error(f"CAENHV_SetChParam({param_name}) on slot {slot} failed with code {err}")
+
+    ## parameter change events. The values of the events are typed as the parameters (CAENHV_GetChParamProp "Type"): 0 numeric, 5 string, integers otherwise
+    def _library(self):
+        ## the library pycaenhv loaded: the CDLL held by pycaenhv.functions or, if not found, the shared object its CAENHV_GetChParam
+        ## comes from (dlopen of a loaded library returns the same instance, so handles are shared)
+        for value in vars(self._functions).values():
+            if isinstance(value,CDLL): return value
+        info = _DlInfo()
+        if not CDLL(None).dladdr(cast(self._functions.CAENHV_GetChParam,c_void_p),byref(info)) or not info.dli_fname:
+            raise OSError("shared object of pycaenhv.functions.CAENHV_GetChParam not found")
+        return CDLL(info.dli_fname.decode())
+
+    def _event_call(self,name,*argtypes):
+        if name not in self._event_calls:
+            try:
+                function = getattr(self._library(),f"CAENHV_{name}")
+            except (OSError,AttributeError,TypeError) as e:
+                logging.warning(f"CAENHV_{name} can't be bound ({e}): parameter events not available")
+                raise SubscriptionNotSupported(f"CAENHV_{name} not available: {e}") from e
+            function.argtypes = argtypes
+            self._event_calls[name] = function
+        return self._event_calls[name]
+
+    def _event_server(self,handle):
+        ## TCP port the mainframe pushes the events of the handle to, opened at the first subscription
+        system_type = self._system_types.get(handle)
+        if system_type not in self.EVENT_SYSTEMS:
+            raise SubscriptionNotSupported(f"Parameter events not supported for system {system_type}, only {', '.join(self.EVENT_SYSTEMS)}")
+        if handle not in self._event_sockets:
+            port = self.event_ports.get(self._addresses.get(handle),0)
+            try:
+                self._event_sockets[handle] = [socket.create_server(("",port),backlog=1),None]
+            except OSError as e:
+                raise BackendError(f"Can't open the event port {port}: {e}") from e
+        return self._event_sockets[handle][0].getsockname()[1]
+
+    def _close_events(self,handle):
+        for sock in self._event_sockets.pop(handle,[]):
+            if sock is not None: sock.close()
+        for key in [ key for key in self._event_types if key[0] == handle ]: del self._event_types[key]
+
+    def _subscription(self,function_name,handle,slot,channels,param_names):
+        port = self._event_server(handle)
+        function = self._event_call(function_name,c_int,c_short,c_ushort,c_ushort,c_char_p,c_uint,c_char_p)
+        param_list = ":".join(param_names).encode()
+        for ch in channels:
+            result_codes = (c_char * len(param_names))()
+            err = function(handle,port,slot,ch,param_list,len(param_names),result_codes)
+            if err in self.EVENT_UNSUPPORTED_CODES:
+                raise SubscriptionNotSupported(f"CAENHV_{function_name} not supported by the mainframe (code {err})")
+            failed = [ param_name for param_name,code in zip(param_names,result_codes.raw) if code ]
+            if err != 0 or failed:
+                raise BackendError(f"CAENHV_{function_name} on slot {slot} channel {ch} failed with code {err} (parameters {failed})")
+
+    def subscribe_channel_parameters(self,handle,slot,channels,param_names):
+        if not channels or not param_names: return
+        get_property = self._event_call("GetChParamProp",c_int,c_ushort,c_ushort,c_char_p,c_char_p,c_void_p)
+        for param_name in param_names:
+            if (handle,slot,param_name) in self._event_types: continue
+            param_type = c_uint()
+            err = get_property(handle,slot,channels[0],param_name.encode(),b"Type",byref(param_type))
+            if err != 0:
+                raise BackendError(f"CAENHV_GetChParamProp({param_name},Type) on slot {slot} failed with code {err}")
+            self._event_types[(handle,slot,param_name)] = param_type.value
+        self._subscription("SubscribeChannelParams",handle,slot,channels,param_names)
+
+    def unsubscribe_channel_parameters(self,handle,slot,channels,param_names):
+        if not channels or not param_names: return
+        self._subscription("UnSubscribeChannelParams",handle,slot,channels,param_names)
+
+    def _event_value(self,handle,event):
+        param_type = self._event_types.get((handle,event.BoardIndex,event.ItemID.decode()))
+        if param_type == 0: return event.Value.FloatValue
+        if param_type == 5: return event.Value.StringValue.decode()
+        return event.Value.IntValue
+
+    def get_events(self,handle,timeout):
+        if handle not in self._event_sockets:
+            raise BackendError(f"No parameter subscription on handle {handle}")
+        sockets = self._event_sockets[handle]
+        if sockets[1] is None: ## the mainframe connects at the first subscription
+            if not select.select([sockets[0]],[],[],timeout)[0]: return []
+            sockets[1] = sockets[0].accept()[0]
+        elif not select.select([sockets[1]],[],[],timeout)[0]:
+            return []
+        get_event_data = self._event_call("GetEventData",c_int,POINTER(_SystemStatus),POINTER(POINTER(_EventData)),POINTER(c_uint))
+        free_event_data = self._event_call("FreeEventData",POINTER(POINTER(_EventData)))
+        status, data, n_events = _SystemStatus(), POINTER(_EventData)(), c_uint()
+        err = get_event_data(sockets[1].fileno(),byref(status),byref(data),byref(n_events))
+        if err != 0:
+            sockets[1].close() ## accepted again after resubscribing
+            sockets[1] = None
+            raise BackendError(f"CAENHV_GetEventData failed with code {err}")
+        try:
+            if status.System in (2,3): ## UNSYNC, NOTAVAIL: the events may have been lost
+                raise BackendError(f"Mainframe event connection lost (system status {status.System})")
+            return [ (data[i].BoardIndex,data[i].ChannelIndex,data[i].ItemID.decode(),self._event_value(handle,data[i]))
+                     for i in range(n_events.value) if data[i].Type == 0 and data[i].ChannelIndex >= 0 ] ## channel PARAMETER events, not keep-alives
+        finally:
+            free_event_data(byref(data))
+
+
+class InstrumentedBackend:
+    """ Proxy of a backend that records the latency and the errors of every call, labelled by mainframe """
+    CALLS = ["init_system","deinit_system","get_crate_map","get_channel_name","get_channel_parameters",
+             "get_channel_parameter","get_channels_parameter","set_channel_parameter","set_channels_parameter",
+             "subscribe_channel_parameters","unsubscribe_channel_parameters"] ## not get_events, that waits for the events
+
+    def __init__(self,backend,mainframe):
+        self.backend = backend
+        self.mainframe = mainframe
+        self.name = backend.name
+
+    def __getattr__(self,attr):
+        target = getattr(self.backend,attr)
+        if attr not in self.CALLS: return target
+        def timed_call(*args,**kwargs):
+            start = time.perf_counter()
+            try:
+                return target(*args,**kwargs)
+            except BackendError:
+                metrics.inc("gemcaen_backend_errors_total",help_text="Failed mainframe calls",mainframe=self.mainframe,call=attr)
+                raise
+            finally:
+                metrics.observe("gemcaen_backend_call_seconds",time.perf_counter() - start,help_text="Latency of the mainframe calls",mainframe=self.mainframe,call=attr)
+        setattr(self,attr,timed_call) ## __getattr__ is not called again for this attribute
+        return timed_call
+
+
+_default_backend = None
+
+def get_backend(cfg_Mainframe=None):
+    global _default_backend
+    backend_name = "pycaenhv" if cfg_Mainframe is None else cfg_Mainframe.get("BACKEND","pycaenhv")
+    if backend_name == "pycaenhv":
+        if _default_backend is None: _default_backend = PyCaenBackend()
+        if cfg_Mainframe is not None and cfg_Mainframe.get("EVENT_PORT") is not None:
+            _default_backend.event_ports[cfg_Mainframe["CAENHV_BOARD_ADDRESS"]] = cfg_Mainframe["EVENT_PORT"]
+        return _default_backend
+    elif backend_name == "simulated":
+        from simulator import SimulatedBackend
+        return SimulatedBackend(cfg_Mainframe.get("SIMULATION",{}))
+    else:
+        raise ValueError("Invalid BACKEND ",backend_name,". Valid backends are pycaenhv, simulated")
@@ -0,0 +1,235 @@
+from prompt_logger import logger as logging
+from argparse import RawTextHelpFormatter
+import argparse
+import sys
+import threading
+import time
+import tracemalloc
+import numpy as np
+import tableformatter as tf
+import influx_writer
+from influx_writer import BatchingWriter
+from logger_classes import MainframeLogger
+from simulator import SimulatedBackend
+from caen_classes import BaseMainframe, make_board
+from change_detection import DeadbandFilter
+from line_protocol import LineSerializer
+from sample import Sample, SampleSchema
+from alarms import AlarmEngine, parse_alarms, add_hook, remove_hook
+
+## Throughput benchmark of the polling stack on simulated mainframes (no hardware nor DB needed)
+
+class TimedLock:
+    """ threading.Lock that records how long it is waited for and held """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.wait_times = []
+        self.hold_times = []
+        self._acquired_at = 0.
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self._lock.acquire()
+        self._acquired_at = time.perf_counter()
+        self.wait_times.append(self._acquired_at - start)
+        return self
+
+    def __exit__(self,type,value,traceback):
+        self.hold_times.append(time.perf_counter() - self._acquired_at)
+        self._lock.release()
+
+
+class BenchmarkWriter(BatchingWriter):
+    """ BatchingWriter with a fake DB taking db_latency seconds per write. Records the sample to DB latency of every point """
+    def __init__(self,db_latency=0.005,**kwargs):
+        super().__init__("http://benchmark","token","org",**kwargs)
+        self.db_latency = db_latency
+        self.sample_latencies = []
+
+    def _send(self,bucket,records):
+        time.sleep(self.db_latency)
+
+    def flush(self,batch):
+        super().flush(batch)
+        done = time.time()
+        self.sample_latencies.extend( done - sample_time for _,_,_,sample_time in batch )
+
+
+def make_config(n_mainframes,n_boards,latency,holdoff,latency_per_channel=0.):
+    ## same layout as config_parser.load_config output: one GEM board (A1515) per slot
+    cfg_influxDB = {"DB_BUCKET":"benchmark","ORG":"org","TOKEN":"token","URL":"http://benchmark"}
+    cfg = {}
+    for m in range(n_mainframes):
+        ip = f"simulated-{m}"
+        cfg_Simulation = {"LATENCY":latency,"LATENCY_PER_CHANNEL":latency_per_channel,"SEED":m,"INITIAL":{"V0Set":600,"Pw":1},
+                          "BOARDS":{ slot:{"MODEL":"A1515","CHANNELS":14} for slot in range(n_boards) }}
+        cfg[ip] = {"MAINFRAME":{"BACKEND":"simulated","SIMULATION":cfg_Simulation,"METADATA_CACHE":False,"CAENHV_BOARD_TYPE":"SY4527","CAENHV_LINK_TYPE":"TCPIP",
+                                "CAENHV_BOARD_ADDRESS":ip,"CAENHV_USER":"user","CAENHV_PASSWORD":"password"},
+                   "configs":{}}
+        for slot in range(n_boards):
+            cfg[ip]["configs"][f"bench_{m}_{slot}"] = {"Monitorables":["VMon","IMon","I0Set","V0Set","Pw","Status","Ieq"],"HoldOffTime":holdoff,
+                                                       "isGEMDetector":True,"BOARD":{"SLOT":slot,"LAYER":1},"influxDB":dict(cfg_influxDB),
+                                                       "Deadbands":{}}
+    return cfg,cfg_influxDB
+
+
+def run_benchmark(n_mainframes=1,n_boards=1,duration=10.,latency=0.001,holdoff=0.,db_latency=0.005,latency_per_channel=0.):
+    SimulatedBackend.reset()
+    cfg,cfg_influxDB = make_config(n_mainframes,n_boards,latency,holdoff,latency_per_channel)
+    writer = BenchmarkWriter(db_latency)
+    influx_writer.set_writer(cfg_influxDB,writer)
+    writer.start()
+
+    terminateEvent = threading.Event()
+    loggers = {}
+    for ip in cfg:
+        loggers[ip] = MainframeLogger(cfg[ip]["MAINFRAME"],cfg[ip]["configs"],terminateEvent)
+        loggers[ip].lock = TimedLock()
+    for mainframe_logger in loggers.values(): mainframe_logger.start()
+    ## wait for the boards to be initialized before counting
+    time.sleep(0.5)
+    n_polls_start = { ip:sum(d.n_polls for d in l.devices.values()) for ip,l in loggers.items() }
+    time.sleep(duration)
+    n_polls_end = { ip:sum(d.n_polls for d in l.devices.values()) for ip,l in loggers.items() }
+    terminateEvent.set()
+    for mainframe_logger in loggers.values(): mainframe_logger.join()
+    writer.close()
+
+    results = {}
+    for ip,mainframe_logger in loggers.items():
+        hold_times = np.array(mainframe_logger.lock.hold_times[n_boards:]) ## skip the boards initialization
+        wait_times = np.array(mainframe_logger.lock.wait_times[n_boards:])
+        results[ip] = {"polls_per_sec":(n_polls_end[ip] - n_polls_start[ip]) / duration,
+                       "lock_hold_mean_ms":hold_times.mean()*1e3 if len(hold_times) else np.nan,
+                       "lock_hold_max_ms":hold_times.max()*1e3 if len(hold_times) else np.nan,
+                       "lock_wait_mean_ms":wait_times.mean()*1e3 if len(wait_times) else np.nan,
+                       "deadline_misses":sum(mainframe_logger.scheduler.deadline_misses.values())}
+    latencies = np.array(writer.sample_latencies)
+    results["sample_to_db_ms"] = {"p50":np.percentile(latencies,50)*1e3,"p99":np.percentile(latencies,99)*1e3,"max":latencies.max()*1e3} if len(latencies) else {}
+    return results
+
+
+def measure_polls(poll,n_polls,n_traced):
+    ## polls/s without tracing, then under tracemalloc: bytes still allocated after n_traced polls (growth) and mean peak of the
+    ## allocations of one poll above what was allocated before it (transient)
+    for _ in range(100): poll() ## warm-up: type probes, caches, buffers
+    start = time.perf_counter()
+    for _ in range(n_polls): poll()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    base = current = tracemalloc.get_traced_memory()[0]
+    transient = 0
+    for _ in range(n_traced):
+        before = current
+        tracemalloc.reset_peak()
+        poll()
+        current,peak = tracemalloc.get_traced_memory()
+        transient += peak - before
+    tracemalloc.stop()
+    return {"polls_per_sec":n_polls / elapsed,"us_per_poll":elapsed / n_polls * 1e6,"transient_bytes_per_poll":transient / n_traced,"growth_bytes":current - base}
+
+def run_sample_benchmark(n_polls=1000000,n_traced=10000,latency=0.):
+    ## cost per poll of the device acquisition path on one simulated GEM board: read into the reused Sample, change detection and
+    ## line protocol of the changed fields. BaseBoard.log (a dict of dicts per poll, read only) as reference
+    SimulatedBackend.reset()
+    cfg,_ = make_config(1,1,latency,0.)
+    mainframe_cfg = next(iter(cfg.values()))
+    device_cfg = next(iter(mainframe_cfg["configs"].values()))
+    results = {}
+    with BaseMainframe(mainframe_cfg["MAINFRAME"]) as mainframe:
+        board = make_board(device_cfg,mainframe)
+        board.set_monitorables(device_cfg["Monitorables"])
+        sample = Sample(board.sample_schema())
+        change_filter = DeadbandFilter(board._channels,{"VMon":0.5,"IMon":"2%"},keepalive=60)
+        serializer = LineSerializer("HV",{ ch:board.channel_names_map[ch] for ch in board._channels })
+        def poll_sample():
+            board.monitor_sample(sample)
+            serializer.serialize(sample,change_filter.update(sample))
+        results["Sample + change detection + line protocol"] = measure_polls(poll_sample,n_polls,n_traced)
+        results["BaseBoard.log (dict of dicts)"] = measure_polls(board.log,n_polls,n_traced)
+    return results
+
+def print_sample_report(results):
+    cols = ["Path","Polls/s","us/poll","Transient bytes/poll","Growth (bytes)"]
+    rows = [ [path,round(r["polls_per_sec"]),round(r["us_per_poll"],1),round(r["transient_bytes_per_poll"]),r["growth_bytes"]] for path,r in results.items() ]
+    print(tf.generate_table(rows, cols, grid_style=tf.AlternatingRowGrid()))
+
+
+ALARM_RULES = [{"Name":"overcurrent","Quantity":"IMon","Above":2.},
+               {"Name":"undervoltage","Quantity":"VMon","Below":550.},
+               {"Name":"ramp","Quantity":"VMon","Rate":20.},
+               {"Name":"divider","Quantity":"Ieq","Deviation":20.},
+               {"Name":"trip","Status":["OVC","OVV","EXTTRIP","INTTRIP"]}]
+
+def run_alarm_benchmark(n_polls=100000,n_channels=14,n_rules=len(ALARM_RULES),trip_every=100):
+    ## time added to each poll by the alarm rules (AlarmEngine.check) on a GEM-like sample of n_channels, n_rules rules (ALARM_RULES
+    ## repeated), a channel tripping and recovering every trip_every polls. The notify action calls a function doing nothing
+    quantities = ["VMon","IMon","V0Set","Pw","Status","Ieq"]
+    rules,_ = parse_alarms({"Rules":[ {**rule,"Name":f"{rule['Name']}_{index}","Actions":["notify"]}
+                                      for index,rule in ( (index,ALARM_RULES[index % len(ALARM_RULES)]) for index in range(n_rules) ) ]},quantities)
+    engine = AlarmEngine("benchmark",rules)
+    sample = Sample(SampleSchema(range(n_channels),quantities,integer=["Pw","Status","Ieq"]))
+    rng = np.random.default_rng(0)
+    noise = rng.normal(0,0.05,(1000,n_channels))
+    hook = lambda alarm: None
+    add_hook(hook)
+    durations = np.empty(n_polls)
+    for poll in range(n_polls):
+        tripped = poll % trip_every < trip_every // 2
+        sample.set("VMon",600. + noise[poll % 1000])
+        sample.set("IMon",1. + noise[poll % 1000]/10)
+        sample.set("V0Set",600.), sample.set("Pw",1), sample.set("Ieq",960)
+        sample.set("Status",1)
+        if tripped: sample.buffer[4,poll // trip_every % n_channels] = 1 | 1 << 9
+        sample.timestamp = poll*1.
+        start = time.perf_counter()
+        engine.check(sample)
+        durations[poll] = time.perf_counter() - start
+    remove_hook(hook)
+    durations *= 1e6
+    return {"rules":n_rules,"channels":n_channels,"polls":n_polls,"alarms_raised":engine.n_raised,
+            "mean_us":durations.mean(),"p50_us":np.percentile(durations,50),"p99_us":np.percentile(durations,99),"max_us":durations.max()}
+
+def print_alarm_report(results):
+    cols = ["Rules","Channels","Polls","Alarms raised","Mean (us)","p50 (us)","p99 (us)","Max (us)"]
+    rows = [[results["rules"],results["channels"],results["polls"],results["alarms_raised"]] + [ round(results[key],1) for key in ("mean_us","p50_us","p99_us","max_us") ]]
+    print(tf.generate_table(rows, cols, grid_style=tf.AlternatingRowGrid()))
+
+
+def print_report(results):
+    cols = ["Mainframe","Polls/s","Lock hold mean (ms)","Lock hold max (ms)","Lock wait mean (ms)","Deadline misses"]
+    rows = [ [ip,round(r["polls_per_sec"],2),round(r["lock_hold_mean_ms"],3),round(r["lock_hold_max_ms"],3),round(r["lock_wait_mean_ms"],3),r["deadline_misses"]] for ip,r in results.items() if ip != "sample_to_db_ms" ]
+    print(tf.generate_table(rows, cols, grid_style=tf.AlternatingRowGrid()))
+    latency = results["sample_to_db_ms"]
+    if latency: print(f"Sample to DB latency: p50 {latency['p50']:.1f} ms, p99 {latency['p99']:.1f} ms, max {latency['max']:.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='''Measures polls/sec, mainframe lock hold time and sample to DB latency of the logging stack on N simulated mainframes x M GEM boards''',
+        epilog="""Typical exectuion\n\t python benchmark.py --mainframes 2 --boards 4 --duration 10 --latency 0.002\n\t python benchmark.py --samples --polls 1000000\n\t python benchmark.py --alarms --rules 20 --channels 14""",
+        formatter_class=RawTextHelpFormatter
+    )
+    parser.add_argument("--mainframes", type=int, default=1, help="Number of simulated mainframes")
+    parser.add_argument("--boards", type=int, default=1, help="Number of GEM boards per mainframe")
+    parser.add_argument("--duration", type=float, default=10., help="Seconds of logging to be measured")
+    parser.add_argument("--latency", type=float, default=0.001, help="Seconds spent by each mainframe call")
+    parser.add_argument("--latency-per-channel", type=float, default=0., help="Extra seconds per channel of a multi-channel read")
+    parser.add_argument("--holdoff", type=float, default=0., help="HoldOffTime of the devices")
+    parser.add_argument("--db-latency", type=float, default=0.005, help="Seconds spent by each DB write")
+    parser.add_argument("--samples", action="store_true", help="Instead: polls/s and allocations (tracemalloc) of the acquisition path of one board,\nfrom the read to the line protocol, with --latency 0 unless given")
+    parser.add_argument("--polls", type=int, default=1000000, help="--samples: polls timed")
+    parser.add_argument("--traced-polls", type=int, default=10000, help="--samples: polls traced by tracemalloc")
+    parser.add_argument("--alarms", action="store_true", help="Instead: time added to each poll by the alarm rules (see alarms.py)")
+    parser.add_argument("--rules", type=int, default=len(ALARM_RULES), help="--alarms: number of rules")
+    parser.add_argument("--channels", type=int, default=14, help="--alarms: channels of the sample")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.samples:
+        print_sample_report(run_sample_benchmark(args.polls,args.traced_polls,args.latency if "--latency" in sys.argv else 0.))
+        sys.exit(0)
+    if args.alarms:
+        print_alarm_report(run_alarm_benchmark(min(args.polls,100000) if "--polls" not in sys.argv else args.polls,args.channels,args.rules))
+        sys.exit(0)
+    print_report(run_benchmark(args.mainframes,args.boards,args.duration,args.latency,args.holdoff,args.db_latency,args.latency_per_channel))
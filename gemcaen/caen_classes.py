@@ -3,36 +3,87 @@ import numbers
 import time
 from datetime import datetime
 import sys
-from pycaenhv.wrappers import init_system, deinit_system, get_board_parameters, get_crate_map, get_channel_parameters,get_channel_parameter, list_commands,get_channel_parameter_property,get_channel_name,set_channel_parameter
-from pycaenhv.enums import CAENHV_SYSTEM_TYPE, LinkType
-from pycaenhv.errors import CAENHVError
-import pycaenhv
+import numpy as np
+from backends import get_backend, BackendError, BulkNotSupported, InstrumentedBackend
+from metadata_cache import MetadataCache, CACHE_PATH
 from prompt_logger import logger as logging
+from sample import Sample, SampleSchema
 
 def throwVomit(value=16):
     global timestamp
     date = datetime.now().timestamp()
     if int(date) - timestamp > value:
         timestamp = int(date)
-        raise pycaenhv.errors.CAENHVError("Login failed ")
+        raise BackendError("Login failed ")
 
 ## TODO 
 # Possible to simplify channel managing? The variables _channels,n_channels,channel_names_map,channel_quantities_map may be merged into 2
-# Catch communication errors coming from pycaen
 
 timestamp = int(datetime.now().timestamp())
 
 
+class CircuitBreaker:
+    """ Tracks the consecutive communication failures of a mainframe.
+        After each failure the next attempt is delayed by an exponential backoff (base_delay*2^n, at most max_delay).
+        After max_failures the circuit opens: attempts continue at the backoff rate, but only state changes get logged.
+    """
+    def __init__(self,name,max_failures=3,base_delay=1.,max_delay=60.):
+        self.name = name
+        self.max_failures = max_failures
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failures = 0
+        self.retry_at = 0. ## time.monotonic() of the next allowed attempt
+        self.n_opened = 0
+
+    @property
+    def is_open(self):
+        return self.failures >= self.max_failures
+
+    def time_to_retry(self):
+        return max(self.retry_at - time.monotonic(),0.)
+
+    def allow(self):
+        return time.monotonic() >= self.retry_at
+
+    def record_success(self):
+        if self.is_open: logging.info(f"{self.name}: communication restored after {self.failures} failures. Circuit closed")
+        self.failures = 0
+        self.retry_at = 0.
+
+    def record_failure(self,error):
+        self.failures += 1
+        delay = min(self.base_delay * 2**(self.failures-1),self.max_delay)
+        self.retry_at = time.monotonic() + delay
+        if self.failures < self.max_failures:
+            logging.warning(f"{self.name}: communication error ({error}). Retrying in {delay:.0f} s")
+        elif self.failures == self.max_failures:
+            self.n_opened += 1
+            logging.error(f"{self.name}: {self.failures} consecutive communication errors, last one: {error}. Circuit open, retrying every {self.max_delay:.0f} s at most")
+        else:
+            logging.debug(f"{self.name}: communication error ({error}). Retrying in {delay:.0f} s")
+
+
 class BaseMainframe:
     def __init__(self,cfg_Mainframe):
         self.cfg = cfg_Mainframe
+        self.backend = InstrumentedBackend(get_backend(self.cfg),self.cfg['CAENHV_BOARD_ADDRESS']) ## pycaenhv, unless MAINFRAME.BACKEND says otherwise
         self.handle = None
+        self.crate_map = None
+        ## channel names/parameters cached on disk, unless MAINFRAME.METADATA_CACHE is False. It can also be the path of the cache file
+        cache_path = self.cfg.get("METADATA_CACHE",True)
+        if cache_path is False: self.metadata_cache = None
+        else: self.metadata_cache = MetadataCache(self.cfg['CAENHV_BOARD_ADDRESS'],CACHE_PATH if cache_path is True else cache_path)
+        self.breaker = CircuitBreaker(f"Mainframe {self.cfg['CAENHV_BOARD_ADDRESS']}",
+                                      max_failures = self.cfg.get("CIRCUIT_MAX_FAILURES",3),
+                                      base_delay = self.cfg.get("RETRY_BASE_DELAY",1.),
+                                      max_delay = self.cfg.get("RETRY_MAX_DELAY",60.))
 
     def __enter__(self):
         try:
             logging.info(f"Init mainframe ({self.cfg['CAENHV_BOARD_ADDRESS']})")
             self.handle = self.get_cratehandle()
-        except pycaenhv.errors.CAENHVError as a:
+        except BackendError as a:
             logging.error(f"... failed")
             if self.__exit__(*sys.exc_info()):
                 pass
@@ -43,44 +94,88 @@ class BaseMainframe:
     def close(self):
         if self.handle != None:
             logging.info(f"Deinit mainframe ({self.cfg['CAENHV_BOARD_ADDRESS']})")
-            deinit_system(self.handle)
+            try:
+                self.backend.deinit_system(self.handle)
+            except BackendError as e: ## i.e. session already closed by the mainframe
+                logging.warning(f"Deinit mainframe ({self.cfg['CAENHV_BOARD_ADDRESS']}) failed: {e}")
             self.handle = None
+            self.crate_map = None
+
+    def reconnect(self):
+        ## logs in again, i.e. after the handle got lost. Raises BackendError if the login fails
+        (logging.debug if self.breaker.is_open else logging.info)(f"Re-login to mainframe ({self.cfg['CAENHV_BOARD_ADDRESS']})")
+        if self.handle != None:
+            try:
+                self.backend.deinit_system(self.handle)
+            except BackendError: ## the session is most likely lost already
+                pass
+            self.handle = None
+            self.crate_map = None
+        self.handle = self.get_cratehandle()
+        return self.handle
         
     def __exit__(self,type,value,traceback):
         self.close()
-        ## if the exit method gets called upon an execption, handle it by printing out the exception only if it's a pycaenhv, otherwise raise
-        if type == pycaenhv.errors.CAENHVError:
+        ## if the exit method gets called upon an execption, handle it by printing out the exception only if it's a communication error, otherwise raise
+        if type == BackendError:
             logging.error(f"Handling exception of type {type}. Exception value: {value}")
             return True
 
     def get_cratehandle(self):
-        system_type = CAENHV_SYSTEM_TYPE[self.cfg['CAENHV_BOARD_TYPE']]
-        link_type = LinkType[self.cfg['CAENHV_LINK_TYPE']]
         logging.debug(f"Getting crate handle and logging in...")
-        handle = init_system(system_type, link_type,
+        handle = self.backend.init_system(self.cfg['CAENHV_BOARD_TYPE'], self.cfg['CAENHV_LINK_TYPE'],
                              self.cfg['CAENHV_BOARD_ADDRESS'],
                              self.cfg['CAENHV_USER'],
                              self.cfg['CAENHV_PASSWORD'])
         logging.debug(f"... success")
         return handle
 
+    def get_crate_map(self):
+        ## fetched once per session and shared by all the boards
+        if self.crate_map is None:
+            self.crate_map = self.backend.get_crate_map(self.handle)
+        return self.crate_map
+
+def make_board(cfg_device,mainframe):
+    ## board of a setup config, on an open mainframe session
+    board_class = GemBoard if cfg_device["isGEMDetector"] else BaseBoard
+    return board_class(cfg_device["BOARD"],mainframe.handle,mainframe.backend,mainframe.get_crate_map(),mainframe.metadata_cache)
+
+def config_channels(cfg_device):
+    ## channels of a setup config, as make_board configures them: the 7 channels of the GEM layer, or BOARD.CHANNELS.
+    ## None if all the channels of the board (only known once logged in)
+    if cfg_device["isGEMDetector"]: return list(range(7)) if cfg_device["BOARD"]["LAYER"] == 1 else list(range(7,14))
+    return cfg_device["BOARD"].get("CHANNELS")
+
 class BaseBoard:
     """ Base class to handle a CAEN board """
-    def __init__(self,cfg_Board,handle):
+    ## derived quantities: name -> (board quantities it is computed from, name of the method computing it from their arrays, dtype).
+    ## They are computed from the arrays fetched in the same poll and never read from the board
+    derived_quantities = {}
+
+    def __init__(self,cfg_Board,handle,backend=None,crate_map=None,metadata_cache=None):
         self.handle = handle
+        self.backend = backend if backend is not None else get_backend() ## same backend as the mainframe that gave the handle
         if self.handle == None:
             raise ValueError("Invalid Mainframe handle ",self.handle)
         else:
             self.cfg = cfg_Board
             self.board_slot = self.cfg["SLOT"]
             self._monitorables = ["VMon","IMon","I0Set","V0Set","Pw","Status"]
-            self.crate_map = get_crate_map(self.handle)
+            self._quantity_dtypes = dict()  ## quantity -> numpy dtype, probed on first read
+            self._bulk_rejected = set()  ## quantities for which the board does not support multi-channel access (BulkNotSupported)
+            self.metadata_cache = metadata_cache
+            self.crate_map = crate_map if crate_map is not None else self.backend.get_crate_map(self.handle)
             self.board_name = self.crate_map["models"][self.board_slot]
             self.board_description = self.crate_map["descriptions"][self.board_slot]
             self.n_channels = self.crate_map["channels"][self.board_slot]
             self._channels = list(range(self.n_channels)) ## take all possible channels
-            self.channel_names_map, self.channel_quantities_map = self.map_channels()  ## channel_<name/quant>_map[ch_index] = ch_<name/quant>
-            if "CHANNELS" in self.cfg.keys(): self.set_channels(self.cfg["CHANNELS"])  ## use only those specified in the config file, if any
+            self.channel_names_map, self.channel_quantities_map = dict(), dict()  ## channel_<name/quant>_map[ch_index] = ch_<name/quant>, only for the used channels
+            self.set_channels(self.default_channels())
+
+    def default_channels(self):
+        ## use only those specified in the config file, if any
+        return self.cfg.get("CHANNELS",list(range(self.crate_map["channels"][self.board_slot])))
 
     def validChannel(self,channel_index:int):
         if channel_index not in self._channels:
@@ -93,18 +188,26 @@ class BaseBoard:
             return False
         return True
 
-    def map_channels(self):
-        channel_names_map = dict()
-        channel_quantities_map = dict()
-        for ch in self._channels:
-            channel_names_map[ch] = get_channel_name(self.handle,self.board_slot,ch)
-            channel_quantities_map[ch] = get_channel_parameters(self.handle,self.board_slot,ch)
-        return  channel_names_map,channel_quantities_map
+    def map_channels(self,channels):
+        ## fills channel_<name/quant>_map for the channels not mapped yet, from the metadata cache if possible
+        cache_updated = False
+        for ch in channels:
+            if ch in self.channel_names_map: continue
+            cached = self.metadata_cache.get_channel(self.board_slot,self.crate_map,ch) if self.metadata_cache is not None else None
+            if cached is None:
+                cached = (self.backend.get_channel_name(self.handle,self.board_slot,ch), self.backend.get_channel_parameters(self.handle,self.board_slot,ch))
+                if self.metadata_cache is not None:
+                    self.metadata_cache.set_channel(self.board_slot,self.crate_map,ch,*cached)
+                    cache_updated = True
+            self.channel_names_map[ch], self.channel_quantities_map[ch] = cached
+        if cache_updated: self.metadata_cache.save()
+        return self.channel_names_map,self.channel_quantities_map
 
     def set_channels(self,channels_list:list):
-        if all( channel in self._channels for channel in channels_list): ## parsed channel list is contained in the available channels (self._channels)
+        if all( channel in range(self.crate_map["channels"][self.board_slot]) for channel in channels_list): ## parsed channel list is contained in the available channels
             self.n_channels = len(channels_list)
             self._channels = channels_list
+            self.map_channels(self._channels)
 
             for k in list(self.channel_names_map): ## purge unused channels
                 if k not in self._channels:
@@ -133,30 +236,141 @@ class BaseBoard:
         self.table_printer(cols,rows)
         
     def get_channel_value(self,channel_index:int,quantity:str):
+        ## communication errors are raised as BackendError, retries are up to the caller
         if self.validChannel(channel_index) and self.validQuantity(channel_index,quantity):
-            try:
-                return get_channel_parameter(self.handle,self.board_slot,channel_index,quantity)
-            except Exception as e:
-                logging.error(e)
-                logging.warning(f"Found a problem in retrieving the channel. Retying in 5 secs")
-                time.sleep(5)
-                self.get_channel_value(channel_index,quantity)
-                
+            return self.backend.get_channel_parameter(self.handle,self.board_slot,channel_index,quantity)
+
     def set_channel_value(self,channel_index:int,quantity:str,value):
         if self.validChannel(channel_index) and self.validQuantity(channel_index,quantity) and isinstance(value, numbers.Number):
-            set_channel_parameter(self.handle,self.board_slot,channel_index,quantity, value)
+            self.backend.set_channel_parameter(self.handle,self.board_slot,channel_index,quantity, value)
         else:
             raise ValueError("Invalid value ",value," for ",quantity)
 
-    def monitor(self):
-        monitored_data = dict()
-        for ch in self._channels:
-            channel_data = dict()
-            for mon in self._monitorables:
-                channel_data[mon] = self.get_channel_value(ch,mon)
-            monitored_data[ch] = channel_data
+    def set_channels_value(self,quantity:str,channel_values:dict):
+        ## channel_values[ch] = value. Validated once, then one mainframe call per distinct value (i.e. the same V0Set on all the
+        ## channels of a layer is a single call). If the board does not support the multi-channel write, fall back to one call per channel.
+        ## Any other error of a multi-channel write is retried per channel this time only
+        for ch,value in channel_values.items():
+            if not (self.validChannel(ch) and self.validQuantity(ch,quantity) and isinstance(value,numbers.Number)):
+                raise ValueError("Invalid value ",value," for ",quantity)
+        numeric = self.quantity_dtype(quantity) == np.float64
+        groups = dict()
+        for ch,value in channel_values.items():
+            groups.setdefault(value,[]).append(ch)
+        for value,channels in groups.items():
+            if quantity in self._bulk_rejected:
+                [ self.backend.set_channel_parameter(self.handle,self.board_slot,ch,quantity,value) for ch in channels ]
+                continue
+            try:
+                self.backend.set_channels_parameter(self.handle,self.board_slot,channels,quantity,value,numeric=numeric)
+            except BulkNotSupported as e:
+                [ self.backend.set_channel_parameter(self.handle,self.board_slot,ch,quantity,value) for ch in channels ] ## raises if the problem is not the bulk write
+                logging.warning(f"Board on slot {self.board_slot} rejected the multi-channel write of {quantity} ({e}). Falling back to per-channel writes")
+                self._bulk_rejected.add(quantity)
+            except BackendError as e: ## i.e. a transient communication error
+                [ self.backend.set_channel_parameter(self.handle,self.board_slot,ch,quantity,value) for ch in channels ]
+                logging.debug(f"Multi-channel write of {quantity} on slot {self.board_slot} failed ({e}). Written per channel this time")
+
+    def quantity_dtype(self,quantity:str):
+        ## numpy dtype of quantity, probed on first use (float or int) with a plain call
+        if quantity not in self._quantity_dtypes:
+            [ self.validQuantity(ch,quantity) for ch in self._channels ]
+            probe = self.backend.get_channel_parameter(self.handle,self.board_slot,self._channels[0],quantity)
+            self._quantity_dtypes[quantity] = np.float64 if isinstance(probe,float) else np.int64
+        return self._quantity_dtypes[quantity]
+
+    def _read_quantity_per_channel(self,quantity:str):
+        return [ self.backend.get_channel_parameter(self.handle,self.board_slot,ch,quantity) for ch in self._channels ]
+
+    def fetch_quantity(self,quantity:str):
+        ## returns the values of quantity for all the configured channels (ordered as self._channels) as a numpy array
+        ## All channels are read with a single mainframe call. If the board does not support it, fall back to one call per channel.
+        ## Any other error of the multi-channel read is retried per channel for this read only: the next one is a single call again
+        dtype = self.quantity_dtype(quantity)
+        if quantity in self._bulk_rejected:
+            values = self._read_quantity_per_channel(quantity)
+        else:
+            try:
+                values = self.backend.get_channels_parameter(self.handle,self.board_slot,self._channels,quantity,numeric = dtype==np.float64)
+            except BulkNotSupported as e:
+                values = self._read_quantity_per_channel(quantity) ## raises if the problem is not the bulk read
+                logging.warning(f"Board on slot {self.board_slot} rejected the multi-channel read of {quantity} ({e}). Falling back to per-channel reads")
+                self._bulk_rejected.add(quantity)
+            except BackendError as e: ## i.e. a transient communication error
+                values = self._read_quantity_per_channel(quantity)
+                logging.debug(f"Multi-channel read of {quantity} on slot {self.board_slot} failed ({e}). Read per channel this time")
+        return np.asarray(values,dtype=dtype)
+
+    def hw_quantities(self,quantities=None):
+        ## the quantities read from the board to monitor quantities: the derived ones are replaced by their dependencies
+        if quantities is None: quantities = self._monitorables
+        hw_quantities = []
+        for quantity in quantities:
+            dependencies = self.derived_quantities[quantity][0] if quantity in self.derived_quantities else (quantity,)
+            hw_quantities += [ dependency for dependency in dependencies if dependency not in hw_quantities ]
+        return hw_quantities
+
+    def calls_per_poll(self,quantities=None):
+        ## mainframe calls needed to monitor quantities: one per quantity, one per channel if the board rejected the multi-channel read
+        return sum( len(self._channels) if quantity in self._bulk_rejected else 1 for quantity in self.hw_quantities(quantities) )
+
+    def sample_schema(self,quantities=None):
+        ## fixed layout of the samples of quantities (see sample.py). Probes the type of the board quantities not read yet
+        if quantities is None: quantities = self._monitorables
+        integer = []
+        for quantity in quantities:
+            if quantity in self.derived_quantities:
+                dtype = self.derived_quantities[quantity][2]
+            else:
+                try:
+                    dtype = self.quantity_dtype(quantity)
+                except ValueError: ## not a quantity of the board: always a failed read
+                    dtype = np.float64
+            if dtype == np.int64: integer.append(quantity)
+        return SampleSchema(self._channels,quantities,integer)
+
+    def monitor_sample(self,sample):
+        ## reads the quantities of sample (a Sample of sample_schema) into its buffer, stamped with the acquisition time. Returns sample
+        if self.handle == None:
+            raise ValueError("Invalid Mainframe handle ",self.handle)
+        hw_arrays = dict()
+        for quantity in self.hw_quantities(sample.schema.quantities):
+            try:
+                hw_arrays[quantity] = self.fetch_quantity(quantity)
+            except BackendError: ## communication problem: the whole poll failed, retry/reconnect is up to the caller
+                raise
+            except Exception as e:
+                logging.error(e)
+                logging.warning(f"Found a problem in retrieving {quantity} for slot {self.board_slot}")
+                hw_arrays[quantity] = np.nan
+        sample.timestamp = time.time()
+        return self.derive(hw_arrays,sample)
+
+    def monitor_arrays(self,quantities=None):
+        ## monitored_arrays[quantity] = np.array of values, one per channel in self._channels
+        return self.monitor_sample(Sample(self.sample_schema(quantities))).arrays()
+
+    def derive(self,hw_arrays,sample):
+        ## fills sample with its quantities, computing the derived ones from hw_arrays. Returns sample
+        for quantity in sample.schema.quantities:
+            if quantity in self.derived_quantities:
+                dependencies,method,_ = self.derived_quantities[quantity]
+                sample.set(quantity,getattr(self,method)(*[ hw_arrays[dependency] for dependency in dependencies ]))
+            else:
+                sample.set(quantity,hw_arrays[quantity])
+        return sample
+
+    def arrays_to_dict(self,monitored_arrays):
+        ## monitored_data[ch][quantity] = value, with python types. Failed reads (NaN) become None
+        monitored_data = { ch:dict() for ch in self._channels }
+        for quantity,values in monitored_arrays.items():
+            for ch,value in zip(self._channels,values.tolist()):
+                monitored_data[ch][quantity] = None if value != value else value
         return monitored_data
 
+    def monitor(self):
+        return self.arrays_to_dict(self.monitor_arrays())
+
     def log(self):
         monitored_data = self.monitor()
 
@@ -168,26 +382,35 @@ class BaseBoard:
 
 class GemBoard(BaseBoard):
     __Divider_Resistors = {"G3BOT":0.625007477,"G3TOP":0.525001495,"G2BOT":0.874992523,"G2TOP":0.550002991,"G1BOT":0.438004665,"G1TOP":0.560006579,"G0BOT":1.125007477}
-    def __init__(self,cfg_Board,handle):
-        super().__init__(cfg_Board,handle) ## init parent class
-        self.gem_layer = self.cfg["LAYER"]
+    derived_quantities = {"Ieq":(("VMon",),"channels_IEq",np.int64)}
+    def __init__(self,cfg_Board,handle,backend=None,crate_map=None,metadata_cache=None):
+        super().__init__(cfg_Board,handle,backend,crate_map,metadata_cache) ## init parent class
         self._monitorables = ["VMon","IMon","I0Set","V0Set","Pw","Status","Ieq"]
 
-        if self.gem_layer not in [1,2]: ## badly parsed layer --> deinit mainframe and raise error
-            raise ValueError("Invalid gem_layer parsed ",gem_layer) ## parse gem layer
+    def default_channels(self):
+        ## the 7 channels of the GEM layer. Called by BaseBoard.__init__ before the channels are mapped
         if "A1515" not in self.board_name: ## not a gem board --> deinit mainframe and raise error
             raise ValueError(f"Board {self.board_name!r} on slot {self.board_slot} not a GEM HV Board.") ## ensure GEM HV board
-        if self.gem_layer == 1: self.set_channels(list(range(7)))
-        else: self.set_channels(list(range(7,14)))
+        self.gem_layer = self.cfg["LAYER"]
+        if self.gem_layer not in [1,2]: ## badly parsed layer --> deinit mainframe and raise error
+            raise ValueError("Invalid gem_layer parsed ",self.gem_layer) ## parse gem layer
+        if self.gem_layer == 1: return list(range(7))
+        else: return list(range(7,14))
+
+    def set_channels(self,channels_list:list):
+        super().set_channels(channels_list)
+        ## divider resistor of each configured channel, from its name (i.e. L1_G3BOT). Ordered as self._channels
+        self._resistors = np.array([ self.__Divider_Resistors[ self.channel_names_map[ch].split("_")[-1] ] for ch in self._channels ])
+
+    def channels_IEq(self,VMon):
+        ## vectorized version of channel_IEq over the configured channels. Integers unless a VMon read failed (NaN)
+        Ieq = np.trunc(VMon / self._resistors)
+        return Ieq if np.isnan(Ieq).any() else Ieq.astype(np.int64)
 
     def channel_IEq(self,ch,VMon):
-        ch_name = self.channel_names_map[ch]
-        resistor = self.__Divider_Resistors[ ch_name.split("_")[-1] ]
-        return int( VMon / resistor)
+        return int( VMon / self._resistors[self._channels.index(ch)])
     def channel_VMon(self,ch,ieq):
-        ch_name = self.channel_names_map[ch]
-        resistor = self.__Divider_Resistors[ ch_name.split("_")[-1] ]
-        return round( ieq * resistor, 0)
+        return round( ieq * self._resistors[self._channels.index(ch)], 0)
 
     def print_Ieq(self):
         monitored = self.monitor()
@@ -201,24 +424,12 @@ class GemBoard(BaseBoard):
             rows.append([ch_name,VMon,channel_IEq,PW])
         self.table_printer(cols,rows)
 
-    def monitor(self):
-        if self.handle == None:
-            raise ValueError("Invalid Mainframe handle ",self.handle)
-
-        monitored_data = dict()
-        for ch in self._channels:
-            channel_data = dict()
-            for mon in self._monitorables:
-                if mon == "Ieq":
-                    channel_data[mon] = self.channel_IEq( ch , self.get_channel_value(ch,"VMon") )
-                else:
-                    channel_data[mon] = self.get_channel_value(ch,mon)
-            monitored_data[ch] = channel_data
-        return monitored_data
-    
-    def set_Ieq(self,ieq): ## under development
+    def set_Ieq(self,ieq):
+        ## V0Set of every channel for the equivalent divider current ieq (uA). Not interactive: setpoints.py plans (--dry-run),
+        ## applies and verifies setpoints on several boards and mainframes. Returns {ch: V0Set}
         self.set_monitorables(["VMon","Pw"])
         monitored = self.monitor()
+        targets = { ch:self.channel_VMon(ch,ieq) for ch in self._channels }
         logging.info("{:>40}{:>30}".format("Current (VMon,Pw,Ieq)","Next (VMon,Pw,Ieq)"))
         for ch,value in monitored.items():
             vmon = round(value['VMon'],1)
@@ -227,12 +438,9 @@ class GemBoard(BaseBoard):
                                                                 vmon,
                                                                 pw,
                                                                 self.channel_IEq(ch,vmon),   
-                                                                self.channel_VMon(ch,ieq),
+                                                                targets[ch],
                                                                 pw,
                                                                 ieq)
                                                                 )
-        if(input("Confirm(Y/N)?") =="Y"):
-            for ch in self._channels:
-                self.set_channel_value(ch,"V0Set",self.channel_VMon(ch,ieq))
-        else    :
-            logging.info(f"Ieq {ieq}uA not applied")
+        self.set_channels_value("V0Set",targets)
+        return targets
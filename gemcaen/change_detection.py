@@ -0,0 +1,62 @@
+import numpy as np
+
+def parse_deadband(value):
+    ## 0.5 -> absolute deadband of 0.5; "1%" -> relative deadband of 1% of the last pushed value
+    if isinstance(value,str) and value.strip().endswith("%"):
+        return 0., float(value.strip()[:-1])/100.
+    if isinstance(value,str) or not value >= 0:
+        raise ValueError("Invalid deadband ",value,". Expected a positive number or a percentage string (i.e. \"1%\")")
+    return float(value), 0.
+
+
+class DeadbandFilter:
+    """ Keeps the last pushed value of each channel quantity and reports only those that moved beyond their deadband """
+    def __init__(self,channels,deadbands=None,keepalive=5*60):
+        self.channels = list(channels)
+        self.keepalive = keepalive ## seconds after which all fields are pushed, regardless of changes
+        self.deadbands = { quantity:parse_deadband(band) for quantity,band in (deadbands or {}).items() } ## quantity -> (absolute,relative)
+        self.reset()
+
+    def reset(self):
+        self._schema = None
+        self._last = None ## np.array [quantity,channel] of the last pushed values, laid out as the samples
+        self.last_full_time = None
+
+    def _prepare(self,schema):
+        ## buffers of the sample layout, allocated once: the filter runs on every poll
+        self._schema = schema
+        shape = (len(schema.quantities),len(schema.channels))
+        self._last = np.full(shape,np.nan)
+        self._absolute = np.array([ self.deadbands.get(quantity,(0.,0.))[0] for quantity in schema.quantities ])[:,None]
+        self._relative = np.array([ self.deadbands.get(quantity,(0.,0.))[1] for quantity in schema.quantities ])[:,None]
+        self._threshold = np.empty(shape)
+        self._diff = np.empty(shape)
+        self._changed = np.empty(shape,dtype=bool)
+        self._unknown = np.empty(shape,dtype=bool)
+        self._mask = np.empty(shape,dtype=bool)
+        self.last_full_time = None
+
+    def update(self,sample):
+        ## returns the mask [quantity,channel] of the fields of sample to be pushed. Valid till the next update
+        if sample.schema != self._schema: self._prepare(sample.schema)
+        values,last,mask = sample.buffer,self._last,self._mask
+        np.isnan(values,out=mask)
+        np.logical_not(mask,out=mask) ## a failed read (NaN) is never pushed
+        full = self.last_full_time is None or sample.timestamp - self.last_full_time >= self.keepalive
+        if full:
+            self.last_full_time = sample.timestamp
+        else:
+            threshold,diff,changed = self._threshold,self._diff,self._changed
+            np.abs(last,out=threshold)
+            np.multiply(threshold,self._relative,out=threshold)
+            np.maximum(threshold,self._absolute,out=threshold)
+            np.subtract(values,last,out=diff)
+            np.abs(diff,out=diff)
+            with np.errstate(invalid="ignore"):
+                np.greater(diff,threshold,out=changed)
+            ## the first good value after a failure is always pushed
+            np.isnan(last,out=self._unknown)
+            np.logical_or(changed,self._unknown,out=changed)
+            np.logical_and(mask,changed,out=mask)
+        np.copyto(last,values,where=mask)
+        return mask
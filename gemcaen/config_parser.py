@@ -1,74 +1,193 @@
 import yaml
-from deepdiff import DeepDiff
+import os
 import pathlib
+from typing import NamedTuple, Optional, Union
 from prompt_logger import logger as logging
+from line_protocol import PRECISIONS
+from alarms import parse_alarms
 
 CONFIG_PATH = pathlib.Path(__file__).parent / "config/config.yml"
 
-def load_config(setup_names):
-    loaded_cfg = {}
-    for setup_name in setup_names:
-        with CONFIG_PATH.open() as ymlfile:
-            cfg = yaml.full_load(ymlfile)
-        check_config(setup_name,cfg[setup_name])
-        loaded_cfg[setup_name] = cfg[setup_name]
-    cfg = MergeMainframes_config(loaded_cfg)
-    return cfg
+## Typed model of a setup. Optional keys get their defaults here, so that two setups omitting a key or setting it to its default are equal.
+## The consumers (BaseMainframe, DeviceLogger, ...) get plain dicts from to_dict
+class MainframeConfig(NamedTuple):
+    CAENHV_BOARD_TYPE: str
+    CAENHV_LINK_TYPE: str
+    CAENHV_BOARD_ADDRESS: str
+    CAENHV_USER: str
+    CAENHV_PASSWORD: str
+    BACKEND: str = "pycaenhv"
+    SIMULATION: Optional[dict] = None
+    METADATA_CACHE: Union[bool,str] = True
+    RETRY_BASE_DELAY: float = 1.
+    RETRY_MAX_DELAY: float = 60.
+    CIRCUIT_MAX_FAILURES: int = 3
+    MAX_CALLS_PER_SECOND: Optional[float] = None
+    ACQUISITION: str = "polling"
+    EVENT_PORT: Optional[int] = None
+
+class BoardConfig(NamedTuple):
+    SLOT: int
+    LAYER: Optional[int] = None
+    CHANNELS: Optional[list] = None
+
+class InfluxDBConfig(NamedTuple):
+    DB_BUCKET: str
+    ORG: str
+    TOKEN: str
+    URL: str
+    BATCH_SIZE: int = 500
+    FLUSH_INTERVAL: float = 1.
+    SPOOL_DIR: Union[bool,str,None] = None
+    SPOOL_MAX_MB: float = 256
+    REPLAY_RATE: float = 5000
+    PRECISION: str = "ns"
+
+class SetupConfig(NamedTuple):
+    MAINFRAME: MainframeConfig
+    BOARD: BoardConfig
+    influxDB: InfluxDBConfig
+    Monitorables: list
+    isGEMDetector: bool
+    HoldOffTime: float
+    Deadbands: Optional[dict] = None
+    KeepAliveTime: float = 300
+    AdaptivePolling: Optional[dict] = None
+    History: Optional[dict] = None
+    Alarms: Optional[dict] = None
+
+def _allowed_types(annotation):
+    ## Optional[x]/Union[x,y] -> their members. Integers are valid floats
+    types = []
+    for member in getattr(annotation,"__args__",None) or (annotation,):
+        types += [int,float] if member is float else [member]
+    return tuple(types)
+
+def _build(model,block,where):
+    ## model instance from a yaml block: checks required, unknown keys and value types
+    if not isinstance(block,dict):
+        raise ValueError(f"Expected a mapping for {where}, found {block!r}")
+    unknown = [ key for key in block if key not in model._fields ]
+    if unknown:
+        raise ValueError(f"Unknown keys {unknown} in {where}. Valid keys are {list(model._fields)}")
+    missing = [ key for key in model._fields if key not in block and key not in model._field_defaults ]
+    if missing:
+        raise ValueError(f"Expected keys {missing} not found in {where}")
+    for key,value in block.items():
+        types = _allowed_types(model.__annotations__[key])
+        if not isinstance(value,types) or (isinstance(value,bool) and bool not in types): ## bool is an int subclass
+            raise ValueError(f"Invalid value {value!r} for {where}.{key}: expected {model.__annotations__[key]}")
+    return model(**block)
+
+def check_config(setup_name,cfg):
+    ## returns the validated SetupConfig of a setup, raises ValueError
+    logging.debug(f"Checking config file for {setup_name}")
+    if not isinstance(cfg,dict):
+        raise ValueError(f"Setup {setup_name} is not a mapping")
+    blocks = { key:_build(model,cfg.get(key),f"{setup_name}.{key}") for key,model in (("MAINFRAME",MainframeConfig),("BOARD",BoardConfig),("influxDB",InfluxDBConfig)) if key in cfg }
+    setup = _build(SetupConfig,{**cfg,**blocks},setup_name)
+
+    # Handle case of GEM Detector
+    if setup.isGEMDetector and setup.BOARD.LAYER not in (1,2):
+        raise ValueError(f"{setup_name}.BOARD: GEM detectors need LAYER 1 or 2, found {setup.BOARD.LAYER}")
+    if not setup.isGEMDetector and not setup.BOARD.CHANNELS:
+        raise ValueError(f"{setup_name}.BOARD: expected key CHANNELS")
+    if not all( isinstance(quantity,str) for quantity in setup.Monitorables ):
+        raise ValueError(f"{setup_name}.Monitorables: expected a list of parameter names")
+    if setup.Alarms is not None:
+        try:
+            parse_alarms(setup.Alarms,setup.Monitorables)
+        except ValueError as e:
+            raise ValueError(f"{setup_name}.{e}") from None
+    if setup.influxDB.PRECISION not in PRECISIONS:
+        raise ValueError(f"{setup_name}.influxDB.PRECISION: expected one of {list(PRECISIONS)}, found {setup.influxDB.PRECISION}")
+    if setup.MAINFRAME.ACQUISITION not in ("polling","events"):
+        raise ValueError(f"{setup_name}.MAINFRAME.ACQUISITION: expected polling or events, found {setup.MAINFRAME.ACQUISITION}")
+    logging.debug(f"Config file for {setup_name} is ok")
+    return setup
+
+def to_dict(model):
+    ## plain dict of a model, recursively. Unset optional keys (None) are left out
+    return { key:(to_dict(value) if hasattr(value,"_fields") else value) for key,value in model._asdict().items() if value is not None }
+
+def parse_config(setup_names,path=CONFIG_PATH):
+    ## reads the config file once. Returns {setup_name: SetupConfig}
+    with pathlib.Path(path).open() as ymlfile:
+        cfg = yaml.safe_load(ymlfile) or {}
+    missing = [ setup_name for setup_name in setup_names if setup_name not in cfg ]
+    if missing:
+        raise ValueError(f"Setups {missing} not found in {path}")
+    return { setup_name:check_config(setup_name,cfg[setup_name]) for setup_name in setup_names }
+
+def load_config(setup_names,path=CONFIG_PATH):
+    return MergeMainframes_config(parse_config(setup_names,path))
 
 
 ## Group setups by mainframes IP
-## output cfg:  {<IP> : dict( 
-##                           configs: dict( <setup_name>: <config>), 
+## output cfg:  {<IP> : dict(
+##                           configs: dict( <setup_name>: <config>),
 ##                           mainframe:<cfg_mainframe>
 ##                           )
 ##              }
-def MergeMainframes_config(cfg):
-    mainframe2setupnames,mainframe_configs = {},{}
+def MergeMainframes_config(setups):
     output_dict = {}
-    for setup_name in cfg: 
-        ip_mainframe = cfg[setup_name]["MAINFRAME"]["CAENHV_BOARD_ADDRESS"]
-        mainframe2setupnames.setdefault(ip_mainframe,[])
-        mainframe2setupnames[ip_mainframe].append(setup_name)
-
-    for ip in mainframe2setupnames.keys():
+    for setup_name,setup in setups.items():
+        ip_mainframe = setup.MAINFRAME.CAENHV_BOARD_ADDRESS
+        if ip_mainframe not in output_dict:
+            output_dict[ip_mainframe] = {"MAINFRAME":setup.MAINFRAME,"configs":{}}
         ## Ensure all MAINFRAME config realted to the same ip are identical
-        s = [ DeepDiff(cfg[current_setup]["MAINFRAME"], cfg[x]["MAINFRAME"], verbose_level=2) == {} for current_setup in mainframe2setupnames[ip] for x in mainframe2setupnames[ip] ]
-        if not all(s):
-            logging.error(f"Setups related to ip {ip} do not share the same config for the key MAINFRAME. Check the config file.")
+        elif output_dict[ip_mainframe]["MAINFRAME"] != setup.MAINFRAME:
+            logging.error(f"Setups related to ip {ip_mainframe} do not share the same config for the key MAINFRAME. Check the config file.")
             raise ValueError(f"Config file error")
-
-        output_dict.setdefault(ip,{"MAINFRAME":None,"configs":{}})
-        output_dict[ip]["MAINFRAME"] = cfg[mainframe2setupnames[ip][0]]["MAINFRAME"]
-        for setup_name in mainframe2setupnames[ip]: 
-            del cfg[setup_name]["MAINFRAME"]
-            output_dict[ip]["configs"][setup_name] = cfg[setup_name]
-          
+        output_dict[ip_mainframe]["configs"][setup_name] = { key:value for key,value in to_dict(setup).items() if key != "MAINFRAME" }
+    for ip in output_dict:
+        output_dict[ip]["MAINFRAME"] = to_dict(output_dict[ip]["MAINFRAME"])
     logging.info(f"Merged configuration based on mainframes IPs")
     return output_dict
 
-def check_config(setup_name,cfg):
-    ## Required keys  
-    CFG_REQ_KEYS = ["MAINFRAME","BOARD","influxDB","Monitorables","isGEMDetector","HoldOffTime"] 
-    MAINFRAME_REQ_KEYS = ["CAENHV_BOARD_TYPE","CAENHV_LINK_TYPE","CAENHV_BOARD_ADDRESS","CAENHV_USER","CAENHV_PASSWORD"]
-    BOARD_REQ_KEYS = ["SLOT"]
-    DB_REQ_KEYS = ["DB_BUCKET","ORG","URL","TOKEN"]
-    
-    # Handle case of GEM Detector 
-    if cfg["isGEMDetector"]: BOARD_REQ_KEYS.append("LAYER")
-    else: BOARD_REQ_KEYS.append("CHANNELS")
-
-    ## Check cfg_file,MAINFRAME,BOARD and influxDB req keys
-    logging.debug(f"Checking config file for {setup_name}")
-    for config_key,item in {"":(cfg,CFG_REQ_KEYS),"BOARD":(cfg["BOARD"],BOARD_REQ_KEYS),"MAINFRAME":(cfg["MAINFRAME"],MAINFRAME_REQ_KEYS),"influxDB":(cfg["influxDB"],DB_REQ_KEYS)}.items():
-        cfg_found,required = item
-        for key in required:
-            try:
-                cfg_found[key]
-            except:
-                raise ValueError("Expected key \'",key," not found in ",cfg_found.keys())
-
-        if config_key != "": logging.debug(f"\tconfig[{setup_name}][{config_key}] has all the keys")
-    logging.debug(f"Config file for {setup_name} is ok")
+
+class ConfigDiff(NamedTuple):
+    """ Changes between two outputs of load_config """
+    added: list ## mainframes to start
+    removed: list ## mainframes to stop
+    restarted: list ## mainframes whose MAINFRAME block changed: new session needed
+    devices: dict ## ip -> {setup_name: new config or None if removed}, for the mainframes that keep their session
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.restarted or self.devices)
+
+def diff_configs(old,new):
+    added = [ ip for ip in new if ip not in old ]
+    removed = [ ip for ip in old if ip not in new ]
+    restarted = [ ip for ip in new if ip in old and new[ip]["MAINFRAME"] != old[ip]["MAINFRAME"] ]
+    devices = {}
+    for ip in new:
+        if ip not in old or ip in restarted: continue
+        old_configs,new_configs = old[ip]["configs"],new[ip]["configs"]
+        changes = { name:config for name,config in new_configs.items() if old_configs.get(name) != config }
+        changes.update({ name:None for name in old_configs if name not in new_configs })
+        if changes: devices[ip] = changes
+    return ConfigDiff(added,removed,restarted,devices)
+
+
+class ConfigWatcher:
+    """ Tells whether the config file changed since the last check """
+    def __init__(self,path=CONFIG_PATH):
+        self.path = pathlib.Path(path)
+        self._stamp = self._stat()
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+            return stat.st_mtime_ns,stat.st_size
+        except FileNotFoundError:
+            return None
+
+    def changed(self):
+        stamp = self._stat()
+        if stamp == self._stamp: return False
+        self._stamp = stamp
+        return True
 
 if __name__ == '__main__':
     pass
@@ -0,0 +1,155 @@
+import time
+from prompt_logger import logger as logging
+from backends import BackendError, SubscriptionNotSupported
+import metrics
+from sample import Sample
+
+class EventAcquisition:
+    """ Event-driven acquisition of the devices of one mainframe (ACQUISITION: events in the MAINFRAME config).
+        The board quantities of each device are subscribed: the changes pushed by the mainframe update the latest arrays of the device,
+        that are then processed (change detection, DB) as a poll would be.
+        A device is read in full (resync) after the subscription, i.e. at start and after a communication error, and when no event
+        arrived for its period (HoldOffTime), so that keep-alive pushes happen and missed events get corrected.
+        run() raises SubscriptionNotSupported if the mainframe can't push events: the caller falls back to polling.
+    """
+    def __init__(self,lock,terminateEvent,mainframe,timeout=0.5,tick=None):
+        self.lock = lock
+        self.terminateEvent = terminateEvent
+        self.mainframe = mainframe
+        self.timeout = timeout ## max wait for events, terminateEvent is checked in between
+        self.tick = tick ## called at every iteration of the loop, as by PollScheduler
+        self.devices = {} ## device_name -> DeviceLogger
+        self.arrays = {} ## device_name -> {board quantity: np.array of the latest values}
+        self.samples = {} ## device_name -> Sample the latest arrays are derived into, reused by every process
+        self._last_update = {} ## device_name -> time.monotonic() of the last resync or event
+        self._index = {} ## (slot,channel) -> [(device_name,position of the channel in the arrays)]
+        self._subscribed = False
+        self._stale = [] ## devices to be read in full
+        self.n_events = 0
+        self.label = mainframe.cfg["CAENHV_BOARD_ADDRESS"]
+
+    def _build_index(self):
+        self._index = {}
+        for device_name,device in self.devices.items():
+            for position,ch in enumerate(device.board._channels):
+                self._index.setdefault((device.board.board_slot,ch),[]).append((device_name,position))
+
+    def add_device(self,device_name,device):
+        ## devices added while running (reconfiguration) are subscribed and read in full straight away
+        self.devices[device_name] = device
+        self._build_index()
+        if self._subscribed:
+            try:
+                with self.lock:
+                    self.mainframe.backend.subscribe_channel_parameters(self.mainframe.handle,device.board.board_slot,device.board._channels,self._hw_quantities(device))
+                self._stale.append(device_name)
+            except BackendError as e:
+                logging.warning(f"Mainframe {self.label}: subscribe of {device_name} failed ({e})")
+                self._subscribed = False ## everything is subscribed again at the next iteration
+
+    def remove_device(self,device_name):
+        device = self.devices.pop(device_name,None)
+        if device is None: return None
+        self._build_index()
+        self.arrays.pop(device_name,None)
+        self.samples.pop(device_name,None)
+        self._last_update.pop(device_name,None)
+        if device_name in self._stale: self._stale.remove(device_name)
+        ## parameters still used by another device of the same channels stay subscribed
+        in_use = { (device.board.board_slot,ch,quantity) for other in self.devices.values() for ch in other.board._channels for quantity in self._hw_quantities(other) if other.board.board_slot == device.board.board_slot }
+        if self._subscribed:
+            try:
+                with self.lock:
+                    for quantity in self._hw_quantities(device):
+                        channels = [ ch for ch in device.board._channels if (device.board.board_slot,ch,quantity) not in in_use ]
+                        if channels: self.mainframe.backend.unsubscribe_channel_parameters(self.mainframe.handle,device.board.board_slot,channels,[quantity])
+            except BackendError as e:
+                logging.warning(f"Mainframe {self.label}: unsubscribe of {device_name} failed ({e})")
+        return device
+
+    def _hw_quantities(self,device):
+        return device.board.hw_quantities(device.cfg["Monitorables"])
+
+    def subscribe(self):
+        ## to be called holding the mainframe lock
+        for device in self.devices.values():
+            self.mainframe.backend.subscribe_channel_parameters(self.mainframe.handle,device.board.board_slot,device.board._channels,self._hw_quantities(device))
+        self._subscribed = True
+        logging.info(f"Mainframe {self.label}: subscribed {len(self.devices)} devices")
+
+    def unsubscribe(self):
+        ## to be called holding the mainframe lock
+        if not self._subscribed or self.mainframe.handle is None: return
+        try:
+            for device in self.devices.values():
+                self.mainframe.backend.unsubscribe_channel_parameters(self.mainframe.handle,device.board.board_slot,device.board._channels,self._hw_quantities(device))
+        except BackendError as e: ## the session is closed next anyway
+            logging.warning(f"Mainframe {self.label}: unsubscribe failed ({e})")
+        self._subscribed = False
+
+    def resync(self,device_names):
+        timestamps = {}
+        with self.lock:
+            for device_name in device_names:
+                device = self.devices[device_name]
+                device.board.handle = self.mainframe.handle ## changes after a re-login
+                self.arrays[device_name] = device.board.monitor_arrays(self._hw_quantities(device))
+                if device_name not in self.samples: self.samples[device_name] = Sample(device.board.sample_schema(device.cfg["Monitorables"]))
+                timestamps[device_name] = time.time()
+                device.n_polls += 1
+        for device_name,timestamp in timestamps.items():
+            self.process(device_name,timestamp)
+
+    def apply(self,events):
+        ## writes the events into the latest arrays. Returns the names of the updated devices
+        updated = set()
+        for slot,channel,param_name,value in events:
+            for device_name,position in self._index.get((slot,channel),()):
+                arrays = self.arrays.get(device_name)
+                if arrays is None or param_name not in arrays: continue
+                arrays[param_name][position] = value
+                updated.add(device_name)
+        self.n_events += len(events)
+        if events: metrics.inc("gemcaen_events_total",len(events),help_text="Parameter change events received",mainframe=self.label)
+        return updated
+
+    def process(self,device_name,timestamp):
+        ## same sample as a poll: derived quantities computed from the latest arrays, copied into the buffer of the device
+        device = self.devices[device_name]
+        self._last_update[device_name] = time.monotonic()
+        sample = device.board.derive(self.arrays[device_name],self.samples[device_name])
+        sample.timestamp = timestamp
+        device.process(sample)
+
+    def run(self):
+        try:
+            while not self.terminateEvent.is_set():
+                if self.tick is not None: self.tick()
+                breaker = self.mainframe.breaker
+                if not breaker.allow(): ## backoff, without holding the lock
+                    self.terminateEvent.wait(min(breaker.time_to_retry(),0.5))
+                    continue
+                try:
+                    if not self._subscribed:
+                        with self.lock:
+                            if breaker.failures: self.mainframe.reconnect()
+                            self.subscribe()
+                        self._stale = list(self.devices)
+                    now = time.monotonic()
+                    self._stale += [ device_name for device_name,device in self.devices.items() if device_name not in self._stale and now - self._last_update.get(device_name,0.) >= device.period ]
+                    if self._stale:
+                        self.resync(self._stale)
+                        self._stale = []
+                    events = self.mainframe.backend.get_events(self.mainframe.handle,self.timeout)
+                    timestamp = time.time()
+                    for device_name in self.apply(events):
+                        self.process(device_name,timestamp)
+                    breaker.record_success()
+                except SubscriptionNotSupported:
+                    raise
+                except BackendError as e:
+                    breaker.record_failure(e)
+                    self._subscribed = False ## resubscribe (and re-login) at the next attempt
+        finally:
+            with self.lock:
+                self.unsubscribe()
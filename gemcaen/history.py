@@ -0,0 +1,165 @@
+import json
+import pathlib
+import re
+import time
+import argparse
+import numpy as np
+from argparse import RawTextHelpFormatter
+
+HISTORY_PATH = pathlib.Path(__file__).parent / "history"
+
+## Local history of the samples of each device, in memory mapped columnar segments: <directory>/<device>/<first timestamp ms>.npy
+## Segment: float64 array [1 + quantities*channels, rows]: column 0 is the timestamp, then <quantity 0 channels>, <quantity 1 channels>, ...
+## Each column is contiguous on disk, so a query reads only the time index and the columns it asks for.
+## Rows not written yet have a NaN timestamp (NaN sorts last for np.searchsorted): no row counter to keep in sync, a segment
+## left by a crash is valid up to its last complete row. The layout of the segment (channels, quantities) is in <first timestamp ms>.json
+
+def device_directory(directory,device_name):
+    return pathlib.Path(directory) / re.sub(r"[^\w.-]","_",device_name)
+
+def _n_rows(times):
+    ## written rows: the timestamps are increasing, the rest is NaN
+    return int(np.searchsorted(times,np.inf,side="right"))
+
+
+class HistoryWriter:
+    """ Appends the samples of a device (as published to the snapshot) to its segments.
+        A new segment is started every segment_rows samples, at every start and when the clock goes back, the oldest are deleted
+        beyond max_segments
+    """
+    def __init__(self,directory,device_name,channels,quantities,segment_rows=100000,max_segments=20):
+        self.directory = device_directory(directory,device_name)
+        self.directory.mkdir(parents=True,exist_ok=True)
+        self.channels = list(channels)
+        self.quantities = list(quantities)
+        self.segment_rows = segment_rows
+        self.max_segments = max_segments
+        self.segment = None ## memmap of the current segment
+        self._row = 0
+        self._last_timestamp = -np.inf
+
+    def _open_segment(self,timestamp):
+        self.close()
+        stamp = int(timestamp*1e3)
+        while (self.directory / f"{stamp}.npy").exists(): stamp += 1
+        (self.directory / f"{stamp}.json").write_text(json.dumps({"channels":self.channels,"quantities":self.quantities}))
+        self.segment = np.lib.format.open_memmap(self.directory / f"{stamp}.npy",mode="w+",dtype=np.float64,
+                                                 shape=(1 + len(self.quantities)*len(self.channels),self.segment_rows))
+        self.segment[0] = np.nan ## only the time index is initialized, the value columns stay sparse till written
+        self._row = 0
+        for old in segments(self.directory)[:-self.max_segments]:
+            old.unlink()
+            old.with_suffix(".json").unlink(missing_ok=True)
+
+    def append(self,monitored_arrays,timestamp):
+        if self.segment is None or self._row == self.segment_rows or timestamp <= self._last_timestamp:
+            self._open_segment(timestamp)
+        n_channels = len(self.channels)
+        for index,quantity in enumerate(self.quantities):
+            values = monitored_arrays.get(quantity)
+            self.segment[1 + index*n_channels:1 + (index + 1)*n_channels,self._row] = values if values is not None and len(values) == n_channels else np.nan
+        self.segment[0,self._row] = timestamp ## last: the row is complete for the readers
+        self._row += 1
+        self._last_timestamp = timestamp
+
+    def close(self):
+        if self.segment is None: return
+        self.segment.flush()
+        self.segment = None
+
+
+def segments(directory):
+    ## segment files of a device directory, oldest first
+    return sorted(pathlib.Path(directory).glob("*.npy"),key=lambda path: int(path.stem))
+
+
+class HistoryReader:
+    """ Time range and downsampled queries on the segments of a device, also while they are being written.
+        Only the time index of the segments and the requested columns are read.
+        Results are {quantity: np.array [samples or buckets, channels]}, channels as in self.channels (the latest layout).
+        Quantities or channels missing from an older segment read as NaN
+    """
+    def __init__(self,directory,device_name):
+        self.directory = device_directory(directory,device_name)
+        if not self.directory.is_dir():
+            raise ValueError(f"No history for {device_name} in {directory}")
+        paths = segments(self.directory)
+        layout = self._layout(paths[-1]) if paths else {"channels":[],"quantities":[]}
+        self.channels = layout["channels"]
+        self.quantities = layout["quantities"]
+
+    def _layout(self,path):
+        return json.loads(path.with_suffix(".json").read_text())
+
+    def _slices(self,start,stop,quantities,channels):
+        ## yields times,{quantity: [rows,channels]} of each segment overlapping [start,stop)
+        for path in segments(self.directory):
+            if int(path.stem)/1e3 >= stop: break
+            segment = np.load(path,mmap_mode="r")
+            layout = self._layout(path)
+            times = segment[0,:_n_rows(segment[0])]
+            first,last = np.searchsorted(times,start,side="left"),np.searchsorted(times,stop,side="left")
+            if first == last: continue
+            n_channels = len(layout["channels"])
+            positions = [ layout["channels"].index(ch) if ch in layout["channels"] else None for ch in channels ]
+            arrays = {}
+            for quantity in quantities:
+                values = np.full((last - first,len(channels)),np.nan)
+                if quantity in layout["quantities"]:
+                    column = 1 + layout["quantities"].index(quantity)*n_channels
+                    for i,position in enumerate(positions):
+                        if position is not None: values[:,i] = segment[column + position,first:last]
+                arrays[quantity] = values
+            yield np.array(times[first:last]),arrays
+
+    def query(self,start,stop,quantities=None,channels=None):
+        ## samples with start <= timestamp < stop. Returns times,{quantity: np.array [samples,channels]}
+        quantities = list(quantities or self.quantities)
+        channels = list(channels or self.channels)
+        parts = list(self._slices(start,stop,quantities,channels))
+        if not parts:
+            return np.empty(0),{ quantity:np.empty((0,len(channels))) for quantity in quantities }
+        times = np.concatenate([ times for times,_ in parts ])
+        order = np.argsort(times,kind="stable") ## segments overlap only if the clock went back
+        return times[order],{ quantity:np.concatenate([ arrays[quantity] for _,arrays in parts ])[order] for quantity in quantities }
+
+    def downsample(self,start,stop,bucket,quantities=None,channels=None):
+        ## min, max and mean per bucket of bucket seconds, from start. Empty buckets are left out, failed reads (NaN) ignored.
+        ## Returns bucket start times,{quantity: {"min","max","mean": np.array [buckets,channels]}}
+        times,arrays = self.query(start,stop,quantities,channels)
+        bucket_ids = np.floor((times - start)/bucket).astype(np.int64)
+        bounds = np.concatenate(([0],np.flatnonzero(np.diff(bucket_ids)) + 1)) if len(times) else np.empty(0,dtype=np.int64)
+        result = {}
+        for quantity,values in arrays.items():
+            if not len(times):
+                result[quantity] = { stat:values for stat in ("min","max","mean") }
+                continue
+            valid = ~np.isnan(values)
+            with np.errstate(invalid="ignore"): ## all NaN buckets
+                mean = np.add.reduceat(np.where(valid,values,0.),bounds)/np.add.reduceat(valid,bounds)
+            result[quantity] = {"min":np.fmin.reduceat(values,bounds),"max":np.fmax.reduceat(values,bounds),"mean":mean}
+        return start + bucket_ids[bounds]*bucket,result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='''Prints the local history of a device, downsampled''',
+        epilog="""Typical exectuion\n\t python history.py ME0_0001_CERN --last 3600 --bucket 60 --quantities VMon IMon""",
+        formatter_class=RawTextHelpFormatter
+    )
+    parser.add_argument("device", type=str, help="Setup name, as in the config file")
+    parser.add_argument("--path", type=str, default=str(HISTORY_PATH), help="History directory (History: Path in the config file)")
+    parser.add_argument("--last", type=float, default=3600., help="Seconds of history to be shown")
+    parser.add_argument("--bucket", type=float, default=60., help="Seconds per line")
+    parser.add_argument("--quantities", type=str, nargs="*", default=None, help="Quantities to be shown. Default all")
+    parser.add_argument("--channels", type=int, nargs="*", default=None, help="Channels to be shown. Default all")
+    args = parser.parse_args()
+
+    reader = HistoryReader(args.path,args.device)
+    now = time.time()
+    starts,stats = reader.downsample(now - args.last,now,args.bucket,args.quantities,args.channels)
+    channels = args.channels or reader.channels
+    for quantity,values in stats.items():
+        print(f"{quantity} min/mean/max, channels {channels}")
+        for index,bucket_start in enumerate(starts):
+            print(time.strftime("%Y-%m-%d %H:%M:%S",time.localtime(bucket_start)),"  ".join( f"{values['min'][index,i]:.4g}/{values['mean'][index,i]:.4g}/{values['max'][index,i]:.4g}" for i in range(len(channels)) ))
@@ -0,0 +1,246 @@
+import threading
+import atexit
+import time
+import pathlib
+import re
+import influxdb_client
+from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client.rest import ApiException
+from prompt_logger import logger as logging
+from spool import Spool
+import metrics
+
+SPOOL_PATH = pathlib.Path(__file__).parent / "spool"
+
+## One writer per influxDB instance (URL,ORG,TOKEN) and timestamp PRECISION, shared by all the devices of the process
+_writers = {}
+_writers_lock = threading.Lock()
+
+def _key(cfg_influxDB):
+    return (cfg_influxDB["URL"],cfg_influxDB["ORG"],cfg_influxDB["TOKEN"],cfg_influxDB.get("PRECISION","ns"))
+
+def get_writer(cfg_influxDB):
+    key = _key(cfg_influxDB)
+    with _writers_lock:
+        if key not in _writers:
+            ## points that can't be written are spooled on disk (SPOOL_DIR, one subfolder per URL, ORG and precision other than ns)
+            ## unless SPOOL_DIR is False: spooled lines are replayed with the precision they were serialized with
+            precision = cfg_influxDB.get("PRECISION","ns")
+            spool_dir = cfg_influxDB.get("SPOOL_DIR",SPOOL_PATH)
+            if spool_dir is True: spool_dir = SPOOL_PATH ## enabled, default folder
+            spool_name = f"{cfg_influxDB['URL']}_{cfg_influxDB['ORG']}" + ("" if precision == "ns" else f"_{precision}")
+            if spool_dir is False: spool = None
+            else: spool = Spool(pathlib.Path(spool_dir) / re.sub(r"[^\w.-]","_",spool_name), max_bytes = cfg_influxDB.get("SPOOL_MAX_MB",256)*1024**2)
+            _writers[key] = BatchingWriter(cfg_influxDB["URL"],cfg_influxDB["TOKEN"],cfg_influxDB["ORG"],
+                                           precision = precision,
+                                           batch_size = cfg_influxDB.get("BATCH_SIZE",500),
+                                           flush_interval = cfg_influxDB.get("FLUSH_INTERVAL",1.0),
+                                           spool = spool,
+                                           replay_rate = cfg_influxDB.get("REPLAY_RATE",5000))
+            _writers[key].start()
+        return _writers[key]
+
+def set_writer(cfg_influxDB,writer):
+    ## use a custom writer for the given influxDB (i.e. benchmarks)
+    with _writers_lock:
+        _writers[_key(cfg_influxDB)] = writer
+
+@atexit.register
+def close_writers():
+    with _writers_lock:
+        for writer in _writers.values():
+            writer.close()
+        _writers.clear()
+
+
+class BatchingWriter:
+    """ Collects points (line-protocol records or influxdb_client.Point) and writes them to influxDB in batches from a background thread.
+        The integer timestamps of the records are in precision (s, ms, us or ns).
+        If a spool is given, the points that can't be written are spooled and replayed, rate-limited, when the DB is back
+    """
+    def __init__(self,url,token,org,precision="ns",batch_size=500,flush_interval=1.0,max_queue=100000,spool=None,replay_rate=5000,retry_interval=10.,timeout=10.):
+        self.url = url
+        self.token = token
+        self.org = org
+        self.precision = precision
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval ## max age (s) of a queued point before it gets flushed
+        self.max_queue = max_queue
+        self.spool = spool
+        self.replay_rate = replay_rate ## points/s replayed from the spool
+        self.retry_interval = retry_interval ## seconds after a failed write during which points go straight to the spool
+        self.timeout = timeout ## seconds, HTTP timeout of the writes
+        self._db_down_until = 0.
+        self._replay_budget = 0.
+        self._last_replay = time.time()
+        self._pending = [] ## [(bucket,record,enqueue_time,sample_time)]
+        self._condition = threading.Condition()
+        self._closing = False
+        self._thread = threading.Thread(target=self._run,name=f"InfluxWriter_{url}",daemon=True)
+        self._client = None
+        self._write_api = None
+        ## statistics
+        self.n_written = 0
+        self.n_failed = 0
+        self.n_dropped = 0
+        self.n_spooled = 0
+        self.n_replayed = 0
+        self.last_flush_latency = 0.
+        self.max_flush_latency = 0.
+        self.last_sample_latency = 0. ## from acquisition to written, oldest point of the last batch
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        with self._condition:
+            self._closing = True
+            self._condition.notify()
+        if self._thread.is_alive(): self._thread.join()
+        if self._client is not None: self._client.close()
+
+    def write(self,bucket,records,sample_time=None):
+        now = time.time()
+        if sample_time is None: sample_time = now
+        with self._condition:
+            self._pending.extend( (bucket,record,now,sample_time) for record in records )
+            if len(self._pending) > self.max_queue:
+                n_drop = len(self._pending) - self.max_queue
+                del self._pending[:n_drop]
+                self.n_dropped += n_drop
+                logging.warning(f"influxDB queue full, dropped the {n_drop} oldest points")
+            if len(self._pending) >= self.batch_size:
+                self._condition.notify()
+
+    @property
+    def queue_depth(self):
+        return len(self._pending)
+
+    def stats(self):
+        return {"queue_depth":self.queue_depth,
+                "written":self.n_written,
+                "failed":self.n_failed,
+                "dropped":self.n_dropped,
+                "last_flush_latency":self.last_flush_latency,
+                "max_flush_latency":self.max_flush_latency,
+                "last_sample_latency":self.last_sample_latency,
+                "spooled":self.n_spooled,
+                "replayed":self.n_replayed,
+                "spool_pending_bytes":self.spool.pending_bytes if self.spool is not None else 0}
+
+    def _next_batch(self,wait_limit=None):
+        ## Blocks till a batch is ready: batch_size points queued, oldest point older than flush_interval or closing.
+        ## Returns None when closing and empty, an empty batch after wait_limit seconds
+        deadline = time.time() + wait_limit if wait_limit is not None else None
+        with self._condition:
+            while True:
+                if self._pending and (self._closing or len(self._pending) >= self.batch_size or time.time() - self._pending[0][2] >= self.flush_interval):
+                    batch = self._pending[:self.batch_size]
+                    del self._pending[:self.batch_size]
+                    return batch
+                if self._closing:
+                    return None
+                if deadline is not None and time.time() >= deadline:
+                    return []
+                timeout = self.flush_interval - (time.time() - self._pending[0][2]) if self._pending else self.flush_interval
+                if deadline is not None: timeout = min(timeout,deadline - time.time())
+                self._condition.wait(max(timeout,0.))
+
+    def _send(self,bucket,records):
+        if self._write_api is None:
+            self._client = influxdb_client.InfluxDBClient(url=self.url,token=self.token,org=self.org,timeout=int(self.timeout*1e3))
+            self._write_api = self._client.write_api(write_options=SYNCHRONOUS)
+        self._write_api.write(bucket=bucket,org=self.org,record=records,write_precision=self.precision)
+
+    @staticmethod
+    def _rejected(error):
+        ## influxDB refused the points (i.e. field type conflict, malformed line): sending them again won't help.
+        ## Connection errors, timeouts, 429 (rate limit) and 5xx mean the DB is down
+        return isinstance(error,ApiException) and error.status is not None and 400 <= error.status < 500 and error.status != 429
+
+    def _write(self,bucket,records):
+        ## writes records, dropping the ones influxDB rejects (the chunk is bisected to find them). Returns the number of dropped records.
+        ## Raises the errors of a DB down
+        try:
+            self._send(bucket,records)
+            return 0
+        except Exception as e:
+            if not self._rejected(e): raise
+            if len(records) == 1:
+                line = records[0].to_line_protocol() if hasattr(records[0],"to_line_protocol") else records[0]
+                logging.error(f"influxDB {self.url}/{bucket} rejected the point {line!r} ({e.status} {e.body or e.reason}). Dropping it")
+                self.n_dropped += 1
+                metrics.inc("gemcaen_db_rejected_points_total",help_text="Points rejected by influxDB (4xx), dropped",url=self.url)
+                return 1
+        half = len(records)//2
+        return self._write(bucket,records[:half]) + self._write(bucket,records[half:])
+
+    def flush(self,batch):
+        by_bucket = {}
+        for bucket,record,_,_ in batch:
+            by_bucket.setdefault(bucket,[]).append(record)
+        start = time.time()
+        for bucket,records in by_bucket.items():
+            if self.spool is not None and start < self._db_down_until: ## don't wait for the timeout of a DB known to be down
+                self.spool_records(bucket,records)
+                continue
+            try:
+                self.n_written += len(records) - self._write(bucket,records)
+            except Exception as e:
+                self.n_failed += len(records)
+                metrics.inc("gemcaen_db_write_errors_total",len(records),help_text="Points that failed to be written to influxDB",url=self.url)
+                if self.spool is None:
+                    logging.warning(f"Exception {e} caught while writing {len(records)} points to {self.url}/{bucket}. Skipping")
+                else:
+                    logging.warning(f"Exception {e} caught while writing {len(records)} points to {self.url}/{bucket}. Spooling them, next attempt in {self.retry_interval} s")
+                    self._db_down_until = time.time() + self.retry_interval
+                    self.spool_records(bucket,records)
+        done = time.time()
+        self.last_flush_latency = done - start
+        self.last_sample_latency = done - min( sample_time for _,_,_,sample_time in batch )
+        self.max_flush_latency = max(self.max_flush_latency,self.last_flush_latency)
+        metrics.observe("gemcaen_db_flush_seconds",self.last_flush_latency,help_text="Time to write a batch to influxDB",url=self.url)
+        metrics.observe("gemcaen_sample_to_db_seconds",self.last_sample_latency,help_text="From acquisition to written, oldest point of each batch",url=self.url)
+        metrics.set_gauge("gemcaen_db_queue_depth",self.queue_depth,help_text="Points waiting to be written to influxDB",url=self.url)
+        logging.debug(f"Flushed {len(batch)} points in {self.last_flush_latency*1e3:.1f} ms, queue depth {self.queue_depth}")
+
+    def spool_records(self,bucket,records):
+        lines = [ record.to_line_protocol() if hasattr(record,"to_line_protocol") else record for record in records ]
+        try:
+            self.spool.append(bucket,lines)
+            self.n_spooled += len(lines)
+        except OSError as e:
+            logging.error(f"Exception {e} caught while spooling {len(lines)} points. Skipping")
+
+    def replay(self):
+        ## sends the oldest spooled points, at most replay_rate points/s
+        now = time.time()
+        self._replay_budget = min(self._replay_budget + (now - self._last_replay)*self.replay_rate, self.replay_rate)
+        self._last_replay = now
+        if now < self._db_down_until or self._replay_budget < 1 or not self.spool.pending_bytes: return
+        entries,cursor = self.spool.read(min(int(self._replay_budget),self.batch_size))
+        if not entries: return
+        by_bucket = {}
+        for bucket,line in entries:
+            by_bucket.setdefault(bucket,[]).append(line)
+        n_rejected = 0
+        try:
+            for bucket,lines in by_bucket.items():
+                n_rejected += self._write(bucket,lines)
+        except Exception as e:
+            logging.warning(f"Exception {e} caught while replaying spooled points. Next attempt in {self.retry_interval} s")
+            self._db_down_until = time.time() + self.retry_interval
+            return
+        ## points of a partially failed chunk may be written twice: influxDB overwrites identical points. Rejected points are not retried
+        self.spool.commit(cursor)
+        self._replay_budget -= len(entries)
+        self.n_replayed += len(entries) - n_rejected
+        logging.debug(f"Replayed {len(entries)} spooled points, {self.spool.pending_bytes} bytes left")
+
+    def _run(self):
+        while True:
+            replaying = self.spool is not None and self.spool.pending_bytes > 0
+            batch = self._next_batch(0.1 if replaying else None)
+            if batch is None: return
+            if batch: self.flush(batch)
+            if replaying: self.replay()
@@ -0,0 +1,66 @@
+import math
+
+## Serializes the changed fields of a poll to influxDB line protocol: one record per channel with all its fields, instead of
+## one influxdb_client.Point per field. The measurement and tag part of each record is escaped once per channel and cached.
+## Timestamps are the acquisition time, written as integers at PRECISION (the precision the writer declares to influxDB).
+
+PRECISIONS = {"s":1,"ms":10**3,"us":10**6,"ns":10**9}
+
+_ESCAPE_MEASUREMENT = str.maketrans({",":"\\,"," ":"\\ ","\n":"\\n","\r":"\\r","\t":"\\t"})
+_ESCAPE_KEY = str.maketrans({",":"\\,","=":"\\="," ":"\\ ","\n":"\\n","\r":"\\r","\t":"\\t"})
+_ESCAPE_STRING = str.maketrans({"\"":"\\\"","\\":"\\\\"})
+
+def escape_measurement(name):
+    return str(name).translate(_ESCAPE_MEASUREMENT)
+
+def escape_key(key):
+    ## tag keys, tag values and field keys
+    escaped = str(key).translate(_ESCAPE_KEY)
+    return escaped + " " if escaped.endswith("\\") else escaped
+
+def format_value(value):
+    ## field value as influxdb_client.Point writes it (same field types as before). None for values that are not written (None, NaN)
+    if value is None: return None
+    if isinstance(value,bool): return "true" if value else "false"
+    if isinstance(value,int): return f"{value}i"
+    if isinstance(value,float):
+        if not math.isfinite(value): return None
+        text = repr(value)
+        return text[:-2] if text.endswith(".0") else text
+    if isinstance(value,str): return f"\"{value.translate(_ESCAPE_STRING)}\""
+    raise ValueError(f"Type {type(value)} of field value {value} is not supported")
+
+class LineSerializer:
+    """ Builds the line-protocol records of a device: measurement,<tag_key>=<channel tag> <fields> <timestamp> """
+    def __init__(self,measurement,channel_tags,tag_key="ChannelName",precision="ns"):
+        if precision not in PRECISIONS:
+            raise ValueError(f"Invalid precision {precision}. Valid precisions are {list(PRECISIONS)}")
+        self.precision = precision
+        self._scale = PRECISIONS[precision]
+        self._prefixes = { ch:f"{escape_measurement(measurement)},{escape_key(tag_key)}={escape_key(tag)} " for ch,tag in channel_tags.items() }
+        self._layout = None ## (schema, record prefix per channel index, "<field key>=" per quantity index) of the last serialized sample
+
+    def timestamp(self,timestamp):
+        return int(round(timestamp*self._scale))
+
+    def _prepare(self,schema):
+        self._layout = (schema,[ self._prefixes[ch] for ch in schema.channels ],[ escape_key(quantity) + "=" for quantity in schema.quantities ])
+
+    def serialize(self,sample,mask=None):
+        ## one record per channel of sample with at least one field in mask [quantity,channel] (default all). Failed reads are skipped
+        if self._layout is None or self._layout[0] != sample.schema: self._prepare(sample.schema)
+        _,prefixes,keys = self._layout
+        integer = sample.schema.integer
+        suffix = f" {self.timestamp(sample.timestamp)}"
+        selected = mask.T.tolist() if mask is not None else None
+        lines = []
+        for channel_index,column in enumerate(sample.buffer.T.tolist()):
+            if selected is not None and not any(selected[channel_index]): continue
+            fields = []
+            for quantity_index,value in enumerate(column):
+                if selected is not None and not selected[channel_index][quantity_index]: continue
+                text = format_value(int(value) if integer[quantity_index] and value == value else value)
+                if text is not None: fields.append(keys[quantity_index] + text)
+            if fields:
+                lines.append(prefixes[channel_index] + ",".join(fields) + suffix)
+        return lines
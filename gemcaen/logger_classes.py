@@ -1,13 +1,22 @@
 from prompt_logger import logger as logging
-from caen_classes import BaseMainframe,BaseBoard,GemBoard
+from caen_classes import BaseMainframe,make_board
+from backends import BackendError, SubscriptionNotSupported
 from threading import Thread
 import threading
 import pathlib
 import time
 import json
-from deepdiff import DeepDiff
-import influxdb_client
-from influxdb_client.client.write_api import SYNCHRONOUS
+from change_detection import DeadbandFilter
+from adaptive_polling import AdaptiveRate
+from history import HistoryWriter, HISTORY_PATH
+from scheduler import PollScheduler
+from event_acquisition import EventAcquisition
+from influx_writer import get_writer
+from line_protocol import LineSerializer
+from sample import Sample
+from alarms import AlarmEngine, parse_alarms
+import metrics
+import status_server
 
 colors_mainframe = ["\033[1;46m","\033[1;42m","\033[1;43m", "\033[1;44m","\033[1;45m","\033[1;107m","\033[1;47m","\033[1;100m"]
 colors_taken_mainframe = [ 1 for k in range(len(colors_mainframe))]
@@ -25,50 +34,132 @@ def get_color(colors,book):
 
 
 class MainframeLogger(Thread):  
-    def __init__(self,mainframe_cfg,device_cfgs,terminateEvent):
+    def __init__(self,mainframe_cfg,device_cfgs,terminateEvent,snapshot=None):
         self.terminateEvent = terminateEvent
         super().__init__(args=(self.terminateEvent))
         self.mainframe_cfg = mainframe_cfg
         self.name = get_color(colors_mainframe,colors_taken_mainframe)+f"Mainframe_{self.mainframe_cfg['CAENHV_BOARD_ADDRESS']}_Thread" + "\033[1;0m"
         self.device_configs = device_cfgs
         self.lock = threading.Lock()
+        self.mainframe = None
         self.devices = {}
+        self.scheduler = None
+        self.acquisition = None ## EventAcquisition, with ACQUISITION: events
+        self.snapshot = snapshot ## SharedSnapshot where the latest samples are published, if any
+        self._pending_configs = None ## device configs given to reconfigure, applied by this thread
+        self._pending_lock = threading.Lock()
+
+    def reconfigure(self,device_cfgs,snapshot=None):
+        ## new device configs (same MAINFRAME block): applied between two passes, keeping the mainframe session.
+        ## snapshot: SharedSnapshot with the layout of the new configs, replacing the current one
+        with self._pending_lock:
+            self._pending_configs = (device_cfgs,snapshot)
+
+    def tick(self):
+        ## called by the scheduler (or the event acquisition) at every iteration of its loop
+        if self.snapshot is not None: self.snapshot.beat()
+        with self._pending_lock:
+            pending,self._pending_configs = self._pending_configs,None
+        if pending is not None: self.apply_configs(*pending)
+
+    def start_device(self,device_name,device_cfg):
+        device = DeviceLogger(device_name,device_cfg,self.mainframe,self.snapshot,self.lock)
+        try:
+            with self.lock:
+                device.init_board()
+        except Exception as e:
+            logging.error(f"{device_name}: exception {e} caught while initializing the board. Not logging it")
+            return None
+        self.devices[device_name] = device
+        self.scheduler.add_device(device_name,device)
+        if self.acquisition is not None: self.acquisition.add_device(device_name,device)
+        logging.debug(f"{device_name} logging started")
+        return device
+
+    def stop_device(self,device_name):
+        self.scheduler.remove_device(device_name)
+        if self.acquisition is not None: self.acquisition.remove_device(device_name)
+        device = self.devices.pop(device_name,None)
+        if device is not None: device.close()
+        return device
+
+    def apply_configs(self,device_cfgs,snapshot=None):
+        ## restarts only the devices whose config changed
+        previous_snapshot = self.snapshot
+        if snapshot is not None:
+            self.snapshot = snapshot
+            for device in self.devices.values(): device.snapshot = snapshot
+        changed = [ name for name in self.device_configs if device_cfgs.get(name) != self.device_configs[name] ]
+        for device_name in changed:
+            self.stop_device(device_name)
+        started = [ name for name,device_cfg in device_cfgs.items() if name not in self.devices and self.start_device(name,device_cfg) is not None ]
+        self.device_configs = device_cfgs
+        if snapshot is not None and previous_snapshot is not None: previous_snapshot.close()
+        logging.info(f"Mainframe {self.mainframe_cfg['CAENHV_BOARD_ADDRESS']} reconfigured: stopped {changed}, started {started}")
 
-        # with BaseMainframe(self.mainframe_cfg) as mainframe:
-        #     self.handle = mainframe.handle
-        #     for device_name,device_cfg in self.device_configs.items():
-        #         self.devices[device_name] = DeviceLogger(device_name,device_cfg,self.handle,self.lock)
-        # print(self.handle)
-    
     def run(self):
         with BaseMainframe(self.mainframe_cfg) as mainframe:
-            handle = mainframe.handle
+            self.mainframe = mainframe
+            ## login failed: keep trying with backoff
+            while mainframe.handle is None and not self.terminateEvent.is_set():
+                self.terminateEvent.wait(mainframe.breaker.time_to_retry())
+                if self.terminateEvent.is_set(): return
+                try:
+                    with self.lock:
+                        mainframe.reconnect()
+                    mainframe.breaker.record_success()
+                except BackendError as e:
+                    mainframe.breaker.record_failure(e)
+            ## a single scheduler polls all the devices of this mainframe, each at its HoldOffTime
+            self.scheduler = PollScheduler(self.lock,self.terminateEvent,mainframe=mainframe,tick=self.tick,
+                                           max_call_rate=self.mainframe_cfg.get("MAX_CALLS_PER_SECOND"))
+            ## ACQUISITION: events uses the parameter changes pushed by the mainframe, if supported, polling otherwise
+            if self.mainframe_cfg.get("ACQUISITION","polling") == "events":
+                self.acquisition = EventAcquisition(self.lock,self.terminateEvent,mainframe,tick=self.tick)
             for device_name, device_cfg in self.device_configs.items():
-                self.devices[device_name] = DeviceLogger(device_name,device_cfg,handle,self.lock,self.terminateEvent)
-                self.devices[device_name].start()
-                logging.debug(f"{device_name} logging started")
-            for device in self.devices.values():
-                device.join()
-
-class DeviceLogger(Thread):
-    def __init__(self,device_name,cfg,handle,lock,terminateEvent):
-        self.terminateEvent = terminateEvent
-        super().__init__(args=(self.terminateEvent))
-        self.name = get_color(colors_device,colors_taken_device) + f'{device_name}_Thread' + "\033[1;0m"
-        self.handle = handle
+                self.start_device(device_name,device_cfg)
+            if self.acquisition is not None:
+                try:
+                    self.acquisition.run()
+                except SubscriptionNotSupported as e:
+                    logging.warning(f"{e}. Falling back to polling")
+                    self.acquisition = None
+            self.scheduler.run()
+            for device_name,device in self.devices.items():
+                logging.info(f"{device_name}: {device.n_polls} polls, {self.scheduler.deadline_misses.get(device_name,0)} deadline misses")
+                device.close()
+
+class DeviceLogger:
+    def __init__(self,device_name,cfg,mainframe,snapshot=None,lock=None):
+        self.name = get_color(colors_device,colors_taken_device) + device_name + "\033[1;0m"
+        self.mainframe = mainframe
         self.cfg = cfg
         self.device_name = device_name
         self.channel_names_map = {} ## Map containing the map from channel number to channel name. Gets filled when the comm is opened
-        self.lock = lock
+        self.board = None
+        self.change_filter = None
+        self.adaptive = None ## AdaptiveRate, if AdaptivePolling is configured
+        self.history = None ## HistoryWriter, if History is configured
+        self.serializer = None ## LineSerializer of the board channels
+        self.sample = None ## Sample refilled by every poll
+        self.n_polls = 0
+        self.snapshot = snapshot
+        self.lock = lock ## mainframe lock, taken by the safe setpoints of the alarms
+        self.alarms = None ## AlarmEngine, if Alarms is configured
+        self.writer = get_writer(self.cfg["influxDB"]) ## shared by all the devices writing to the same influxDB
+
+    @property
+    def period(self):
+        return self.adaptive.period if self.adaptive is not None else self.cfg["HoldOffTime"]
+
+    @property
+    def calls_per_poll(self):
+        return self.board.calls_per_poll(self.cfg["Monitorables"])
   
     def yieldBoard(self):
-        if self.cfg["isGEMDetector"]:
-            board = GemBoard(self.cfg["BOARD"],self.handle)
-        else:
-            board = BaseBoard(self.cfg["BOARD"],self.handle)
-        return board
+        return make_board(self.cfg,self.mainframe)
         
-    def updateDB(self,data):
+    def yieldSerializer(self):
         ## Channel name alias, as we want them to appear in the DB
         ## used only if isGEMDetector
         channel_aliases = [
@@ -80,53 +171,81 @@ class DeviceLogger(Thread):
             "G1Top",
             "Drift"
         ]
-        # Instantiate InfluxDB client and connect:
-        client = influxdb_client.InfluxDBClient(
-            url=self.cfg["influxDB"]["URL"],
-            token=self.cfg["influxDB"]["TOKEN"],
-            org=self.cfg["influxDB"]["ORG"]
-        )
-        write_api = client.write_api(write_options=SYNCHRONOUS)
-
-        for ch,values in data.items():
-            if type(ch) == int:
-                for quantity,value in values.items():
-                    if self.cfg["isGEMDetector"]:
-                        point = influxdb_client.Point("HV").tag("ChannelName",channel_aliases[ch%7]).field(quantity,value)
-                    else:
-                        point = influxdb_client.Point("CAEN_Board_Monitor").tag("ChannelName",self.channel_names_map[ch]).field(quantity,value)
-                    write_api.write(bucket=self.cfg["influxDB"]["DB_BUCKET"], org=self.cfg["influxDB"]["ORG"], record=point)
+        precision = self.cfg["influxDB"].get("PRECISION","ns")
+        if self.cfg["isGEMDetector"]:
+            return LineSerializer("HV",{ ch:channel_aliases[ch%7] for ch in self.board._channels },precision=precision)
+        return LineSerializer("CAEN_Board_Monitor",{ ch:self.channel_names_map[ch] for ch in self.board._channels },precision=precision)
 
-    def run(self):
-        prev_data = dict()
-        last_logged_time = 0
-        
-        with self.lock:
-            board = self.yieldBoard()
-            board.set_monitorables(self.cfg["Monitorables"])
-            self.channel_names_map = board.channel_names_map
-            logging.debug(f"Initialized {self.device_name}'s board. Monitoring {self.cfg['Monitorables']} for channels {self.channel_names_map}")
-
-        while not self.terminateEvent.is_set():
-            with self.lock: 
-                logging.debug(f"Acquired lock")
-                monitored_data = board.log()  
-                logging.debug(f"Fetched data")
-                logging.debug(f"Released lock")
-            ## if there are no changes in the monitored data AND last DB update was done less than 5 mins ago
-            if DeepDiff(monitored_data, prev_data, verbose_level=2, exclude_paths=["root['time']"]) == {} and monitored_data['time'] - last_logged_time < 5 * 60:
-                pass
-            else:
-                try:
-                    self.updateDB(monitored_data)
-                    logging.info(f"Updated DB")
-                    prev_data = monitored_data
-                    last_logged_time = monitored_data['time']
-                except Exception as a: 
-                    logging.warning(f"Exception {a} caught while updating DB Retrying...skipping")
+    def updateDB(self,sample,mask=None):
+        ## one line-protocol record per channel with all its changed fields (mask), stamped with the acquisition time
+        records = self.serializer.serialize(sample,mask)
+        ## queued, the batching writer flushes them in the background
+        self.writer.write(self.cfg["influxDB"]["DB_BUCKET"],records,sample.timestamp)
+
+    def init_board(self):
+        ## to be called holding the mainframe lock
+        self.board = self.yieldBoard()
+        self.board.set_monitorables(self.cfg["Monitorables"])
+        self.channel_names_map = self.board.channel_names_map
+        self.serializer = self.yieldSerializer()
+        ## buffer of the polls of the board, refilled in place (see sample.py)
+        self.sample = Sample(self.board.sample_schema(self.cfg["Monitorables"]))
+        ## push only the fields that moved beyond their deadband, all of them every KeepAliveTime seconds
+        self.change_filter = DeadbandFilter(self.board._channels,self.cfg.get("Deadbands"),self.cfg.get("KeepAliveTime",5*60))
+        ## poll every Fast seconds while the channels ramp, trip or move, every Slow seconds (default HoldOffTime) otherwise
+        cfg_adaptive = self.cfg.get("AdaptivePolling")
+        if cfg_adaptive:
+            self.adaptive = AdaptiveRate(self.device_name,self.board._channels,
+                                         fast = cfg_adaptive.get("Fast",1.),
+                                         slow = cfg_adaptive.get("Slow",self.cfg["HoldOffTime"]),
+                                         max_dvdt = cfg_adaptive.get("dVdt",1.),
+                                         max_didt = cfg_adaptive.get("dIdt",1.),
+                                         hold = cfg_adaptive.get("Hold",60.))
+        ## every sample is also kept in the local history (see history.py)
+        cfg_history = self.cfg.get("History")
+        if cfg_history:
+            self.history = HistoryWriter(cfg_history.get("Path",HISTORY_PATH),self.device_name,self.board._channels,self.cfg["Monitorables"],
+                                         segment_rows = cfg_history.get("SegmentRows",100000),
+                                         max_segments = cfg_history.get("Segments",20))
+        ## alarm and interlock rules, checked on every sample before it is published (see alarms.py)
+        if self.cfg.get("Alarms"):
+            self.alarms = AlarmEngine(self.device_name,*parse_alarms(self.cfg["Alarms"],self.cfg["Monitorables"]))
+        ## latest sample served to the status clients (see status_server.py)
+        status_server.register(self.device_name,self.mainframe.cfg["CAENHV_BOARD_ADDRESS"],self.board.board_slot,self.board._channels,
+                               [ self.channel_names_map[ch] for ch in self.board._channels ])
+        logging.debug(f"Initialized {self.device_name}'s board. Monitoring {self.cfg['Monitorables']} for channels {self.channel_names_map}")
+
+    def poll(self):
+        ## to be called holding the mainframe lock. Returns the sample, overwritten by the next poll
+        self.board.handle = self.mainframe.handle ## changes after a re-login
+        sample = self.board.monitor_sample(self.sample)
+        self.n_polls += 1
+        if self.adaptive is not None: self.adaptive.update(sample,sample.timestamp) ## before the scheduler picks the next deadline
+        return sample
 
+    def close(self):
+        status_server.unregister(self.device_name)
+        if self.history is not None: self.history.close()
 
-            time.sleep(self.cfg["HoldOffTime"])
+    def process(self,sample):
+        if self.alarms is not None:
+            with metrics.timer("gemcaen_alarms_seconds",help_text="Time to check the alarm rules and run their actions",device=self.device_name):
+                self.alarms.check(sample,self.board,self.lock)
+        if self.snapshot is not None: self.snapshot.publish(self.device_name,sample,sample.timestamp)
+        status_server.publish(self.device_name,sample)
+        if self.history is not None:
+            with metrics.timer("gemcaen_history_append_seconds",help_text="Time to append a sample to the local history",device=self.device_name):
+                self.history.append(sample,sample.timestamp)
+        with metrics.timer("gemcaen_change_detection_seconds",help_text="Time spent in change detection",device=self.device_name):
+            changed = self.change_filter.update(sample)
+        n_changed = int(changed.sum())
+        if n_changed:
+            try:
+                with metrics.timer("gemcaen_updatedb_seconds",help_text="Time to build and queue the DB points",device=self.device_name):
+                    self.updateDB(sample,changed)
+                logging.info(f"{self.name}: queued DB update of {n_changed} fields. Writer queue depth {self.writer.queue_depth}, last flush {self.writer.last_flush_latency*1e3:.1f} ms")
+            except Exception as a: 
+                logging.warning(f"{self.name}: exception {a} caught while updating DB. Skipping")
 
 if __name__=='__main__':
     pass
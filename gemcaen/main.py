@@ -1,14 +1,18 @@
 from prompt_logger import logger as logging
 from argparse import RawTextHelpFormatter
 from logger_classes import MainframeLogger,DeviceLogger
-from config_parser import load_config
+from config_parser import load_config, diff_configs, ConfigWatcher, CONFIG_PATH
+from supervisor import MainframeSupervisor
 import argparse
 import threading
 import signal
 import functools
+import metrics
+import status_server
 
 
 terminateEvent = threading.Event() ## when set, kills all the threads
+reloadEvent = threading.Event() ## when set, the config file is loaded again
 
 ## catch keyboard interrupt and issue terminateEvent
 @functools.lru_cache
@@ -18,6 +22,10 @@ def sigint_handler(signal, frame):
     logging.warning(f"Received interrupt signal")
     logging.warning("Execution will terminate upon mainframes connections closure... ")
 
+## kill -HUP <pid> reloads the config (as saving config.yml does)
+def sighup_handler(signal, frame):
+    reloadEvent.set()
+
 #### PARSER
 parser = argparse.ArgumentParser(
     description='''Scripts that: \n\t-Takes as input a list of keys that match those in the config.yml file\n\t-Checks if the parsed keys have a legit configuration\n\t-Starts the monitoring of the specified HW quantities''',
@@ -25,21 +33,77 @@ parser = argparse.ArgumentParser(
     formatter_class=RawTextHelpFormatter
 )
 parser.add_argument("setupNames", type=str, help="Setup names you want to monitor as they appear in the config file. Space separated.", nargs="*")
+parser.add_argument("--metrics-port", type=int, default=None, help="Serve timing and error metrics in Prometheus format on http://127.0.0.1:<port>/metrics")
+parser.add_argument("--processes", action="store_true", help="Run each mainframe in its own process, restarted if it crashes or hangs.\nThe latest samples are published in shared memory (see snapshot.py)")
+parser.add_argument("--status-socket", type=str, default=str(status_server.STATUS_PATH), help="Unix socket serving the latest samples to status_server.py. Empty to disable.\nDefault status.sock")
+parser.add_argument("--config", type=str, default=str(CONFIG_PATH), help="Config file, watched for changes. Default config/config.yml")
 args = parser.parse_args()
 
+def start_mainframe(ip,cfg,loggers):
+    ## each mainframe has its own termination event, so that a reload can stop it alone
+    loggers[ip] = MainframeLogger(cfg[ip]["MAINFRAME"],cfg[ip]["configs"],threading.Event())
+    loggers[ip].start()
+
+def stop_mainframes(ips,loggers):
+    for ip in ips:
+        loggers[ip].terminateEvent.set()
+    for ip in ips:
+        loggers.pop(ip).join()
+
+def reload(cfg,loggers,supervisor=None):
+    ## parses the config file again and applies the differences: only the touched devices restart, the mainframe sessions are kept
+    ## unless their MAINFRAME block changed. Returns the config in use
+    try:
+        new_cfg = load_config(args.setupNames,args.config)
+    except Exception as e:
+        logging.error(f"Config reload failed ({e}). Keeping the running configuration")
+        return cfg
+    diff = diff_configs(cfg,new_cfg)
+    if not diff:
+        logging.info("Config reloaded: no changes")
+        return new_cfg
+    logging.info(f"Config reloaded. New mainframes {diff.added}, removed {diff.removed}, changed MAINFRAME {diff.restarted}, changed devices { {ip:list(changes) for ip,changes in diff.devices.items()} }")
+    if supervisor is not None:
+        supervisor.reconfigure(new_cfg,diff)
+        return new_cfg
+    stop_mainframes(diff.removed + diff.restarted,loggers)
+    for ip in diff.added + diff.restarted:
+        start_mainframe(ip,new_cfg,loggers)
+    for ip in diff.devices:
+        loggers[ip].reconfigure(new_cfg[ip]["configs"])
+    return new_cfg
+
 def run():
     loggers = {}
-    cfg = load_config(args.setupNames)
+    supervisor = None
+    cfg = load_config(args.setupNames,args.config)
     [logging.debug(f"Mainframe {ip}, devices {list(cfg[ip]['configs'].keys())}") for ip in cfg.keys()]
     
 
-    for ip in cfg:
-        mainframe_cfg = cfg[ip]["MAINFRAME"]
-        device_configs = cfg[ip]["configs"]
-        loggers[ip] = MainframeLogger(mainframe_cfg,device_configs,terminateEvent)
-        loggers[ip].start()
+    if args.processes:
+        ## workers serve their own metrics on --metrics-port +1, +2, ...
+        supervisor = MainframeSupervisor(cfg,terminateEvent,metrics_port=args.metrics_port,status_socket=args.status_socket)
+        supervisor.start()
+        status = None
+    else:
+        status = status_server.start_server(args.status_socket) if args.status_socket else None
+        for ip in cfg:
+            start_mainframe(ip,cfg,loggers)
         
+    if args.metrics_port is not None: metrics.start_http_server(args.metrics_port)
     signal.signal(signal.SIGINT, sigint_handler)
+    signal.signal(signal.SIGUSR1, metrics.dump) ## kill -USR1 <pid> logs a summary of the metrics
+    signal.signal(signal.SIGHUP, sighup_handler)
+
+    watcher = ConfigWatcher(args.config)
+    while not terminateEvent.wait(1.):
+        if supervisor is not None: supervisor.check()
+        if reloadEvent.is_set() or watcher.changed():
+            reloadEvent.clear()
+            cfg = reload(cfg,loggers,supervisor)
+    if supervisor is not None: supervisor.stop()
+    stop_mainframes(list(loggers),loggers)
+    status_server.stop_server(status)
+
 if __name__ == "__main__":
     run()
-
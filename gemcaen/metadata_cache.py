@@ -0,0 +1,70 @@
+import fcntl
+import json
+import os
+import pathlib
+import tempfile
+import threading
+from prompt_logger import logger as logging
+
+## On-disk cache of the channel names and parameter lists of the boards, so that restarting the logger
+## does not query them channel by channel. An entry is keyed by mainframe address, slot, board model, serial number
+## and firmware release: a board swap or a firmware update changes the live crate map and therefore the key.
+CACHE_PATH = pathlib.Path(__file__).parent / "cache/metadata.json"
+
+## all the mainframes share the same file: saves are serialized between the threads of a process by _file_lock,
+## between processes (main.py --processes) by flock on <cache>.lock
+_file_lock = threading.Lock()
+
+def board_key(address,slot,crate_map):
+    serial = crate_map.get("serial_numbers",[None]*(slot+1))[slot]
+    firmware = crate_map.get("firmware_releases",[None]*(slot+1))[slot]
+    return f"{address}/{slot}/{crate_map['models'][slot]}/{serial}/{firmware}"
+
+
+class MetadataCache:
+    """ Channel metadata of the boards of one mainframe, loaded from and saved to a json file """
+    def __init__(self,address,path=CACHE_PATH):
+        self.address = address
+        self.path = pathlib.Path(path)
+        self._entries = self._load()
+
+    def _load(self):
+        try:
+            with self.path.open() as cache_file:
+                return json.load(cache_file)
+        except FileNotFoundError:
+            return {}
+        except (ValueError,OSError) as e:
+            logging.warning(f"Could not read the metadata cache {self.path} ({e}). Starting from an empty cache")
+            return {}
+
+    def get_channel(self,slot,crate_map,channel:int):
+        ## returns (channel_name,channel_quantities) or None if not cached
+        entry = self._entries.get(board_key(self.address,slot,crate_map),{}).get(str(channel))
+        if entry is None: return None
+        return entry["name"],entry["quantities"]
+
+    def set_channel(self,slot,crate_map,channel:int,channel_name,channel_quantities):
+        self._entries.setdefault(board_key(self.address,slot,crate_map),{})[str(channel)] = {"name":channel_name,"quantities":list(channel_quantities)}
+
+    def save(self):
+        ## a cache that can't be written only costs the channel by channel queries at the next start: never raises
+        try:
+            with _file_lock:
+                self.path.parent.mkdir(parents=True,exist_ok=True)
+                with self.path.with_suffix(".lock").open("w") as lock_file:
+                    fcntl.flock(lock_file,fcntl.LOCK_EX) ## released when the file is closed
+                    ## merge with what other mainframes saved in the meanwhile (their entries as read from the file, not the copies
+                    ## loaded earlier by this cache), then replace the file atomically
+                    entries = self._load()
+                    entries.update({ key:entry for key,entry in self._entries.items() if key.startswith(f"{self.address}/") })
+                    with tempfile.NamedTemporaryFile("w",dir=self.path.parent,prefix=self.path.name,suffix=".tmp",delete=False) as cache_file:
+                        json.dump(entries,cache_file,indent=1)
+                    try:
+                        os.replace(cache_file.name,self.path)
+                    except OSError:
+                        os.unlink(cache_file.name)
+                        raise
+            self._entries = entries
+        except OSError as e:
+            logging.warning(f"Could not save the metadata cache {self.path} ({e})")
@@ -0,0 +1,137 @@
+import threading
+import time
+import bisect
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from prompt_logger import logger as logging
+
+## Process-wide latency histograms, counters and gauges, served in Prometheus text format by start_http_server
+## and dumped to the log by dump (i.e. on SIGUSR1, see main.py)
+
+LATENCY_BUCKETS = (0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.,2.5,5.,10.)
+
+## label values as the text exposition format wants them: backslash, double quote and line feed escaped
+_ESCAPE_LABEL = str.maketrans({"\\":"\\\\","\"":"\\\"","\n":"\\n"})
+
+def _labels_string(labels,extra=()):
+    items = list(labels) + list(extra)
+    if not items: return ""
+    return "{" + ",".join( f'{k}="{str(v).translate(_ESCAPE_LABEL)}"' for k,v in items ) + "}"
+
+
+class Histogram:
+    def __init__(self,buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0]*(len(buckets)+1) ## last one is +Inf
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self,value):
+        self.counts[bisect.bisect_left(self.buckets,value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help = {} ## name -> (type,help)
+        self._histograms = {} ## (name,labels) -> Histogram
+        self._counters = {} ## (name,labels) -> value
+        self._gauges = {} ## (name,labels) -> value
+
+    def _declare(self,name,metric_type,help_text):
+        if name not in self._help: self._help[name] = (metric_type,help_text)
+
+    def observe(self,name,value,help_text="",**labels):
+        key = (name,tuple(sorted(labels.items())))
+        with self._lock:
+            self._declare(name,"histogram",help_text)
+            if key not in self._histograms: self._histograms[key] = Histogram()
+            self._histograms[key].observe(value)
+
+    def inc(self,name,value=1,help_text="",**labels):
+        key = (name,tuple(sorted(labels.items())))
+        with self._lock:
+            self._declare(name,"counter",help_text)
+            self._counters[key] = self._counters.get(key,0) + value
+
+    def set_gauge(self,name,value,help_text="",**labels):
+        key = (name,tuple(sorted(labels.items())))
+        with self._lock:
+            self._declare(name,"gauge",help_text)
+            self._gauges[key] = value
+
+    @contextmanager
+    def timer(self,name,help_text="",**labels):
+        ## observes the seconds spent in the with block, also when it raises
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name,time.perf_counter() - start,help_text,**labels)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name,(metric_type,help_text) in sorted(self._help.items()):
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                if metric_type == "histogram":
+                    for (h_name,labels),histogram in self._histograms.items():
+                        if h_name != name: continue
+                        cumulative = 0
+                        for bound,count in zip(list(histogram.buckets) + ["+Inf"],histogram.counts):
+                            cumulative += count
+                            lines.append(f"{name}_bucket{_labels_string(labels,[('le',bound)])} {cumulative}")
+                        lines.append(f"{name}_sum{_labels_string(labels)} {histogram.sum}")
+                        lines.append(f"{name}_count{_labels_string(labels)} {histogram.count}")
+                else:
+                    values = self._counters if metric_type == "counter" else self._gauges
+                    for (v_name,labels),value in values.items():
+                        if v_name == name: lines.append(f"{name}{_labels_string(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        ## one line per histogram (count, mean) and per counter/gauge, for the log
+        lines = []
+        with self._lock:
+            for (name,labels),histogram in sorted(self._histograms.items()):
+                mean = histogram.sum/histogram.count if histogram.count else 0.
+                lines.append(f"{name}{_labels_string(labels)} count={histogram.count} mean={mean*1e3:.2f}ms")
+            for (name,labels),value in sorted(list(self._counters.items()) + list(self._gauges.items())):
+                lines.append(f"{name}{_labels_string(labels)} {value}")
+        return lines
+
+REGISTRY = Registry()
+observe = REGISTRY.observe
+inc = REGISTRY.inc
+set_gauge = REGISTRY.set_gauge
+timer = REGISTRY.timer
+
+def dump(*args):
+    ## signal handler compatible
+    logging.info("Metrics dump:\n" + "\n".join(REGISTRY.summary()))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ("/","/metrics"):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type","text/plain; version=0.0.4")
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self,format,*args):
+        logging.debug(f"Metrics request from {self.client_address[0]}: {format % args}")
+
+def start_http_server(port,host="127.0.0.1"):
+    server = ThreadingHTTPServer((host,port),MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever,name="Metrics_Thread",daemon=True)
+    thread.start()
+    logging.info(f"Serving metrics on http://{host}:{server.server_port}/metrics")
+    return server
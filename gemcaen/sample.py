@@ -0,0 +1,79 @@
+import sys
+import collections.abc
+import numpy as np
+
+## Sample of a board: the values of every monitored quantity and channel in a preallocated float64 buffer [quantity,channel],
+## refilled in place by every poll of the board. Failed reads are NaN. The layout (SampleSchema) is fixed per board: quantities
+## and channels in the configured order, and which quantities are integers (Pw, Status, Ieq, ...), returned as python ints.
+## A Sample reads as a mapping quantity -> view of its row, as the per-quantity arrays did (sample["VMon"], sample.get("Status")).
+## The buffer is overwritten by the next poll: whoever keeps values across polls copies them (copy, copy_to).
+
+class SampleSchema:
+    __slots__ = ("channels","quantities","integer","quantity_index")
+    def __init__(self,channels,quantities,integer=()):
+        self.channels = tuple(channels)
+        self.quantities = tuple( sys.intern(quantity) for quantity in quantities )
+        self.integer = tuple( quantity in integer for quantity in self.quantities ) ## per quantity
+        self.quantity_index = { quantity:index for index,quantity in enumerate(self.quantities) }
+
+    def __eq__(self,other):
+        return isinstance(other,SampleSchema) and (self.channels,self.quantities,self.integer) == (other.channels,other.quantities,other.integer)
+
+    def __hash__(self):
+        return hash((self.channels,self.quantities,self.integer))
+
+    def __repr__(self):
+        return f"SampleSchema(channels={list(self.channels)},quantities={list(self.quantities)})"
+
+
+class Sample(collections.abc.Mapping):
+    """ Values of one poll of a board, buffer[quantity index,channel index], taken at timestamp (acquisition time) """
+    __slots__ = ("schema","buffer","timestamp","_rows")
+    def __init__(self,schema):
+        self.schema = schema
+        self.buffer = np.full((len(schema.quantities),len(schema.channels)),np.nan)
+        self.timestamp = None
+        self._rows = { quantity:self.buffer[index] for index,quantity in enumerate(schema.quantities) } ## views, built once
+
+    ## mapping quantity -> row
+    def __getitem__(self,quantity):
+        return self._rows[quantity]
+
+    def __iter__(self):
+        return iter(self.schema.quantities)
+
+    def __len__(self):
+        return len(self.schema.quantities)
+
+    def __contains__(self,quantity):
+        return quantity in self._rows
+
+    def set(self,quantity,values):
+        ## copies values (array, list or scalar) into the row of quantity
+        self._rows[quantity][:] = values
+
+    def value(self,quantity_index,channel_index):
+        ## python value: None for a failed read, int for integer quantities
+        value = self.buffer[quantity_index,channel_index].item()
+        if value != value: return None
+        return int(value) if self.schema.integer[quantity_index] else value
+
+    def tolist(self,quantity):
+        index = self.schema.quantity_index[quantity]
+        integer = self.schema.integer[index]
+        return [ None if value != value else int(value) if integer else value for value in self.buffer[index].tolist() ]
+
+    def arrays(self):
+        ## {quantity: np.array} copies, int64 for the integer quantities without failed reads
+        return { quantity:row.astype(np.int64) if integer and not np.isnan(row).any() else row.copy()
+                 for (quantity,row),integer in zip(self._rows.items(),self.schema.integer) }
+
+    def copy_to(self,other):
+        ## other has the same schema
+        np.copyto(other.buffer,self.buffer)
+        other.timestamp = self.timestamp
+
+    def copy(self):
+        other = Sample(self.schema)
+        self.copy_to(other)
+        return other
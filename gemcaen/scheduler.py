@@ -0,0 +1,154 @@
+import time
+import threading
+from prompt_logger import logger as logging
+from backends import BackendError
+import metrics
+
+class PollScheduler:
+    """ Polls all the devices of one mainframe from a single thread, each at its own period (HoldOffTime).
+        Devices falling due within merge_window seconds are read in the same pass, holding the mainframe lock once.
+        A poll that is late by more than one period is dropped (and counted as a deadline miss) instead of being queued.
+        If a mainframe is given, communication errors are handled by its circuit breaker: no polls till the backoff expires
+        (waiting outside the lock) and a re-login after reconnect_after consecutive failures.
+        tick, if given, is called at every iteration of the loop (at least every 0.5 s unless a pass hangs): i.e. heartbeat, reconfiguration.
+        max_call_rate, if given, caps the mainframe calls per second (device.calls_per_poll per poll): due devices that don't fit
+        wait, most overdue first.
+    """
+    def __init__(self,lock,terminateEvent,merge_window=0.05,mainframe=None,reconnect_after=2,tick=None,max_call_rate=None):
+        self.lock = lock
+        self.mainframe = mainframe
+        self.reconnect_after = reconnect_after
+        self._reconnected_at = 0 ## number of consecutive failures at the last re-login
+        self.terminateEvent = terminateEvent
+        self.merge_window = merge_window
+        self.tick = tick
+        self.max_call_rate = max_call_rate
+        self._call_budget = max_call_rate or 0. ## calls available, refilled at max_call_rate up to max_call_rate (1 s burst)
+        self._last_refill = time.monotonic()
+        self.devices = {} ## device_name -> device, with .period, .poll() and .process(sample)
+        self._next_due = {} ## device_name -> time.monotonic() deadline of the next poll
+        self.deadline_misses = {} ## device_name -> number of dropped polls
+        self.max_lateness = {} ## device_name -> max delay (s) of a poll wrt its deadline
+        self._devices_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self.label = mainframe.cfg["CAENHV_BOARD_ADDRESS"] if mainframe is not None else "" ## mainframe label of the metrics
+
+    def add_device(self,device_name,device):
+        with self._devices_lock:
+            self.devices[device_name] = device
+            self._next_due[device_name] = time.monotonic()
+            self.deadline_misses[device_name] = 0
+            self.max_lateness[device_name] = 0.
+        self._wakeup.set()
+
+    def remove_device(self,device_name):
+        with self._devices_lock:
+            self._next_due.pop(device_name,None)
+            return self.devices.pop(device_name,None)
+
+    def _reschedule(self,device_name,deadline,now):
+        period = self.devices[device_name].period
+        lateness = now - deadline
+        self.max_lateness[device_name] = max(self.max_lateness[device_name],lateness)
+        if period <= 0:
+            self._next_due[device_name] = now
+            return
+        missed = int(lateness // period) if lateness > 0 else 0 ## polls that fell due while this one was waiting
+        if missed:
+            self.deadline_misses[device_name] += missed
+            metrics.inc("gemcaen_deadline_misses_total",missed,help_text="Polls dropped because late by more than one period",mainframe=self.label,device=device_name)
+            logging.debug(f"{device_name}: dropped {missed} late polls")
+        self._next_due[device_name] = deadline + (missed+1)*period
+
+    def due_devices(self):
+        ## returns the devices due within the merge window, or the time to wait for the next one
+        with self._devices_lock:
+            if not self._next_due: return [],None
+            now = time.monotonic()
+            earliest = min(self._next_due.values())
+            if earliest > now: return [],earliest - now
+            return [ (name,deadline) for name,deadline in self._next_due.items() if deadline <= now + self.merge_window ],0.
+
+    def throttle(self,due):
+        ## returns the due devices that fit in the call budget (most overdue first) and, if none does, the time to wait
+        if self.max_call_rate is None: return due,0.
+        now = time.monotonic()
+        self._call_budget = min(self._call_budget + (now - self._last_refill)*self.max_call_rate, self.max_call_rate)
+        self._last_refill = now
+        allowed = []
+        for device_name,deadline in sorted(due,key=lambda item: item[1]):
+            device = self.devices.get(device_name)
+            cost = device.calls_per_poll if device is not None else 0
+            ## a poll costing more than the whole budget goes when the budget is full
+            if cost > self._call_budget and self._call_budget < self.max_call_rate: break
+            self._call_budget -= cost
+            allowed.append((device_name,deadline))
+        if len(allowed) < len(due):
+            metrics.inc("gemcaen_throttle_waits_total",help_text="Passes that left due polls waiting for the cap on mainframe calls",mainframe=self.label)
+        if allowed: return allowed,0.
+        return [],(min(cost,self.max_call_rate) - self._call_budget)/self.max_call_rate
+
+    def run_pass(self,due):
+        samples = {}
+        error = None
+        wait_start = time.perf_counter()
+        with self.lock:
+            acquired = time.perf_counter()
+            metrics.observe("gemcaen_lock_wait_seconds",acquired - wait_start,help_text="Time waited for the mainframe lock",mainframe=self.label)
+            logging.debug(f"Acquired lock, polling {[name for name,_ in due]}")
+            for device_name,deadline in due:
+                device = self.devices.get(device_name)
+                if device is None: continue
+                try:
+                    with metrics.timer("gemcaen_poll_seconds",help_text="Time to read a device",mainframe=self.label,device=device_name):
+                        samples[device_name] = device.poll()
+                except BackendError as e: ## the mainframe is not answering: give up this pass
+                    error = e
+                    break
+                except Exception as e:
+                    logging.error(f"{device_name}: exception {e} caught while polling. Skipping")
+            metrics.observe("gemcaen_lock_hold_seconds",time.perf_counter() - acquired,help_text="Time the mainframe lock is held by a polling pass",mainframe=self.label)
+        if self.mainframe is not None:
+            if error is None:
+                self.mainframe.breaker.record_success()
+                self._reconnected_at = 0
+            else: self.mainframe.breaker.record_failure(error)
+        elif error is not None:
+            logging.error(f"Communication error {error} caught while polling. Skipping")
+        now = time.monotonic()
+        with self._devices_lock:
+            for device_name,deadline in due:
+                if device_name in self._next_due: self._reschedule(device_name,deadline,now)
+        ## change detection and DB queuing happen outside the mainframe lock
+        for device_name,sample in samples.items():
+            device = self.devices.get(device_name)
+            if device is not None: device.process(sample)
+
+    def reconnect(self):
+        try:
+            with self.lock:
+                self.mainframe.reconnect()
+            self._reconnected_at = self.mainframe.breaker.failures
+            return True
+        except BackendError as e:
+            self.mainframe.breaker.record_failure(e)
+            return False
+
+    def run(self):
+        while not self.terminateEvent.is_set():
+            if self.tick is not None: self.tick()
+            if self.mainframe is not None:
+                breaker = self.mainframe.breaker
+                if not breaker.allow(): ## backoff, without holding the lock
+                    self.terminateEvent.wait(min(breaker.time_to_retry(),0.5))
+                    continue
+                ## re-login once per failed attempt, after reconnect_after consecutive failures
+                if breaker.failures >= self.reconnect_after and breaker.failures != self._reconnected_at and not self.reconnect():
+                    continue
+            due,wait = self.due_devices()
+            if due: due,wait = self.throttle(due)
+            if not due:
+                self._wakeup.clear()
+                self._wakeup.wait(min(wait,0.5) if wait is not None else 0.5) ## recheck terminateEvent at least every 0.5 s
+                continue
+            self.run_pass(due)
@@ -0,0 +1,212 @@
+import time
+import argparse
+import numbers
+import sys
+from argparse import RawTextHelpFormatter
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Optional
+import tableformatter as tf
+from prompt_logger import logger as logging
+from caen_classes import BaseMainframe, GemBoard, make_board, config_channels
+from backends import BackendError
+from config_parser import load_config, CONFIG_PATH
+
+## Non-interactive setpoints on many channels, boards and mainframes: the writes are grouped per mainframe (one session each,
+## mainframes in parallel), then the read-back is polled till every channel reached its target or the timeout expired.
+## targets = {setup_name: {quantity: value or {channel: value}}}, quantity one of SETTABLE. Writes go I0Set, V0Set, Pw in this
+## order per board, so that a channel is switched on with its new limits. Ieq is written as the V0Set of each GEM channel.
+
+SETTABLE = ["I0Set","V0Set","Pw","Ieq"]
+## quantity read back to tell that the setpoint is reached, and the default tolerance on it
+READBACK = {"V0Set":"VMon","I0Set":"I0Set","Pw":"Pw"}
+TOLERANCES = {"V0Set":2.,"I0Set":0.01,"Pw":0}
+
+class ChannelResult(NamedTuple):
+    setup: str
+    channel: int
+    quantity: str ## written quantity (Ieq targets are written as V0Set)
+    target: float
+    readback: Optional[float] ## last value of READBACK[quantity]
+    status: str ## reached, timeout, not_applied (the mainframe holds another value, i.e. clipped), error, planned (dry run)
+    seconds: float ## from the write to the setpoint reached, or to the end of the wait
+    error: Optional[str] = None
+
+
+def check_targets(cfg,targets):
+    ## raises ValueError for the targets that don't fit the config of their setup: unknown setups or setpoints, values that
+    ## are not numbers, channels not configured, Ieq of setups that are not GEM detectors. Needs no mainframe
+    device_cfgs = { setup_name:device_cfg for ip in cfg for setup_name,device_cfg in cfg[ip]["configs"].items() }
+    unknown = [ setup_name for setup_name in targets if setup_name not in device_cfgs ]
+    if unknown:
+        raise ValueError(f"Setups {unknown} not found in the configuration")
+    for setup_name,setup_targets in targets.items():
+        device_cfg = device_cfgs[setup_name]
+        channels = config_channels(device_cfg)
+        invalid = [ quantity for quantity in setup_targets if quantity not in SETTABLE ]
+        if invalid: raise ValueError(f"Invalid setpoints {invalid}. Valid setpoints are {SETTABLE}")
+        for quantity,value in setup_targets.items():
+            channel_values = value if isinstance(value,dict) else {None:value}
+            if not all( isinstance(v,numbers.Number) for v in channel_values.values() ):
+                raise ValueError(f"{setup_name}: invalid value for {quantity}: {value}")
+            if quantity == "Ieq" and not device_cfg["isGEMDetector"]:
+                raise ValueError(f"{setup_name}: Ieq setpoints need a GEM detector")
+            outside = [ ch for ch in channel_values if ch is not None and channels is not None and ch not in channels ]
+            if outside:
+                raise ValueError(f"{setup_name}: channels {outside} of {quantity} not configured. Configured channels are {channels}")
+
+def board_targets(board,targets):
+    ## {quantity: {ch: value}} to be written on board, in write order. Raises ValueError
+    writes = dict()
+    for quantity,value in targets.items():
+        if quantity not in SETTABLE:
+            raise ValueError(f"Invalid setpoint {quantity}. Valid setpoints are {SETTABLE}")
+        channel_values = dict(value) if isinstance(value,dict) else { ch:value for ch in board._channels }
+        if not all( isinstance(v,numbers.Number) for v in channel_values.values() ):
+            raise ValueError(f"Invalid value for {quantity}: {value}")
+        if quantity == "Ieq":
+            if not isinstance(board,GemBoard):
+                raise ValueError(f"Ieq setpoints need a GEM board, found {board.board_name} on slot {board.board_slot}")
+            [ board.validChannel(ch) for ch in channel_values ]
+            quantity,channel_values = "V0Set",{ ch:board.channel_VMon(ch,ieq) for ch,ieq in channel_values.items() }
+        writes.setdefault(quantity,dict()).update(channel_values)
+    return { quantity:writes[quantity] for quantity in READBACK if quantity in writes }
+
+def _expected(quantity,target,pw):
+    ## value of the read-back quantity once target is reached: channels off ramp VMon to 0
+    return target if quantity != "V0Set" or pw else 0.
+
+class BoardSetpoints:
+    """ Writes (write) and verifies (check, one read-back pass) the setpoints of one board, on an open session """
+    def __init__(self,setup_name,board,writes):
+        self.setup_name = setup_name
+        self.board = board
+        self.writes = writes ## as returned by board_targets
+        self.results = dict() ## (quantity,ch) -> ChannelResult
+        self.pending = set() ## (quantity,ch) written, not reached yet
+        self.readbacks = dict() ## (quantity,ch) -> last read-back value
+        self.start = time.monotonic()
+
+    def finish(self,quantity,ch,readback,status,error=None):
+        self.results[(quantity,ch)] = ChannelResult(self.setup_name,ch,quantity,self.writes[quantity][ch],readback,status,round(time.monotonic() - self.start,3),error)
+        self.pending.discard((quantity,ch))
+
+    def write(self,tolerances,dry_run=False):
+        self.start = time.monotonic()
+        for quantity,channel_values in self.writes.items():
+            try:
+                if dry_run:
+                    current = self.board.fetch_quantity(quantity)
+                    [ self.finish(quantity,ch,current[self.board._channels.index(ch)].item(),"planned") for ch in channel_values ]
+                    continue
+                self.board.set_channels_value(quantity,channel_values)
+                self.pending.update( (quantity,ch) for ch in channel_values )
+                ## the mainframe may hold another value than the written one (i.e. V0Set above SVMax)
+                applied = self.board.fetch_quantity(quantity)
+                for ch,target in channel_values.items():
+                    value = applied[self.board._channels.index(ch)].item()
+                    if abs(value - target) > max(tolerances.get(quantity,0),1e-3*abs(target)):
+                        self.finish(quantity,ch,value,"not_applied",f"{quantity} reads {value}")
+            except (BackendError,ValueError) as e: ## ValueError: i.e. a parameter the channel doesn't have
+                [ self.finish(quantity,ch,None,"error",str(e)) for ch in channel_values if (quantity,ch) not in self.results ]
+
+    def check(self,tolerances):
+        quantities = { READBACK[quantity] for quantity,_ in self.pending }
+        if "VMon" in quantities: quantities.add("Pw") ## VMon goes to 0 on the channels off
+        try:
+            arrays = { quantity:self.board.fetch_quantity(quantity) for quantity in quantities }
+        except BackendError as e:
+            logging.warning(f"{self.setup_name}: read-back failed ({e})")
+            return
+        for quantity,ch in list(self.pending):
+            index = self.board._channels.index(ch)
+            self.readbacks[(quantity,ch)] = arrays[READBACK[quantity]][index].item()
+            pw = arrays["Pw"][index] if "Pw" in arrays else 1
+            if abs(self.readbacks[(quantity,ch)] - _expected(quantity,self.writes[quantity][ch],pw)) <= tolerances.get(quantity,0):
+                self.finish(quantity,ch,self.readbacks[(quantity,ch)],"reached")
+
+    def timeout(self):
+        for quantity,ch in list(self.pending):
+            self.finish(quantity,ch,self.readbacks.get((quantity,ch)),"timeout")
+
+    def sorted_results(self):
+        return sorted(self.results.values(),key=lambda result: (list(self.writes).index(result.quantity),result.channel))
+
+def setup_error(setup_name,setup_targets,error):
+    ## result of a setup that could not be written at all
+    return ChannelResult(setup_name,-1,",".join(setup_targets),float("nan"),None,"error",0.,str(error))
+
+def apply_mainframe(mainframe_cfg,device_cfgs,targets,timeout,tolerances,poll_interval,terminateEvent=None,dry_run=False):
+    ## the setups of one mainframe on a single session: all the writes first, then the read-back of all the boards together
+    results = []
+    with BaseMainframe(mainframe_cfg) as mainframe:
+        boards = []
+        for setup_name,device_cfg in device_cfgs.items():
+            try:
+                if mainframe.handle is None: raise BackendError(f"login to {mainframe_cfg['CAENHV_BOARD_ADDRESS']} failed")
+                board = make_board(device_cfg,mainframe)
+                writes = board_targets(board,targets[setup_name])
+            except (BackendError,ValueError) as e: ## ValueError: i.e. the board in the slot is not a GEM board
+                results.append(setup_error(setup_name,targets[setup_name],e))
+                continue
+            boards.append(BoardSetpoints(setup_name,board,writes))
+        for board in boards:
+            board.write(tolerances,dry_run)
+        deadline = time.monotonic() + timeout
+        while any( board.pending for board in boards ):
+            time.sleep(poll_interval)
+            [ board.check(tolerances) for board in boards if board.pending ]
+            if time.monotonic() > deadline or (terminateEvent is not None and terminateEvent.is_set()): break
+        for board in boards:
+            board.timeout()
+            results += board.sorted_results()
+    return results
+
+def apply_setpoints(cfg,targets,timeout=60.,tolerances=None,poll_interval=1.,terminateEvent=None,dry_run=False):
+    """ Applies targets (see above) to the setups of cfg (as returned by load_config), one thread per mainframe.
+        Returns the ChannelResult of every written channel. Targets that don't fit the config (check_targets) raise ValueError before
+        any mainframe is contacted. The failures of a board or a mainframe (i.e. not the board model of the config) are error results:
+        the results of the other mainframes are kept
+    """
+    tolerances = {**TOLERANCES,**(tolerances or {})}
+    check_targets(cfg,targets)
+    per_mainframe = { ip:{ setup_name:device_cfg for setup_name,device_cfg in cfg[ip]["configs"].items() if setup_name in targets } for ip in cfg }
+    per_mainframe = { ip:device_cfgs for ip,device_cfgs in per_mainframe.items() if device_cfgs }
+    with ThreadPoolExecutor(max_workers=max(len(per_mainframe),1),thread_name_prefix="Setpoints") as executor:
+        futures = { ip:executor.submit(apply_mainframe,cfg[ip]["MAINFRAME"],device_cfgs,targets,timeout,tolerances,poll_interval,terminateEvent,dry_run)
+                    for ip,device_cfgs in per_mainframe.items() }
+        results = []
+        for ip,future in futures.items():
+            try:
+                results += future.result()
+            except Exception as e:
+                logging.error(f"Mainframe {ip}: exception {e} caught while applying the setpoints")
+                results += [ setup_error(setup_name,targets[setup_name],e) for setup_name in per_mainframe[ip] ]
+        return results
+
+def print_results(results):
+    cols = ["Setup","Ch","Quantity","Target","Read-back","Status","Seconds"]
+    rows = [ [r.setup,r.channel,r.quantity,r.target,"" if r.readback is None else round(r.readback,3),r.status if r.error is None else f"{r.status}: {r.error}",r.seconds] for r in results ]
+    print(tf.generate_table(rows, cols, grid_style=tf.AlternatingRowGrid()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='''Applies setpoints to the channels of the given setups, all the mainframes in parallel, and waits till they are reached''',
+        epilog="""Typical exectuion\n\t python setpoints.py ME0_0001_CERN ME0_0002_CERN --Ieq 700 --timeout 600\n\t python setpoints.py ME0_0001_CERN_LV --set V0Set=8 --set Pw=1""",
+        formatter_class=RawTextHelpFormatter
+    )
+    parser.add_argument("setupNames", type=str, help="Setup names as they appear in the config file. Space separated.", nargs="+")
+    parser.add_argument("--Ieq", type=float, default=None, help="Equivalent divider current (uA) of the GEM setups")
+    parser.add_argument("--set", type=str, action="append", default=[], help="<quantity>=<value>, quantity one of V0Set, I0Set, Pw, Ieq. Repeatable")
+    parser.add_argument("--channels", type=int, nargs="*", default=None, help="Channels to be set. Default all the configured channels")
+    parser.add_argument("--timeout", type=float, default=60., help="Seconds to wait for the setpoints to be reached")
+    parser.add_argument("--config", type=str, default=str(CONFIG_PATH), help="Config file. Default config/config.yml")
+    parser.add_argument("--dry-run", action="store_true", help="Print the current values and the targets without writing")
+    args = parser.parse_args()
+
+    setpoints = { quantity:float(value) for quantity,value in ( item.split("=",1) for item in args.set ) }
+    if args.Ieq is not None: setpoints["Ieq"] = args.Ieq
+    if args.channels: setpoints = { quantity:{ ch:value for ch in args.channels } for quantity,value in setpoints.items() }
+    results = apply_setpoints(load_config(args.setupNames,args.config),{ setup_name:setpoints for setup_name in args.setupNames },timeout=args.timeout,dry_run=args.dry_run)
+    print_results(results)
+    sys.exit(0 if all( r.status in ("reached","planned") for r in results ) else 1)
@@ -0,0 +1,247 @@
+import itertools
+import random
+import threading
+import time
+from backends import BaseBackend, BackendError, BulkNotSupported, SubscriptionNotSupported
+
+## Simulated SY4527 mainframe, selected with BACKEND: simulated in the MAINFRAME config.
+## Optional MAINFRAME.SIMULATION keys:
+##   LATENCY: seconds spent by each call (default 0.001)
+##   LATENCY_PER_CHANNEL: extra seconds per channel of a multi-channel read (default 0)
+##   ERROR_RATE: probability of a call raising BackendError (default 0)
+##   BULK_SUPPORTED: if False multi-channel reads and writes are rejected (default True)
+##   SEED: seed of the noise/error generator
+##   BOARDS: {<slot>: {MODEL: A1515, CHANNELS: 14, NAMES: [...]}} (default: one A1515 in slot 0)
+##   INITIAL: initial channel settings, i.e. {V0Set: 600, Pw: 1} (default: all channels off)
+##   EVENTS_SUPPORTED: if False parameter subscriptions are rejected (default True)
+##   EVENT_INTERVAL: seconds between two checks of the subscribed parameters (default 0.05)
+##   EVENT_DEADBAND: change of a float parameter that triggers an event (default 0.5). Integer parameters trigger on any change
+
+GEM_ELECTRODES = ["G3BOT","G3TOP","G2BOT","G2TOP","G1BOT","G1TOP","G0BOT"]
+GEM_RESISTORS = {"G3BOT":0.625007477,"G3TOP":0.525001495,"G2BOT":0.874992523,"G2TOP":0.550002991,"G1BOT":0.438004665,"G1TOP":0.560006579,"G0BOT":1.125007477}
+INT_PARAMETERS = ["Pw","Status"]
+CHANNEL_PARAMETERS = ["V0Set","I0Set","VMon","IMon","RUp","RDWn","Pw","Status"]
+
+_handles = itertools.count(1)
+
+
+class SimulatedChannel:
+    def __init__(self,name,resistor,initial=None):
+        self.name = name
+        self.resistor = resistor ## MOhm, IMon = VMon/resistor
+        self.params = {"V0Set":0.,"I0Set":20.,"RUp":50.,"RDWn":50.,"Pw":0,"Status":0}
+        self.vmon = 0.
+        self.last_update = time.time()
+        for param_name,value in (initial or {}).items(): self.set(param_name,value)
+        self.vmon = self.params["V0Set"] if self.params["Pw"] else 0. ## start already ramped
+
+    def update(self):
+        ## ramp VMon towards the target at RUp/RDWn V/s
+        now = time.time()
+        target = self.params["V0Set"] if self.params["Pw"] else 0.
+        step = (now - self.last_update) * (self.params["RUp"] if target > self.vmon else self.params["RDWn"])
+        self.vmon = min(self.vmon + step,target) if target > self.vmon else max(self.vmon - step,target)
+        self.last_update = now
+        status = 1 if self.params["Pw"] else 0
+        if self.vmon < target: status |= 2 ## ramping up
+        elif self.vmon > target: status |= 4 ## ramping down
+        self.params["Status"] = status
+
+    def get(self,param_name,rng):
+        self.update()
+        if param_name == "VMon":
+            return self.vmon + rng.gauss(0,0.05) if self.vmon > 0 else 0.
+        if param_name == "IMon":
+            return self.vmon / self.resistor + rng.gauss(0,0.005) if self.vmon > 0 else 0.
+        return self.params[param_name]
+
+    def set(self,param_name,value):
+        self.update()
+        if param_name not in self.params:
+            raise BackendError(f"Channel {self.name}: parameter {param_name} not found")
+        self.params[param_name] = int(value) if param_name in INT_PARAMETERS else float(value)
+
+
+class SimulatedCrate:
+    def __init__(self,address,cfg_Simulation):
+        self.address = address
+        self.lock = threading.Lock() ## a mainframe serves one call at a time
+        self.latency = cfg_Simulation.get("LATENCY",0.001)
+        self.latency_per_channel = cfg_Simulation.get("LATENCY_PER_CHANNEL",0.)
+        self.error_rate = cfg_Simulation.get("ERROR_RATE",0.)
+        self.bulk_supported = cfg_Simulation.get("BULK_SUPPORTED",True)
+        self.rng = random.Random(cfg_Simulation.get("SEED"))
+        self.handles = set()
+        self.n_calls = 0
+        self.initial = cfg_Simulation.get("INITIAL",{})
+        self.events_supported = cfg_Simulation.get("EVENTS_SUPPORTED",True)
+        self.event_interval = cfg_Simulation.get("EVENT_INTERVAL",0.05)
+        self.event_deadband = cfg_Simulation.get("EVENT_DEADBAND",0.5)
+        self.subscriptions = {} ## (slot,channel,param_name) -> last value sent
+        self.n_events = 0
+        self.boards = {} ## slot -> dict(model,channels)
+        for slot,cfg_board in cfg_Simulation.get("BOARDS",{0:{"MODEL":"A1515","CHANNELS":14}}).items():
+            self.boards[int(slot)] = self.make_board(int(slot),cfg_board)
+
+    def make_board(self,slot,cfg_board):
+        model = cfg_board.get("MODEL","A1515")
+        n_channels = cfg_board.get("CHANNELS",14)
+        names = cfg_board.get("NAMES")
+        if names is None:
+            if "A1515" in model: names = [ f"L{ch//7+1}_{GEM_ELECTRODES[ch%7]}" for ch in range(n_channels) ]
+            else: names = [ f"CH{ch}" for ch in range(n_channels) ]
+        channels = [ SimulatedChannel(name,GEM_RESISTORS.get(name.split("_")[-1],1.),self.initial) for name in names ]
+        return {"model":model,"description":f"Simulated {model}","serial":1000+slot,"firmware":"1.00","channels":channels}
+
+    def call(self,handle,n_channels=1):
+        ## every call costs latency, may fail and needs a valid handle
+        with self.lock:
+            self.n_calls += 1
+            delay = self.latency + self.latency_per_channel*(n_channels-1)
+            if delay > 0: time.sleep(delay) ## not even sleep(0), a context switch, in the zero-latency benchmarks
+        if handle not in self.handles:
+            raise BackendError(f"Simulated mainframe {self.address}: invalid handle {handle}")
+        if self.error_rate and self.rng.random() < self.error_rate:
+            raise BackendError(f"Simulated mainframe {self.address}: communication error")
+
+    def changed_parameters(self):
+        ## events for the subscribed parameters that changed since the last one sent
+        events = []
+        for (slot,channel,param_name),last in self.subscriptions.items():
+            value = self.channel(slot,channel).get(param_name,self.rng)
+            if param_name in INT_PARAMETERS: changed = value != last
+            else: changed = abs(value - last) > self.event_deadband
+            if changed:
+                self.subscriptions[(slot,channel,param_name)] = value
+                events.append((slot,channel,param_name,value))
+        self.n_events += len(events)
+        return events
+
+    def channel(self,slot,channel):
+        try:
+            return self.boards[slot]["channels"][channel]
+        except (KeyError,IndexError):
+            raise BackendError(f"Simulated mainframe {self.address}: no channel {channel} in slot {slot}")
+
+
+class SimulatedBackend(BaseBackend):
+    """ In-memory SY4527 mainframe. All the backends configured with the same address share the same crate """
+    name = "simulated"
+    _crates = {} ## address -> SimulatedCrate
+    _handles = {} ## handle -> SimulatedCrate
+    _registry_lock = threading.Lock()
+
+    def __init__(self,cfg_Simulation=None):
+        self.cfg = cfg_Simulation or {}
+
+    @classmethod
+    def reset(cls):
+        with cls._registry_lock:
+            cls._crates.clear()
+            cls._handles.clear()
+
+    @classmethod
+    def crate(cls,address):
+        return cls._crates[address]
+
+    def _crate(self,handle):
+        try:
+            return self._handles[handle]
+        except KeyError:
+            raise BackendError(f"Invalid handle {handle}")
+
+    def drop_sessions(self,address):
+        ## simulates the mainframe closing all the sessions (i.e. reboot)
+        crate = self._crates[address]
+        crate.handles.clear()
+        crate.subscriptions.clear()
+
+    def init_system(self,system_type,link_type,address,user,password):
+        with self._registry_lock:
+            if address not in self._crates: self._crates[address] = SimulatedCrate(address,self.cfg)
+            crate = self._crates[address]
+            handle = next(_handles)
+            self._handles[handle] = crate
+        crate.handles.add(handle)
+        crate.call(handle)
+        return handle
+
+    def deinit_system(self,handle):
+        crate = self._crate(handle)
+        crate.call(handle)
+        crate.handles.discard(handle)
+
+    def get_crate_map(self,handle):
+        crate = self._crate(handle)
+        crate.call(handle)
+        n_slots = max(crate.boards) + 1
+        boards = [ crate.boards.get(slot) for slot in range(n_slots) ]
+        return {"models":[ b["model"] if b else "" for b in boards ],
+                "descriptions":[ b["description"] if b else "" for b in boards ],
+                "channels":[ len(b["channels"]) if b else 0 for b in boards ],
+                "serial_numbers":[ b["serial"] if b else 0 for b in boards ],
+                "firmware_releases":[ b["firmware"] if b else "" for b in boards ]}
+
+    def get_channel_name(self,handle,slot,channel):
+        crate = self._crate(handle)
+        crate.call(handle)
+        return crate.channel(slot,channel).name
+
+    def get_channel_parameters(self,handle,slot,channel):
+        crate = self._crate(handle)
+        crate.call(handle)
+        crate.channel(slot,channel)
+        return list(CHANNEL_PARAMETERS)
+
+    def get_channel_parameter(self,handle,slot,channel,param_name):
+        crate = self._crate(handle)
+        crate.call(handle)
+        return crate.channel(slot,channel).get(param_name,crate.rng)
+
+    def get_channels_parameter(self,handle,slot,channels,param_name,numeric=True):
+        crate = self._crate(handle)
+        if not crate.bulk_supported:
+            crate.call(handle)
+            raise BulkNotSupported(f"Simulated mainframe {crate.address}: multi-channel read not supported")
+        crate.call(handle,len(channels))
+        values = [ crate.channel(slot,ch).get(param_name,crate.rng) for ch in channels ]
+        return [ float(v) for v in values ] if numeric else [ int(v) for v in values ]
+
+    def set_channel_parameter(self,handle,slot,channel,param_name,value):
+        crate = self._crate(handle)
+        crate.call(handle)
+        crate.channel(slot,channel).set(param_name,value)
+
+    def set_channels_parameter(self,handle,slot,channels,param_name,value,numeric=True):
+        crate = self._crate(handle)
+        if not crate.bulk_supported:
+            crate.call(handle)
+            raise BulkNotSupported(f"Simulated mainframe {crate.address}: multi-channel write not supported")
+        crate.call(handle,len(channels))
+        for ch in channels: crate.channel(slot,ch).set(param_name,value)
+
+    def subscribe_channel_parameters(self,handle,slot,channels,param_names):
+        crate = self._crate(handle)
+        crate.call(handle)
+        if not crate.events_supported:
+            raise SubscriptionNotSupported(f"Simulated mainframe {crate.address}: parameter subscriptions not supported")
+        for ch in channels:
+            for param_name in param_names:
+                crate.subscriptions[(slot,ch,param_name)] = crate.channel(slot,ch).get(param_name,crate.rng)
+
+    def unsubscribe_channel_parameters(self,handle,slot,channels,param_names):
+        crate = self._crate(handle)
+        crate.call(handle)
+        for ch in channels:
+            for param_name in param_names:
+                crate.subscriptions.pop((slot,ch,param_name),None)
+
+    def get_events(self,handle,timeout):
+        crate = self._crate(handle)
+        deadline = time.monotonic() + timeout
+        while True:
+            if handle not in crate.handles:
+                raise BackendError(f"Simulated mainframe {crate.address}: invalid handle {handle}")
+            events = crate.changed_parameters()
+            if events or time.monotonic() >= deadline: return events
+            time.sleep(min(crate.event_interval,max(deadline - time.monotonic(),0.)))
@@ -0,0 +1,107 @@
+import json
+import re
+import struct
+import time
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+from caen_classes import config_channels
+
+## Latest sample of every device of a mainframe, in a shared memory block that local consumers can map and read without copies.
+## Layout: [int64 schema length][json schema, padded to 8 bytes][float64 values]
+## values: [heartbeat] then, for each device, [sequence, timestamp, <quantity 0 channels>, <quantity 1 channels>, ...]
+## The sequence is odd while the device is being written (seqlock): readers retry till they see the same even sequence before and after.
+
+def snapshot_name(address):
+    return "gemcaen_" + re.sub(r"[^\w]","_",address)
+
+def device_schema(device_name,cfg):
+    ## channels are known from the config, as the board polls them (check_config requires CHANNELS if not a GEM detector)
+    channels = list(config_channels(cfg))
+    return {"name":device_name,"channels":channels,"quantities":list(cfg["Monitorables"])}
+
+def _attach(name,untrack=True):
+    if not untrack: return shared_memory.SharedMemory(name=name)
+    try:
+        return shared_memory.SharedMemory(name=name,track=False) ## python >= 3.13
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        ## otherwise the resource tracker of this process unlinks the block when it exits
+        resource_tracker.unregister(shm._name,"shared_memory")
+        return shm
+
+
+class SharedSnapshot:
+    """ Writer (create=True, with the schema) or reader (attach to an existing block by name) of a mainframe snapshot.
+        Processes started by the creator share its resource tracker and attach with untrack=False
+    """
+    def __init__(self,name,schema=None,create=False,untrack=True):
+        self.name = name
+        if create:
+            schema_bytes = json.dumps(schema).encode()
+            header_size = 8 + -(-len(schema_bytes)//8)*8
+            n_values = 1 + sum( 2 + len(d["channels"])*len(d["quantities"]) for d in schema["devices"] )
+            self.shm = shared_memory.SharedMemory(name=name,create=True,size=header_size + 8*n_values)
+            self.shm.buf[:8] = struct.pack("<q",len(schema_bytes))
+            self.shm.buf[8:8+len(schema_bytes)] = schema_bytes
+        else:
+            self.shm = _attach(name,untrack)
+            schema_length, = struct.unpack("<q",bytes(self.shm.buf[:8]))
+            schema = json.loads(bytes(self.shm.buf[8:8+schema_length]))
+            header_size = 8 + -(-schema_length//8)*8
+            n_values = 1 + sum( 2 + len(d["channels"])*len(d["quantities"]) for d in schema["devices"] )
+        self.schema = schema
+        self.values = np.ndarray((n_values,),dtype=np.float64,buffer=self.shm.buf,offset=header_size)
+        if create: self.values[:] = np.nan
+        self._blocks = {} ## device_name -> (sequence/timestamp view, values view [quantity,channel], quantities)
+        offset = 1
+        for device in schema["devices"]:
+            n_channels,n_quantities = len(device["channels"]),len(device["quantities"])
+            header = self.values[offset:offset+2]
+            header[0] = 0 if create else header[0]
+            block = self.values[offset+2:offset+2+n_channels*n_quantities].reshape(n_quantities,n_channels)
+            self._blocks[device["name"]] = (header,block,device["quantities"])
+            offset += 2 + n_channels*n_quantities
+
+    @property
+    def devices(self):
+        return list(self._blocks)
+
+    def channels(self,device_name):
+        return next( d["channels"] for d in self.schema["devices"] if d["name"] == device_name )
+
+    def beat(self):
+        self.values[0] = time.time()
+
+    @property
+    def heartbeat(self):
+        return self.values[0]
+
+    def publish(self,device_name,monitored_arrays,timestamp):
+        header,block,quantities = self._blocks[device_name]
+        sequence = header[0] + header[0] % 2 ## even, also if a previous writer was killed while writing
+        header[0] = sequence + 1 ## odd: being written
+        for index,quantity in enumerate(quantities):
+            values = monitored_arrays.get(quantity)
+            block[index] = values if values is not None and len(values) == block.shape[1] else np.nan
+        header[1] = timestamp
+        header[0] = sequence + 2
+
+    def read(self,device_name,retries=100):
+        ## returns timestamp,{quantity: np.array per channel} (copies, consistent with each other)
+        header,block,quantities = self._blocks[device_name]
+        for _ in range(retries):
+            sequence = header[0]
+            if sequence % 2 == 0:
+                timestamp,values = header[1],block.copy()
+                if header[0] == sequence:
+                    return timestamp,{ quantity:values[index] for index,quantity in enumerate(quantities) }
+            time.sleep(0)
+        raise TimeoutError(f"Snapshot {self.name}: {device_name} is being written continuously")
+
+    def close(self):
+        self.values = None
+        self._blocks = {}
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
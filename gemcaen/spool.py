@@ -0,0 +1,107 @@
+import json
+import os
+import pathlib
+from prompt_logger import logger as logging
+
+## Append-only on-disk spool of the points that could not be written to influxDB.
+## Points are appended as json lines [bucket,line_protocol] to segment files spool_<n>.jsonl, that rotate every segment_bytes.
+## When the spool grows beyond max_bytes the oldest segments are evicted. Replay reads the segments in order (oldest first)
+## from a cursor that is saved on disk after each committed chunk, so that the spool survives restarts.
+## It is only used from the BatchingWriter thread: no locking.
+
+class Spool:
+    def __init__(self,directory,max_bytes=256*1024**2,segment_bytes=4*1024**2):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True,exist_ok=True)
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.cursor_path = self.directory / "cursor.json"
+        self.segments = sorted( int(p.stem.split("_")[1]) for p in self.directory.glob("spool_*.jsonl") )
+        self.cursor = self._load_cursor() ## (segment,offset) of the next point to be replayed
+        self.n_evicted = 0
+        if self.pending_bytes: logging.info(f"Spool {self.directory}: {self.pending_bytes} bytes of points to be replayed")
+
+    def _segment_path(self,segment):
+        return self.directory / f"spool_{segment:012d}.jsonl"
+
+    def _load_cursor(self):
+        try:
+            with self.cursor_path.open() as cursor_file:
+                segment,offset = json.load(cursor_file)
+            if segment in self.segments: return segment,offset
+        except (FileNotFoundError,ValueError):
+            pass
+        return (self.segments[0],0) if self.segments else (0,0)
+
+    def _save_cursor(self):
+        tmp_path = self.cursor_path.with_suffix(".tmp")
+        with tmp_path.open("w") as cursor_file:
+            json.dump(list(self.cursor),cursor_file)
+        os.replace(tmp_path,self.cursor_path)
+
+    @property
+    def total_bytes(self):
+        return sum( self._segment_path(segment).stat().st_size for segment in self.segments )
+
+    @property
+    def pending_bytes(self):
+        if not self.segments: return 0
+        return self.total_bytes - (self.cursor[1] if self.cursor[0] in self.segments else 0)
+
+    def append(self,bucket,lines):
+        if not self.segments or self._segment_path(self.segments[-1]).stat().st_size >= self.segment_bytes:
+            self.segments.append(self.segments[-1]+1 if self.segments else 0)
+            if len(self.segments) == 1: self.cursor = (self.segments[0],0)
+        with self._segment_path(self.segments[-1]).open("a") as segment_file:
+            segment_file.write("".join( json.dumps([bucket,line]) + "\n" for line in lines ))
+            segment_file.flush()
+            os.fsync(segment_file.fileno())
+        self._evict()
+
+    def _evict(self):
+        ## drop the oldest segments till the spool fits in max_bytes. The segment being written is never dropped
+        while len(self.segments) > 1 and self.total_bytes > self.max_bytes:
+            segment = self.segments.pop(0)
+            with self._segment_path(segment).open("rb") as segment_file:
+                if self.cursor[0] == segment: segment_file.seek(self.cursor[1])
+                n_lost = sum(1 for _ in segment_file)
+            self._segment_path(segment).unlink()
+            self.n_evicted += n_lost
+            logging.warning(f"Spool {self.directory} full: evicted {n_lost} points")
+            if self.cursor[0] <= segment:
+                self.cursor = (self.segments[0],0)
+                self._save_cursor()
+
+    def read(self,max_points):
+        ## returns [(bucket,line)] of the oldest points not replayed yet (at most max_points, from one segment) and the cursor after them
+        segment,offset = self.cursor
+        while segment in self.segments:
+            entries = []
+            with self._segment_path(segment).open("rb") as segment_file:
+                segment_file.seek(offset)
+                while len(entries) < max_points:
+                    line = segment_file.readline()
+                    if not line.endswith(b"\n"): break ## end of file (or a partially written line)
+                    entries.append(tuple(json.loads(line)))
+                    offset += len(line)
+            if entries or segment == self.segments[-1]: return entries,(segment,offset)
+            segment,offset = self.segments[self.segments.index(segment)+1],0 ## segment already replayed, go to the next one
+        return [],self.cursor
+
+    def commit(self,cursor):
+        ## marks the points read up to cursor as replayed. Fully replayed segments, but the last one, are deleted
+        self.cursor = cursor
+        segment,offset = cursor
+        while self.segments and self.segments[0] < segment:
+            self._segment_path(self.segments.pop(0)).unlink()
+        if segment in self.segments and offset >= self._segment_path(segment).stat().st_size:
+            if segment != self.segments[-1]:
+                self.segments.remove(segment)
+                self._segment_path(segment).unlink()
+                self.cursor = (self.segments[0],0)
+            elif offset > 0:
+                ## everything replayed: start again from an empty segment
+                self.segments.remove(segment)
+                self._segment_path(segment).unlink()
+                self.cursor = (segment+1,0)
+        self._save_cursor()
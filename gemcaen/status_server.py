@@ -0,0 +1,175 @@
+import argparse
+import glob
+import json
+import os
+import pathlib
+import socket
+import socketserver
+import threading
+import time
+from argparse import RawTextHelpFormatter
+import tableformatter as tf
+from prompt_logger import logger as logging
+from sample import Sample
+
+## Latest sample of every device of the process, served as json on a Unix socket: status checks read it instead of opening
+## their own mainframe session. Each process serves its own devices: main.py on STATUS_PATH, the workers of main.py --processes
+## on STATUS_PATH.<snapshot name>. The client (python status_server.py) reads all of them.
+## Protocol: the client sends a json request line, {} or {"devices": [...]}, the server answers a json document and closes:
+## {"devices": {name: {"mainframe","slot","channels","names","timestamp","quantities": {quantity: [value per channel]}}}}
+## Failed reads (NaN) are null.
+
+STATUS_PATH = pathlib.Path(__file__).parent / "status.sock"
+
+class LatestSamples:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._devices = {} ## device_name -> dict(mainframe,slot,channels,names)
+        self._samples = {} ## device_name -> Sample, copy of the latest one
+
+    def register(self,device_name,mainframe,slot,channels,names):
+        with self._lock:
+            self._devices[device_name] = {"mainframe":mainframe,"slot":slot,"channels":list(channels),"names":list(names)}
+            self._samples.pop(device_name,None)
+
+    def unregister(self,device_name):
+        with self._lock:
+            self._devices.pop(device_name,None)
+            self._samples.pop(device_name,None)
+
+    def publish(self,device_name,sample):
+        ## the sample buffer is refilled by the next poll: copied into the one kept for the device, converted only when asked for
+        with self._lock:
+            kept = self._samples.get(device_name)
+            if kept is None or kept.schema != sample.schema:
+                kept = self._samples[device_name] = Sample(sample.schema)
+            sample.copy_to(kept)
+
+    def read(self,device_names=None):
+        ## converted holding the lock: the kept samples are overwritten in place
+        devices = {}
+        with self._lock:
+            for name,device in self._devices.items():
+                if device_names is not None and name not in device_names: continue
+                sample = self._samples.get(name)
+                devices[name] = {**device,"timestamp":sample.timestamp if sample is not None else None,
+                                 "quantities":{ quantity:sample.tolist(quantity) for quantity in sample } if sample is not None else {}}
+        return {"devices":devices}
+
+LATEST = LatestSamples()
+register = LATEST.register
+unregister = LATEST.unregister
+publish = LATEST.publish
+
+
+class StatusHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline() or b"{}")
+            ## {"devices": [device names]}, all the devices if omitted
+            if not isinstance(request,dict):
+                raise ValueError(f"Expected a json object, found {type(request).__name__}")
+            device_names = request.get("devices")
+            if device_names is not None and not (isinstance(device_names,list) and all( isinstance(name,str) for name in device_names )):
+                raise ValueError("Expected a list of device names in devices")
+            body = json.dumps(LATEST.read(device_names),separators=(",",":"))
+        except ValueError as e:
+            body = json.dumps({"error":str(e)})
+        self.wfile.write(body.encode())
+
+
+def start_server(path=STATUS_PATH):
+    ## serves LATEST on the Unix socket path from a background thread. Returns the server, None if it can't be started
+    path = str(path)
+    if os.path.exists(path):
+        try:
+            with socket.socket(socket.AF_UNIX,socket.SOCK_STREAM) as probe:
+                probe.connect(path)
+            logging.error(f"Status socket {path} already served by another process. Not serving the status")
+            return None
+        except OSError: ## left by a process that did not stop cleanly
+            os.unlink(path)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(path,StatusHandler)
+    except OSError as e:
+        logging.error(f"Can't serve the status on {path} ({e})")
+        return None
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever,name="Status_Thread",daemon=True)
+    thread.start()
+    logging.info(f"Serving the latest samples on {path}")
+    return server
+
+def stop_server(server):
+    if server is None: return
+    server.shutdown()
+    server.server_close()
+    try:
+        os.unlink(server.server_address)
+    except OSError:
+        pass
+
+
+## client
+def query(path=STATUS_PATH,device_names=None,timeout=2.):
+    ## latest samples served on path and on the sockets of the workers (path.*). Returns {device_name: sample}
+    devices = {}
+    for socket_path in [str(path)] + sorted(glob.glob(f"{path}.*")):
+        try:
+            with socket.socket(socket.AF_UNIX,socket.SOCK_STREAM) as client:
+                client.settimeout(timeout)
+                client.connect(socket_path)
+                client.sendall(json.dumps({"devices":device_names} if device_names else {}).encode() + b"\n")
+                response = b"".join(iter(lambda: client.recv(65536),b""))
+        except OSError: ## no logger running on it
+            continue
+        devices.update(json.loads(response).get("devices",{}))
+    return devices
+
+def _round(value,digits=3):
+    return "" if value is None else round(value,digits) if isinstance(value,float) else value
+
+def status_table(sample,quantities=None):
+    ## cols,rows of BaseBoard.print_board_status
+    quantities = quantities or list(sample["quantities"])
+    cols = ["Ch_Number","Ch_Name"] + quantities
+    rows = [ [ch,name] + [ _round(sample["quantities"][quantity][index]) if quantity in sample["quantities"] else "" for quantity in quantities ]
+             for index,(ch,name) in enumerate(zip(sample["channels"],sample["names"])) ]
+    return cols,rows
+
+def ieq_table(sample):
+    ## cols,rows of GemBoard.print_Ieq, for the devices monitoring VMon, Pw and Ieq
+    values = sample["quantities"]
+    cols = ["chName","VMon","ch_IEq","PW"]
+    rows = [ [name,_round(values["VMon"][index],2),values["Ieq"][index],values["Pw"][index]] for index,name in enumerate(sample["names"]) ]
+    return cols,rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='''Prints the latest samples of the running loggers, without connecting to the mainframes''',
+        epilog="""Typical exectuion\n\t python status_server.py ME0_0001_CERN --ieq""",
+        formatter_class=RawTextHelpFormatter
+    )
+    parser.add_argument("setupNames", type=str, help="Setup names. Default all the logged ones", nargs="*")
+    parser.add_argument("--socket", type=str, default=str(STATUS_PATH), help="Status socket of main.py (--status-socket)")
+    parser.add_argument("--quantities", type=str, nargs="*", default=None, help="Quantities to be shown. Default all the monitored ones")
+    parser.add_argument("--ieq", action="store_true", help="VMon, Ieq and Pw of the GEM setups")
+    parser.add_argument("--json", action="store_true", help="Print the raw json")
+    args = parser.parse_args()
+
+    devices = query(args.socket,args.setupNames)
+    if not devices:
+        print(f"No running logger serves the status on {args.socket}")
+    if args.json:
+        print(json.dumps(devices,indent=1))
+        devices = {}
+    for device_name,sample in sorted(devices.items()):
+        age = f"{time.time() - sample['timestamp']:.1f} s ago" if sample["timestamp"] is not None else "no sample yet"
+        print(f"{device_name} (mainframe {sample['mainframe']}, slot {sample['slot']}), {age}")
+        if sample["timestamp"] is None: continue
+        if args.ieq and not all( quantity in sample["quantities"] for quantity in ("VMon","Ieq","Pw") ):
+            print("\tVMon, Ieq and Pw not monitored")
+            continue
+        cols,rows = ieq_table(sample) if args.ieq else status_table(sample,args.quantities)
+        print(tf.generate_table(rows, cols, grid_style=tf.AlternatingRowGrid()))
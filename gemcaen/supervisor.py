@@ -0,0 +1,171 @@
+import multiprocessing
+import os
+import signal
+import threading
+import time
+import numpy as np
+from prompt_logger import logger as logging
+from caen_classes import CircuitBreaker
+from logger_classes import MainframeLogger
+from snapshot import SharedSnapshot, snapshot_name, device_schema
+import influx_writer
+import metrics
+import status_server
+
+## Process-per-mainframe execution (main.py --processes): each mainframe runs its MainframeLogger in a worker process,
+## so that a crash or a hang in the CAEN library takes down only that mainframe. The supervisor restarts the workers
+## that exit or stop beating (backoff as for the mainframe communication) and owns the shared memory snapshots
+## the workers publish their latest samples into (see snapshot.py). New device configs reach a running worker
+## through its control pipe, so that its mainframe session is kept.
+
+def run_worker(mainframe_cfg,device_cfgs,name,control,metrics_port=None,status_socket=None):
+    ## control: receiving end of a pipe, with (device_cfgs,new_layout) for MainframeLogger.reconfigure.
+    ## new_layout: the supervisor recreated the snapshot with the layout of the new configs, to be attached again
+    ## stopped by SIGTERM from the supervisor. A multiprocessing.Event could be left locked by a worker killed while waiting on it
+    terminateEvent = threading.Event()
+    signal.signal(signal.SIGTERM,lambda signum,frame: terminateEvent.set())
+    signal.signal(signal.SIGINT,signal.SIG_IGN) ## ctrl-c is handled by the supervisor
+    signal.signal(signal.SIGUSR1,metrics.dump)
+    supervisor_pid = os.getppid()
+    if metrics_port is not None: metrics.start_http_server(metrics_port)
+    status = status_server.start_server(f"{status_socket}.{name}") if status_socket else None ## found by the client next to the main socket
+    snapshot = SharedSnapshot(name,untrack=False)
+    mainframe_logger = MainframeLogger(mainframe_cfg,device_cfgs,terminateEvent,snapshot)
+    mainframe_logger.start()
+    while mainframe_logger.is_alive():
+        if control is not None and control.poll(0.5):
+            try:
+                device_cfgs,new_layout = control.recv()
+                mainframe_logger.reconfigure(device_cfgs,SharedSnapshot(name,untrack=False) if new_layout else None)
+            except (EOFError,OSError): ## closed by the supervisor, that stops this worker
+                control = None
+        else:
+            mainframe_logger.join(0.5)
+        if os.getppid() != supervisor_pid: terminateEvent.set() ## orphaned
+    influx_writer.close_writers() ## atexit handlers don't run in forked processes
+    status_server.stop_server(status)
+    mainframe_logger.snapshot.close()
+    if not terminateEvent.is_set(): raise SystemExit(1) ## the logger died on its own: let the supervisor restart it
+
+
+class MainframeSupervisor:
+    """ Starts one worker process per mainframe and keeps them running till terminateEvent is set.
+        A worker is restarted if it exits, or if its heartbeat is older than hang_timeout seconds (hung in a call to the mainframe).
+    """
+    def __init__(self,cfg,terminateEvent,hang_timeout=60.,base_delay=1.,max_delay=60.,metrics_port=None,status_socket=None):
+        self.cfg = cfg ## as returned by load_config
+        self.terminateEvent = terminateEvent
+        self.hang_timeout = hang_timeout
+        self.base_delay = base_delay
+        self.max_delay = max_delay ## also the uptime after which a worker is considered healthy again
+        self.metrics_port = metrics_port ## workers serve their metrics on metrics_port+1, metrics_port+2, ...
+        self.status_socket = status_socket ## workers serve their latest samples on status_socket.<snapshot name>
+        self.context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn")
+        self.workers = {} ## ip -> dict(process,control,snapshot,breaker,started,restarts)
+        self._n_workers = 0 ## workers ever added, for the metrics ports
+
+    def start(self):
+        for ip in self.cfg:
+            self._add_worker(ip)
+
+    def _add_worker(self,ip):
+        schema = {"devices":[ device_schema(device_name,device_cfg) for device_name,device_cfg in self.cfg[ip]["configs"].items() ]}
+        self.workers[ip] = {"process":None,
+                            "control":None,
+                            "snapshot":SharedSnapshot(snapshot_name(ip),schema,create=True),
+                            "breaker":CircuitBreaker(f"Mainframe {ip} worker",base_delay=self.base_delay,max_delay=self.max_delay),
+                            "metrics_port":self.metrics_port + 1 + self._n_workers if self.metrics_port is not None else None,
+                            "started":None,
+                            "restarts":0}
+        self._n_workers += 1
+        logging.info(f"Mainframe {ip}: latest samples published in shared memory {snapshot_name(ip)}")
+        self._spawn(ip)
+
+    def _spawn(self,ip):
+        worker = self.workers[ip]
+        worker["snapshot"].values[0] = np.nan ## no heartbeat till the new worker polls
+        receiver,worker["control"] = self.context.Pipe(duplex=False)
+        worker["process"] = self.context.Process(target=run_worker,name=f"Mainframe_{ip}_Process",
+                                                 args=(self.cfg[ip]["MAINFRAME"],self.cfg[ip]["configs"],snapshot_name(ip),receiver,worker["metrics_port"],self.status_socket))
+        worker["process"].start()
+        receiver.close() ## the worker's end
+        worker["started"] = time.monotonic()
+        logging.info(f"Mainframe {ip}: worker started, pid {worker['process'].pid}")
+
+    def check(self):
+        now = time.monotonic()
+        for ip,worker in self.workers.items():
+            process,breaker = worker["process"],worker["breaker"]
+            if process is None:
+                if breaker.allow():
+                    worker["restarts"] += 1
+                    metrics.inc("gemcaen_worker_restarts_total",help_text="Mainframe worker processes restarted",mainframe=ip)
+                    self._spawn(ip)
+                continue
+            if process.is_alive():
+                heartbeat = worker["snapshot"].heartbeat
+                if np.isnan(heartbeat) or time.time() - heartbeat <= self.hang_timeout:
+                    if breaker.failures and now - worker["started"] > self.max_delay: breaker.record_success() ## running fine again
+                    continue
+                logging.error(f"Mainframe {ip}: worker pid {process.pid} not beating since {time.time() - heartbeat:.0f} s. Killing it")
+                process.kill()
+            process.join()
+            breaker.record_failure(f"worker exited with code {process.exitcode} after {now - worker['started']:.0f} s")
+            worker["process"] = None
+            worker["control"].close()
+
+    def run(self):
+        ## blocks till terminateEvent is set, then stops the workers
+        while not self.terminateEvent.is_set():
+            self.check()
+            self.terminateEvent.wait(1.)
+        self.stop()
+
+    def reconfigure(self,cfg,diff):
+        ## diff from config_parser.diff_configs. The workers of the mainframes removed or with a changed MAINFRAME block are restarted,
+        ## those with changed devices get the new configs through their control pipe and keep their session
+        self.cfg = cfg
+        self._stop_workers(diff.removed + diff.restarted)
+        for ip in diff.added + diff.restarted:
+            self._add_worker(ip)
+        for ip in diff.devices:
+            self._update_worker(ip)
+
+    def _update_worker(self,ip):
+        worker = self.workers[ip]
+        schema = {"devices":[ device_schema(device_name,device_cfg) for device_name,device_cfg in self.cfg[ip]["configs"].items() ]}
+        new_layout = schema != worker["snapshot"].schema
+        if new_layout:
+            ## same name, new block: the worker attaches it when it gets the configs, readers attach it again
+            heartbeat = worker["snapshot"].heartbeat
+            worker["snapshot"].close()
+            worker["snapshot"].unlink()
+            worker["snapshot"] = SharedSnapshot(snapshot_name(ip),schema,create=True)
+            worker["snapshot"].values[0] = heartbeat
+        if worker["process"] is None: return ## restarted with self.cfg
+        try:
+            worker["control"].send((self.cfg[ip]["configs"],new_layout))
+        except OSError as e: ## worker exiting: check() restarts it with self.cfg
+            logging.warning(f"Mainframe {ip}: new configs not sent to worker pid {worker['process'].pid} ({e})")
+            return
+        logging.info(f"Mainframe {ip}: new configs sent to worker pid {worker['process'].pid}" + (", snapshot layout changed" if new_layout else ""))
+
+    def _stop_workers(self,ips,timeout=30.):
+        for ip in ips:
+            if self.workers[ip]["process"] is not None: self.workers[ip]["process"].terminate()
+        for ip in ips:
+            worker = self.workers.pop(ip)
+            process = worker["process"]
+            if process is not None:
+                worker["control"].close()
+                process.join(timeout)
+                if process.is_alive():
+                    logging.warning(f"Mainframe {ip}: worker pid {process.pid} did not stop in {timeout:.0f} s. Killing it")
+                    process.kill()
+                    process.join()
+            worker["snapshot"].close()
+            worker["snapshot"].unlink()
+            logging.info(f"Mainframe {ip}: worker stopped after {worker['restarts']} restarts")
+
+    def stop(self,timeout=30.):
+        self._stop_workers(list(self.workers),timeout)
@@ -0,0 +1,32 @@
+import os
+import sys
+import pathlib
+import pytest
+
+## The modules in gemcaen/ import each other by name and log to ./logs, as when running main.py from that folder
+GEMCAEN_DIR = pathlib.Path(__file__).parent.parent / "gemcaen"
+sys.path.insert(0,str(GEMCAEN_DIR))
+os.chdir(GEMCAEN_DIR)
+
+from simulator import SimulatedBackend
+
+## helpers shared by the test modules: from tests.conftest import mainframe_cfg, poll
+
+def mainframe_cfg(address="simulated",metadata_cache=False,**simulation):
+    ## MAINFRAME block of a simulated mainframe (SIMULATION keys as keyword arguments), with no call latency unless given
+    simulation = {"LATENCY":0,**simulation}
+    return {"BACKEND":"simulated","SIMULATION":simulation,"METADATA_CACHE":metadata_cache,"CAENHV_BOARD_TYPE":"SY4527","CAENHV_LINK_TYPE":"TCPIP",
+            "CAENHV_BOARD_ADDRESS":address,"CAENHV_USER":"user","CAENHV_PASSWORD":"password"}
+
+def poll(sample,timestamp,**values):
+    ## fills sample as a poll of the board would
+    [ sample.set(quantity,value) for quantity,value in values.items() ]
+    sample.timestamp = timestamp
+    return sample
+
+@pytest.fixture(autouse=True)
+def reset_simulator():
+    ## every test starts with no simulated crates
+    SimulatedBackend.reset()
+    yield
+    SimulatedBackend.reset()
@@ -0,0 +1,36 @@
+import threading
+import numpy as np
+from adaptive_polling import AdaptiveRate, decode_status
+from scheduler import PollScheduler
+
+def test_decode_status():
+    assert decode_status(3) == ["ON","RUP"]
+    assert decode_status(1 | 1 << 9) == ["ON","INTTRIP"]
+
+def test_fast_while_ramping_or_moving():
+    rate = AdaptiveRate("device",[0,1],fast=1.,slow=30.,max_dvdt=1.,hold=10.)
+    stable = {"Status":np.array([1,1]),"VMon":np.array([600.,600.])}
+    assert rate.update(stable,0.) == 30.
+    assert rate.update({"Status":np.array([1,3]),"VMon":np.array([600.,600.])},1.) == 1. ## ramping up
+    assert rate.update(stable,5.) == 1. ## hold
+    assert rate.update(stable,12.) == 30.
+    assert rate.update({"Status":np.array([1,1]),"VMon":np.array([600.,650.])},13.) == 1. ## dV/dt
+    assert rate.update({"Status":np.array([1,np.nan]),"VMon":np.array([600.,np.nan])},30.) == 30. ## failed reads are ignored
+    buffers = rate._previous["VMon"],rate._active
+    assert rate.update({"Status":np.array([1,1]),"VMon":np.array([600.,600.])},31.) == 30.
+    assert rate._previous["VMon"] is buffers[0] and rate._active is buffers[1] ## updated in place
+    assert rate._previous["VMon"].tolist() == [600.,600.]
+    assert rate.update({"Status":np.array([1,1]),"VMon":np.array([600.,600.]),"IMon":np.array([1.,1.])},32.) == 30. ## new layout
+    assert rate.update({"Status":np.array([1,1]),"VMon":np.array([600.,600.]),"IMon":np.array([1.,5.])},33.) == 1. ## dI/dt
+
+class Device:
+    period = 0.
+    calls_per_poll = 4
+
+def test_call_rate_cap():
+    scheduler = PollScheduler(threading.Lock(),threading.Event(),max_call_rate=10)
+    for name in ("a","b","c"): scheduler.add_device(name,Device())
+    due,wait = scheduler.throttle(scheduler.due_devices()[0])
+    assert len(due) == 2 and wait == 0. ## 8 calls out of 10
+    due,wait = scheduler.throttle([("c",0.)])
+    assert due == [] and 0. < wait <= 0.2
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+import alarms
+from alarms import AlarmEngine, parse_alarms
+from sample import Sample, SampleSchema
+from caen_classes import BaseMainframe, GemBoard
+from tests.conftest import mainframe_cfg, poll
+
+MONITORABLES = ["VMon","IMon","Status","Ieq"]
+
+def test_parse_alarms():
+    rules,hook = parse_alarms({"Hook":"notify-send","Rules":[{"Quantity":"IMon","Above":2},{"Name":"trip","Status":["OVC","INTTRIP"],"Actions":["log","safe"],"Safe":{"V0Set":0}}]},MONITORABLES)
+    assert hook == ["notify-send"]
+    assert rules[0].name == "IMon above 2" and rules[0].kind == "threshold"
+    assert rules[1].quantity == "Status" and rules[1].status_mask == 1 << 3 | 1 << 9 and rules[1].safe == {"V0Set":0.}
+    for invalid in ({"Quantity":"IMon"}, ## no condition
+                    {"Quantity":"IMon","Above":2,"Rate":1}, ## two conditions
+                    {"Quantity":"Temp","Above":40}, ## not monitored
+                    {"Status":["TRIPPED"]},
+                    {"Quantity":"IMon","Above":2,"Actions":["safe"]}, ## no Safe setpoints
+                    {"Quantity":"IMon","Above":2,"Actions":["safe"],"Safe":{"VMon":0}},
+                    {"Quantity":"IMon","Above":"2"}):
+        with pytest.raises(ValueError):
+            parse_alarms({"Rules":[invalid]},MONITORABLES)
+
+def test_rules():
+    rules,_ = parse_alarms({"Rules":[{"Name":"overcurrent","Quantity":"IMon","Above":2,"Channels":[1,2]},
+                                     {"Name":"ramp","Quantity":"VMon","Rate":10},
+                                     {"Name":"divider","Quantity":"Ieq","Deviation":20},
+                                     {"Name":"trip","Status":["OVC"]}]},MONITORABLES)
+    engine = AlarmEngine("ME0",rules)
+    sample = Sample(SampleSchema([0,1,2],MONITORABLES,integer=["Status","Ieq"]))
+    assert engine.check(poll(sample,0.,VMon=600.,IMon=[3.,1.,1.],Status=1,Ieq=[700,705,700])) == [] ## channel 0 not checked for overcurrent
+    alarms_raised = engine.check(poll(sample,1.,VMon=[600.,620.,600.],IMon=[3.,3.,1.],Status=[1,9,1],Ieq=[700,750,700]))
+    assert sorted( (a.rule,a.channel) for a in alarms_raised ) == [("divider",1),("overcurrent",1),("ramp",1),("trip",1)]
+    assert all( a.state == "raised" for a in alarms_raised )
+    ## still firing: no new action. A failed read keeps the alarm
+    assert engine.check(poll(sample,2.,VMon=[600.,np.nan,600.],IMon=[3.,3.,1.])) == []
+    cleared = engine.check(poll(sample,3.,VMon=[600.,600.,600.],IMon=[1.,1.,1.],Status=1,Ieq=700))
+    assert sorted( (a.rule,a.state) for a in cleared ) == [("divider","cleared"),("overcurrent","cleared"),("trip","cleared")] ## ramp: no rate after a failed read
+    assert engine.check(poll(sample,4.))[0][1:] == ("ramp",1,"VMon",600.,4.,"cleared")
+    assert engine.n_raised == 4
+
+def test_safe_setpoints_and_notify():
+    cfg = mainframe_cfg(INITIAL={"V0Set":600,"Pw":1})
+    notified = []
+    alarms.add_hook(notified.append)
+    try:
+        with BaseMainframe(cfg) as mainframe:
+            board = GemBoard({"SLOT":0,"LAYER":1},mainframe.handle,mainframe.backend)
+            board.set_monitorables(["VMon","Status"])
+            rules,_ = parse_alarms({"Rules":[{"Name":"trip","Status":["INTTRIP"],"Actions":["notify","safe"],"Safe":{"V0Set":0,"Pw":0}}]},board._monitorables)
+            engine = AlarmEngine("ME0",rules)
+            sample = Sample(board.sample_schema())
+            board.monitor_sample(sample)
+            sample.buffer[1,2] = 1 | 1 << 9 ## tripped channel
+            engine.check(sample,board)
+            assert [ (a.channel,a.state) for a in notified ] == [(2,"raised")]
+            assert [ mainframe.backend.get_channel_parameter(mainframe.handle,0,ch,"Pw") for ch in range(7) ] == [1,1,0,1,1,1,1]
+            assert mainframe.backend.get_channel_parameter(mainframe.handle,0,2,"V0Set") == 0
+    finally:
+        alarms.remove_hook(notified.append)
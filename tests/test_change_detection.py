@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+from sample import Sample, SampleSchema
+from change_detection import DeadbandFilter, parse_deadband
+from tests.conftest import poll
+
+def test_parse_deadband():
+    assert parse_deadband(0.5) == (0.5,0.)
+    assert parse_deadband(" 1% ") == (0.,0.01)
+    for invalid in (-1,"1","abc%",float("nan")):
+        with pytest.raises(ValueError):
+            parse_deadband(invalid)
+
+def test_absolute_deadband():
+    sample = Sample(SampleSchema([0,1],["VMon","IMon"]))
+    change_filter = DeadbandFilter([0,1],{"VMon":0.5},keepalive=60)
+    assert change_filter.update(poll(sample,0.,VMon=600.,IMon=1.)).all() ## first sample: all the fields
+    mask = change_filter.update(poll(sample,1.,VMon=[600.5,600.6],IMon=[1.,1.001]))
+    assert mask.tolist() == [[False,True],[False,True]] ## VMon beyond 0.5 only, IMon on any change
+    ## compared with the last pushed value, not the last read: slow drifts get pushed
+    mask = change_filter.update(poll(sample,2.,VMon=[600.9,600.6],IMon=[1.,1.001]))
+    assert mask.tolist() == [[True,False],[False,False]]
+
+def test_relative_deadband():
+    sample = Sample(SampleSchema([0,1],["IMon"]))
+    change_filter = DeadbandFilter([0,1],{"IMon":"10%"},keepalive=60)
+    change_filter.update(poll(sample,0.,IMon=[1.,-10.]))
+    assert change_filter.update(poll(sample,1.,IMon=[1.09,-11.5])).tolist() == [[False,True]] ## 10% of the absolute value
+    assert change_filter.update(poll(sample,2.,IMon=[0.85,-12.])).tolist() == [[True,False]]
+
+def test_keepalive():
+    sample = Sample(SampleSchema([0],["VMon"]))
+    change_filter = DeadbandFilter([0],{"VMon":10},keepalive=60)
+    change_filter.update(poll(sample,0.,VMon=600.))
+    assert not change_filter.update(poll(sample,59.,VMon=600.)).any()
+    assert change_filter.update(poll(sample,60.,VMon=600.)).all() ## all the fields pushed every keepalive seconds
+    assert not change_filter.update(poll(sample,61.,VMon=600.)).any()
+    assert change_filter.update(poll(sample,120.,VMon=600.)).all()
+
+def test_failed_reads():
+    sample = Sample(SampleSchema([0,1],["VMon","Pw"],integer=["Pw"]))
+    change_filter = DeadbandFilter([0,1],{"VMon":0.5},keepalive=60)
+    mask = change_filter.update(poll(sample,0.,VMon=[600.,np.nan],Pw=[1,1]))
+    assert mask.tolist() == [[True,False],[True,True]] ## a failed read (NaN) is never pushed
+    mask = change_filter.update(poll(sample,1.,VMon=[np.nan,600.],Pw=[1,1]))
+    assert mask.tolist() == [[False,True],[False,False]] ## first good value after a failure
+    ## the last pushed value is kept through a failed read
+    assert change_filter.update(poll(sample,2.,VMon=[600.2,600.],Pw=[1,1])).tolist() == [[False,False],[False,False]]
+    assert change_filter.update(poll(sample,60.,VMon=[np.nan,600.],Pw=[1,0])).tolist() == [[False,True],[True,True]]
+    ## a new sample layout starts from scratch
+    other = Sample(SampleSchema([0],["VMon"]))
+    assert change_filter.update(poll(other,61.,VMon=600.)).tolist() == [[True]]
+
+def test_deadband_filter():
+    sample = Sample(SampleSchema([0,1],["VMon","IMon","Pw"],integer=["Pw"]))
+    change_filter = DeadbandFilter([0,1],{"VMon":0.5,"IMon":"10%"},keepalive=60)
+    mask = change_filter.update(poll(sample,0.,VMon=[600.,600.],IMon=[1.,np.nan],Pw=[1,1]))
+    assert mask.tolist() == [[True,True],[True,False],[True,True]] ## first sample: all the fields read
+    mask = change_filter.update(poll(sample,1.,VMon=[600.4,601.],IMon=[1.05,2.],Pw=[1,0]))
+    assert mask.tolist() == [[False,True],[False,True],[False,True]] ## within deadband, beyond, first good value after a failure
+    mask = change_filter.update(poll(sample,2.,VMon=[np.nan,601.],IMon=[1.2,2.],Pw=[1,0]))
+    assert mask.tolist() == [[False,False],[True,False],[False,False]]
+    assert change_filter.update(poll(sample,61.)).sum() == 5 ## keep-alive: all but the failed read
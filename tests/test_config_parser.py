@@ -0,0 +1,85 @@
+import pytest
+import threading
+import time
+import yaml
+from config_parser import load_config, diff_configs, ConfigWatcher
+from logger_classes import MainframeLogger
+import influx_writer
+from tests.conftest import mainframe_cfg
+
+def setup_cfg(address="simulated",layer=1,**extra):
+    cfg = {"Monitorables":["VMon","IMon"],"HoldOffTime":0.05,"isGEMDetector":True,
+           "MAINFRAME":mainframe_cfg(address),
+           "BOARD":{"SLOT":0,"LAYER":layer},
+           "influxDB":{"DB_BUCKET":"bucket","ORG":"org","TOKEN":"token","URL":"http://localhost:8086","SPOOL_DIR":False}}
+    cfg.update(extra)
+    return cfg
+
+def write(path,setups):
+    path.write_text(yaml.safe_dump(setups))
+    return path
+
+def test_validation(tmp_path):
+    path = write(tmp_path / "config.yml",{"A":setup_cfg(),"B":setup_cfg(HoldOffTime="1"),"C":setup_cfg(HoldOfTime=1),
+                                          "D":setup_cfg(layer=3),"E":setup_cfg(isGEMDetector=False)})
+    cfg = load_config(["A"],path)
+    assert cfg["simulated"]["MAINFRAME"]["CIRCUIT_MAX_FAILURES"] == 3 ## defaults filled in
+    assert "MAX_CALLS_PER_SECOND" not in cfg["simulated"]["MAINFRAME"] ## unset optional keys left out
+    for setup_name,error in (("B","HoldOffTime"),("C","Unknown keys"),("D","LAYER"),("E","CHANNELS"),("F","not found")):
+        with pytest.raises(ValueError,match=error):
+            load_config([setup_name],path)
+
+def test_mainframe_grouping(tmp_path):
+    mainframe_default = setup_cfg(layer=2)
+    mainframe_default["MAINFRAME"]["CIRCUIT_MAX_FAILURES"] = 3
+    path = write(tmp_path / "config.yml",{"A":setup_cfg(),"B":mainframe_default,"C":setup_cfg(address="other"),
+                                          "D":setup_cfg(MAINFRAME={**setup_cfg()["MAINFRAME"],"CIRCUIT_MAX_FAILURES":5})})
+    cfg = load_config(["A","B","C"],path) ## a default value given explicitly is the same config
+    assert list(cfg) == ["simulated","other"]
+    assert list(cfg["simulated"]["configs"]) == ["A","B"]
+    with pytest.raises(ValueError):
+        load_config(["A","D"],path)
+
+def test_diff_configs(tmp_path):
+    path = tmp_path / "config.yml"
+    old = load_config(["A","B","C"],write(path,{"A":setup_cfg(),"B":setup_cfg(layer=2),"C":setup_cfg(address="other")}))
+    assert not diff_configs(old,old)
+    new = load_config(["A","B","D"],write(path,{"A":setup_cfg(HoldOffTime=1),"B":setup_cfg(layer=2),"D":setup_cfg(address="new")}))
+    diff = diff_configs(old,new)
+    assert diff.added == ["new"] and diff.removed == ["other"] and diff.restarted == []
+    assert diff.devices == {"simulated":{"A":new["simulated"]["configs"]["A"]}}
+    write(path,{"A":setup_cfg(),"B":setup_cfg(layer=2,MAINFRAME={**setup_cfg()["MAINFRAME"],"SIMULATION":{"LATENCY":0.01}})})
+    with pytest.raises(ValueError): ## the setups of a mainframe must agree on its MAINFRAME block
+        load_config(["A","B"],path)
+    moved = load_config(["B"],path)
+    assert diff_configs(old,moved).restarted == ["simulated"]
+
+def test_config_watcher(tmp_path):
+    path = write(tmp_path / "config.yml",{"A":setup_cfg()})
+    watcher = ConfigWatcher(path)
+    assert not watcher.changed()
+    write(path,{"A":setup_cfg(HoldOffTime=10)})
+    assert watcher.changed()
+    assert not watcher.changed()
+
+def test_reconfigure_keeps_session(tmp_path):
+    path = tmp_path / "config.yml"
+    cfg = load_config(["A","B"],write(path,{"A":setup_cfg(),"B":setup_cfg(layer=2)}))["simulated"]
+    terminateEvent = threading.Event()
+    mainframe_logger = MainframeLogger(cfg["MAINFRAME"],cfg["configs"],terminateEvent)
+    mainframe_logger.start()
+    try:
+        time.sleep(0.2)
+        handle,device_a = mainframe_logger.mainframe.handle,mainframe_logger.devices["A"]
+        new_cfg = load_config(["B","C"],write(path,{"B":setup_cfg(layer=2,Monitorables=["VMon"]),"C":setup_cfg()}))["simulated"]
+        assert diff_configs({"simulated":cfg},{"simulated":new_cfg}).devices == {"simulated":{"B":new_cfg["configs"]["B"],"C":new_cfg["configs"]["C"],"A":None}}
+        mainframe_logger.reconfigure(new_cfg["configs"])
+        time.sleep(0.3)
+        assert mainframe_logger.mainframe.handle == handle ## same session
+        assert list(mainframe_logger.devices) == ["B","C"]
+        assert mainframe_logger.devices["B"].cfg["Monitorables"] == ["VMon"]
+        assert mainframe_logger.devices["C"].n_polls > 0 and mainframe_logger.devices["C"] is not device_a
+    finally:
+        terminateEvent.set()
+        mainframe_logger.join()
+        influx_writer.close_writers()
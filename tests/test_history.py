@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+from history import HistoryWriter, HistoryReader, segments, device_directory
+
+def fill(writer,n,start=1000.,step=1.):
+    for i in range(n):
+        writer.append({"VMon":np.array([i,i+1,i+2],dtype=np.float64),"IMon":np.array([np.nan,1.,2.])},start + i*step)
+
+def test_query(tmp_path):
+    writer = HistoryWriter(tmp_path,"ME0",[0,1,2],["VMon","IMon"],segment_rows=100)
+    fill(writer,250)
+    reader = HistoryReader(tmp_path,"ME0") ## while the last segment is being written
+    times,arrays = reader.query(1095,1105,["VMon"],[1]) ## across two segments
+    assert list(times) == list(range(1095,1105))
+    assert list(arrays["VMon"][:,0]) == list(range(96,106))
+    times,arrays = reader.query(1240,2000)
+    assert len(times) == 10 and arrays["IMon"].shape == (10,3) and np.isnan(arrays["IMon"][:,0]).all()
+    assert len(reader.query(0,1000)[0]) == 0
+    writer.close()
+
+def test_rotation(tmp_path):
+    writer = HistoryWriter(tmp_path,"ME0",[0,1,2],["VMon","IMon"],segment_rows=100,max_segments=2)
+    fill(writer,250)
+    writer.close()
+    assert len(segments(device_directory(tmp_path,"ME0"))) == 2
+    times,_ = HistoryReader(tmp_path,"ME0").query(0,2000)
+    assert times[0] == 1100 and times[-1] == 1249
+
+def test_downsample(tmp_path):
+    writer = HistoryWriter(tmp_path,"ME0",[0,1,2],["VMon","IMon"],segment_rows=100)
+    fill(writer,100,step=0.5)
+    starts,stats = HistoryReader(tmp_path,"ME0").downsample(1000,1050,10.)
+    assert list(starts) == [1000,1010,1020,1030,1040]
+    assert list(stats["VMon"]["min"][:,0]) == [0,20,40,60,80]
+    assert list(stats["VMon"]["max"][:,2]) == [21,41,61,81,101]
+    assert stats["VMon"]["mean"][0,0] == pytest.approx(9.5)
+    assert np.isnan(stats["IMon"]["mean"][:,0]).all() and (stats["IMon"]["mean"][:,2] == 2).all()
+
+def test_layout_change(tmp_path):
+    writer = HistoryWriter(tmp_path,"ME0",[0,1,2],["VMon","IMon"])
+    fill(writer,10)
+    writer.close()
+    writer = HistoryWriter(tmp_path,"ME0",[1,2],["VMon"]) ## reconfigured device: new segment
+    writer.append({"VMon":np.array([5.,6.])},2000.)
+    writer.close()
+    reader = HistoryReader(tmp_path,"ME0")
+    assert reader.channels == [1,2] and reader.quantities == ["VMon"]
+    times,arrays = reader.query(1000,3000,["VMon","IMon"],[0,1])
+    assert len(times) == 11
+    assert arrays["VMon"][-1,1] == 5 and np.isnan(arrays["VMon"][-1,0]) and np.isnan(arrays["IMon"][-1]).all()
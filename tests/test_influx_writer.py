@@ -0,0 +1,158 @@
+import time
+from influxdb_client.rest import ApiException
+import influx_writer
+from influx_writer import BatchingWriter
+from spool import Spool
+
+class FakeWriteApi:
+    """ write_api of influxdb_client: records the writes, or raises while fail is set. Chunks with a rejected record get a 400 """
+    def __init__(self,latency=0.):
+        self.latency = latency
+        self.fail = False
+        self.rejected = set()
+        self.writes = [] ## (bucket,records)
+        self.n_calls = 0
+    def write(self,bucket,org,record,write_precision):
+        self.n_calls += 1
+        time.sleep(self.latency)
+        if self.fail: raise ConnectionError("influxDB down")
+        if self.rejected.intersection(record): raise ApiException(status=400,reason="field type conflict")
+        self.writes.append((bucket,list(record)))
+
+    @property
+    def records(self):
+        return [ record for _,records in self.writes for record in records ]
+
+def make_writer(latency=0.,**kwargs):
+    writer = BatchingWriter("http://fake","token","org",**kwargs)
+    writer._write_api = FakeWriteApi(latency) ## used by _send instead of an influxdb_client
+    return writer
+
+def wait_for(condition,timeout=5.):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+def records(start,stop):
+    return [ f"m f={i} {i}" for i in range(start,stop) ]
+
+def test_flush_on_batch_size():
+    writer = make_writer(batch_size=3,flush_interval=60)
+    writer.start()
+    try:
+        writer.write("bucket",records(0,2))
+        time.sleep(0.1)
+        assert writer._write_api.writes == [] ## neither full nor old
+        writer.write("bucket",records(2,4))
+        wait_for(lambda: writer.n_written == 3)
+        assert writer._write_api.writes == [("bucket",records(0,3))]
+        assert writer.stats()["queue_depth"] == 1
+    finally:
+        writer.close()
+
+def test_flush_on_age_and_stats():
+    writer = make_writer(latency=0.02,batch_size=100,flush_interval=0.2)
+    writer.write("bucket",records(0,5),sample_time=time.time() - 5)
+    writer.write("other",records(5,7))
+    assert writer.stats()["queue_depth"] == 7 ## not started
+    start = time.time()
+    writer.start()
+    try:
+        wait_for(lambda: writer.n_written == 7)
+        assert time.time() - start >= 0.15
+        assert writer._write_api.writes == [("bucket",records(0,5)),("other",records(5,7))] ## one write per bucket
+        stats = writer.stats()
+        assert stats["queue_depth"] == 0 and stats["written"] == 7 and stats["failed"] == 0
+        assert stats["last_flush_latency"] >= 0.04 and stats["max_flush_latency"] >= stats["last_flush_latency"]
+        assert stats["last_sample_latency"] >= 5 ## oldest point of the batch
+    finally:
+        writer.close()
+
+def test_spool_and_replay(tmp_path):
+    writer = make_writer(batch_size=100,flush_interval=0.05,spool=Spool(tmp_path),retry_interval=0.3,replay_rate=1000)
+    api = writer._write_api
+    api.fail = True
+    writer.start()
+    try:
+        writer.write("bucket",records(0,4))
+        wait_for(lambda: writer.n_spooled == 4)
+        assert writer.stats()["failed"] == 4 and writer.stats()["spool_pending_bytes"] > 0
+        ## DB known to be down: spooled without trying
+        n_calls = api.n_calls
+        writer.write("bucket",records(4,6))
+        wait_for(lambda: writer.n_spooled == 6)
+        assert api.n_calls == n_calls
+        api.fail = False
+        wait_for(lambda: writer.n_replayed == 6)
+        assert api.records == records(0,6)
+        assert writer.spool.pending_bytes == 0
+        ## live points are written again
+        writer.write("bucket",records(6,8))
+        wait_for(lambda: writer.n_written == 2)
+    finally:
+        writer.close()
+
+def test_failed_write_without_spool():
+    writer = make_writer(batch_size=2,flush_interval=60)
+    writer._write_api.fail = True
+    writer.start()
+    try:
+        writer.write("bucket",records(0,2))
+        wait_for(lambda: writer.n_failed == 2)
+        assert writer.n_spooled == 0 and writer.queue_depth == 0
+    finally:
+        writer.close()
+
+def test_close_drains_queue():
+    writer = make_writer(batch_size=100,flush_interval=60)
+    writer.start()
+    writer.write("bucket",records(0,250))
+    writer.close()
+    assert writer._write_api.records == records(0,250)
+    assert [ len(batch) for _,batch in writer._write_api.writes ] == [100,100,50]
+    assert writer.stats()["queue_depth"] == 0
+
+def test_queue_limit():
+    writer = make_writer(max_queue=10)
+    writer.write("bucket",records(0,15))
+    assert writer.stats()["queue_depth"] == 10 and writer.stats()["dropped"] == 5
+    assert [ record for _,record,_,_ in writer._pending ][0] == "m f=5 5" ## oldest dropped
+
+def test_rejected_points_dropped(tmp_path):
+    writer = make_writer(batch_size=100,flush_interval=0.05,spool=Spool(tmp_path),retry_interval=0.3,replay_rate=1000)
+    api = writer._write_api
+    poisoned = records(0,8)[3]
+    api.rejected.add(poisoned)
+    ## DB down: the poisoned point is spooled with good ones
+    api.fail = True
+    writer.start()
+    try:
+        writer.write("bucket",records(0,8))
+        wait_for(lambda: writer.n_spooled == 8)
+        writer.write("bucket",records(8,10)) ## good points spooled after the poisoned chunk
+        wait_for(lambda: writer.n_spooled == 10)
+        api.fail = False
+        ## replay drops the rejected point and commits past it: the following points are replayed
+        wait_for(lambda: writer.spool.pending_bytes == 0)
+        assert writer.n_replayed == 9 and writer.n_dropped == 1
+        assert sorted(api.records) == sorted( record for record in records(0,10) if record != poisoned )
+        ## live batch with a rejected point: the others are written, nothing is spooled and the DB is not considered down
+        api.rejected.add("m f=12 12")
+        writer.write("bucket",records(10,15))
+        wait_for(lambda: writer.n_written == 4)
+        assert writer.n_dropped == 2 and writer.n_spooled == 10 and writer._db_down_until < time.time()
+    finally:
+        writer.close()
+
+def test_get_writer_spool_dir(tmp_path,monkeypatch):
+    monkeypatch.setattr(influx_writer,"SPOOL_PATH",tmp_path / "default")
+    cfg = {"URL":"http://fake","ORG":"org","TOKEN":"token"}
+    try:
+        for spool_dir,expected in ((True,tmp_path / "default"),(str(tmp_path / "custom"),tmp_path / "custom"),(None,tmp_path / "default")):
+            writer = influx_writer.get_writer({**cfg,"SPOOL_DIR":spool_dir} if spool_dir is not None else cfg)
+            assert writer.spool.directory == expected / "http___fake_org"
+            influx_writer.close_writers()
+        assert influx_writer.get_writer({**cfg,"SPOOL_DIR":False}).spool is None
+    finally:
+        influx_writer.close_writers()
@@ -0,0 +1,31 @@
+import influxdb_client
+import numpy as np
+import pytest
+from line_protocol import LineSerializer, escape_key
+from sample import Sample, SampleSchema
+
+def make_sample(channels,quantities,integer,values,timestamp):
+    sample = Sample(SampleSchema(channels,quantities,integer))
+    sample.buffer[:] = values
+    sample.timestamp = timestamp
+    return sample
+
+def test_one_record_per_channel():
+    serializer = LineSerializer("HV",{0:"G3Bot",1:"G3Top",2:"G2Bot"})
+    sample = make_sample([0,1,2],["VMon","IMon","Pw"],["Pw"],[[600.25,np.nan,599.],[1.5,np.nan,np.nan],[1,0,1]],1700000000.123456)
+    mask = np.array([[True,False,True],[True,False,False],[True,False,False]])
+    assert serializer.serialize(sample,mask) == ["HV,ChannelName=G3Bot VMon=600.25,IMon=1.5,Pw=1i 1700000000123456000",
+                                                 "HV,ChannelName=G2Bot VMon=599 1700000000123456000"]
+    assert len(serializer.serialize(sample)) == 3 ## no mask: every field read without failures
+    ## same fields and types as one influxdb_client.Point per field
+    for quantity,value in (("VMon",600.25),("Pw",1)):
+        point = influxdb_client.Point("HV").tag("ChannelName","G3Bot").field(quantity,value).to_line_protocol()
+        assert point.split(" ")[1] in serializer.serialize(sample)[0]
+
+def test_escaping_and_precision():
+    serializer = LineSerializer("CAEN_Board_Monitor",{18:"LV ch,18=a"},precision="ms")
+    sample = make_sample([18],["VMon"],[],[[8.]],1700000000.1234)
+    assert serializer.serialize(sample) == ["CAEN_Board_Monitor,ChannelName=LV\\ ch\\,18\\=a VMon=8 1700000000123"]
+    assert escape_key("a\\") == "a\\ "
+    with pytest.raises(ValueError):
+        LineSerializer("HV",{},precision="m")
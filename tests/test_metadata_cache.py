@@ -0,0 +1,33 @@
+import json
+import multiprocessing
+import pytest
+from metadata_cache import MetadataCache
+
+CRATE_MAP = {"models":["A1515"],"serial_numbers":[1],"firmware_releases":["1.0"]}
+
+def save_channels(path,process,n_saves):
+    ## one mainframe per worker process, all saving the same file
+    cache = MetadataCache(f"mainframe{process}",path)
+    for ch in range(n_saves):
+        cache.set_channel(0,CRATE_MAP,ch,f"CH{ch}",["VMon"])
+        cache.save()
+
+@pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(),reason="forked workers, as main.py --processes")
+def test_concurrent_saves(tmp_path):
+    path = tmp_path / "metadata.json"
+    context = multiprocessing.get_context("fork")
+    processes = [ context.Process(target=save_channels,args=(path,process,20)) for process in range(6) ]
+    [ process.start() for process in processes ]
+    [ process.join() for process in processes ]
+    assert [ process.exitcode for process in processes ] == [0]*6
+    entries = json.loads(path.read_text()) ## valid json
+    assert sorted(entries) == [ f"mainframe{process}/0/A1515/1/1.0" for process in range(6) ]
+    assert { key:sorted(map(int,channels)) for key,channels in entries.items() } == { key:list(range(20)) for key in entries }
+    assert [ p.name for p in tmp_path.iterdir() if p.suffix == ".tmp" ] == []
+
+def test_save_failure_ignored(tmp_path):
+    (tmp_path / "cache").write_text("") ## a file where the cache folder should be
+    cache = MetadataCache("mainframe",tmp_path / "cache" / "metadata.json")
+    cache.set_channel(0,CRATE_MAP,0,"CH0",["VMon"])
+    cache.save()
+    assert cache.get_channel(0,CRATE_MAP,0) == ("CH0",["VMon"])
@@ -0,0 +1,39 @@
+import time
+import pytest
+from metrics import Registry
+
+def test_render_histogram():
+    registry = Registry()
+    for value in (0.0002,0.003,0.003,20.):
+        registry.observe("gemcaen_poll_seconds",value,help_text="Time to read a device",device="ME0")
+    lines = registry.render().splitlines()
+    assert lines[:2] == ["# HELP gemcaen_poll_seconds Time to read a device","# TYPE gemcaen_poll_seconds histogram"]
+    buckets = [ line for line in lines if line.startswith("gemcaen_poll_seconds_bucket") ]
+    assert buckets[0] == 'gemcaen_poll_seconds_bucket{device="ME0",le="0.0005"} 1'
+    assert buckets[3] == 'gemcaen_poll_seconds_bucket{device="ME0",le="0.005"} 3' ## cumulative
+    assert buckets[-2] == 'gemcaen_poll_seconds_bucket{device="ME0",le="10.0"} 3'
+    assert buckets[-1] == 'gemcaen_poll_seconds_bucket{device="ME0",le="+Inf"} 4'
+    counts = [ int(line.rsplit(" ",1)[1]) for line in buckets ]
+    assert counts == sorted(counts)
+    assert 'gemcaen_poll_seconds_count{device="ME0"} 4' in lines
+    assert float(next( line for line in lines if line.startswith("gemcaen_poll_seconds_sum") ).rsplit(" ",1)[1]) == pytest.approx(20.0062)
+
+def test_render_counters_and_escaping():
+    registry = Registry()
+    registry.inc("gemcaen_backend_errors_total",help_text="Failed mainframe calls",mainframe="a",call="init_system")
+    registry.inc("gemcaen_backend_errors_total",2,mainframe="a",call="init_system")
+    registry.set_gauge("gemcaen_db_queue_depth",7,url='http://db\\"x"\nbis')
+    text = registry.render()
+    assert "# TYPE gemcaen_backend_errors_total counter\n" in text
+    assert 'gemcaen_backend_errors_total{call="init_system",mainframe="a"} 3\n' in text
+    assert 'gemcaen_db_queue_depth{url="http://db\\\\\\"x\\"\\nbis"} 7\n' in text
+
+def test_timer():
+    registry = Registry()
+    with registry.timer("gemcaen_updatedb_seconds",device="ME0"):
+        time.sleep(0.01)
+    with pytest.raises(RuntimeError):
+        with registry.timer("gemcaen_updatedb_seconds",device="ME0"):
+            raise RuntimeError ## observed also when the block raises
+    histogram = registry._histograms[("gemcaen_updatedb_seconds",(("device","ME0"),))]
+    assert histogram.count == 2 and histogram.sum >= 0.01
@@ -0,0 +1,16 @@
+import numpy as np
+from sample import Sample, SampleSchema
+from tests.conftest import poll
+
+def test_sample():
+    sample = Sample(SampleSchema([7,8],["VMon","Pw"],integer=["Pw"]))
+    assert list(sample) == ["VMon","Pw"] and "Pw" in sample and sample.get("IMon") is None
+    poll(sample,1.,VMon=[600.5,np.nan],Pw=[1,0])
+    assert sample["VMon"].base is sample.buffer ## rows are views of the buffer
+    assert sample.tolist("VMon") == [600.5,None] and sample.tolist("Pw") == [1,0]
+    assert sample.value(1,0) == 1 and isinstance(sample.value(1,0),int) and sample.value(0,1) is None
+    arrays = sample.arrays()
+    assert arrays["Pw"].dtype == np.int64 and arrays["VMon"].dtype == np.float64
+    kept = sample.copy()
+    poll(sample,2.,VMon=0.)
+    assert kept.timestamp == 1. and kept["VMon"][0] == 600.5
@@ -0,0 +1,188 @@
+import threading
+import time
+import pytest
+import scheduler
+from scheduler import PollScheduler
+from simulator import SimulatedBackend
+from caen_classes import BaseMainframe, BaseBoard, CircuitBreaker
+from tests.conftest import mainframe_cfg
+
+class Clock:
+    """ time.monotonic of the scheduler, moved by the test """
+    def __init__(self):
+        self.now = 100.
+    def __call__(self):
+        return self.now
+
+class CountingLock:
+    def __init__(self):
+        self.n_acquired = 0
+    def __enter__(self):
+        self.n_acquired += 1
+    def __exit__(self,*args):
+        pass
+
+class FakeDevice:
+    """ device with .period, .poll(), .process(sample) and .calls_per_poll, as DeviceLogger """
+    def __init__(self,period,clock):
+        self.period = period
+        self.clock = clock
+        self.polls = [] ## clock at every poll
+        self.processed = []
+        self.calls_per_poll = 1
+    def poll(self):
+        self.polls.append(self.clock.now)
+        return len(self.polls)
+    def process(self,sample):
+        self.processed.append(sample)
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(scheduler.time,"monotonic",clock)
+    return clock
+
+def run_due(poll_scheduler):
+    due,_ = poll_scheduler.due_devices()
+    if due: poll_scheduler.run_pass(due)
+    return sorted( name for name,_ in due )
+
+def test_merge_due_devices(clock):
+    lock = CountingLock()
+    poll_scheduler = PollScheduler(lock,threading.Event(),merge_window=0.05)
+    devices = { "A":FakeDevice(1.,clock), "B":FakeDevice(1.,clock), "C":FakeDevice(5.,clock) }
+    poll_scheduler.add_device("A",devices["A"])
+    poll_scheduler.add_device("C",devices["C"])
+    clock.now += 0.03
+    poll_scheduler.add_device("B",devices["B"])
+    assert run_due(poll_scheduler) == ["A","B","C"] and lock.n_acquired == 1 ## one pass, one lock
+    assert poll_scheduler.due_devices() == ([],pytest.approx(0.97))
+    ## A falls due, B within the merge window: read together. C is not due
+    clock.now += 0.97
+    assert run_due(poll_scheduler) == ["A","B"] and lock.n_acquired == 2
+    assert [ len(device.polls) for device in devices.values() ] == [2,2,1]
+    assert devices["A"].processed == [1,2]
+    ## B polled early keeps its own grid
+    assert poll_scheduler._next_due["B"] == pytest.approx(poll_scheduler._next_due["A"] + 0.03)
+    assert poll_scheduler.deadline_misses == {"A":0,"B":0,"C":0}
+
+def test_late_polls_dropped(clock):
+    poll_scheduler = PollScheduler(CountingLock(),threading.Event())
+    device = FakeDevice(1.,clock)
+    poll_scheduler.add_device("A",device)
+    start = clock.now
+    run_due(poll_scheduler)
+    ## the pass comes 2.5 periods late: one poll, the 2 that fell due meanwhile are dropped
+    clock.now = start + 3.5
+    assert run_due(poll_scheduler) == ["A"]
+    assert device.polls == [start,start + 3.5]
+    assert poll_scheduler.deadline_misses["A"] == 2
+    assert poll_scheduler.max_lateness["A"] == pytest.approx(2.5)
+    ## next deadline on the original grid
+    assert poll_scheduler._next_due["A"] == pytest.approx(start + 4)
+    ## late by less than a period: polled, not a miss
+    clock.now = start + 4.9
+    assert run_due(poll_scheduler) == ["A"]
+    assert poll_scheduler.deadline_misses["A"] == 2
+    assert poll_scheduler._next_due["A"] == pytest.approx(start + 5)
+
+def test_deadline_misses_per_device(clock):
+    poll_scheduler = PollScheduler(CountingLock(),threading.Event())
+    fast,slow = FakeDevice(0.5,clock),FakeDevice(10.,clock)
+    poll_scheduler.add_device("fast",fast)
+    poll_scheduler.add_device("slow",slow)
+    start = clock.now
+    run_due(poll_scheduler)
+    for lateness in (0.6,1.6,0.1): ## a hung pass delays all the due devices
+        clock.now = poll_scheduler._next_due["fast"] + lateness
+        run_due(poll_scheduler)
+    assert poll_scheduler.deadline_misses == {"fast":1 + 3 + 0,"slow":0}
+    assert len(fast.polls) == 4 and len(slow.polls) == 1
+    assert poll_scheduler.max_lateness["fast"] == pytest.approx(1.6)
+    poll_scheduler.remove_device("fast")
+    clock.now = start + 10
+    assert run_due(poll_scheduler) == ["slow"]
+
+## communication errors: circuit breaker of the mainframe and re-login
+
+def test_circuit_breaker_backoff(clock):
+    breaker = CircuitBreaker("test",max_failures=3,base_delay=1.,max_delay=5.)
+    assert breaker.allow() and not breaker.is_open
+    delays = []
+    for _ in range(5):
+        breaker.record_failure("timeout")
+        delays.append(breaker.time_to_retry())
+        assert not breaker.allow()
+    assert delays == [1.,2.,4.,5.,5.] ## doubled at every failure, capped at max_delay
+    clock.now += 4.9
+    assert not breaker.allow()
+    clock.now += 0.1
+    assert breaker.allow() and breaker.time_to_retry() == 0.
+    assert breaker.is_open and breaker.n_opened == 1 ## opened once, at the 3rd failure
+    breaker.record_success()
+    assert not breaker.is_open and breaker.failures == 0 and breaker.allow()
+    breaker.record_failure("timeout")
+    assert breaker.time_to_retry() == 1. ## backoff restarts from base_delay
+    for _ in range(2): breaker.record_failure("timeout")
+    assert breaker.n_opened == 2
+
+class BoardDevice(FakeDevice):
+    """ reads VMon of one simulated channel, with the handle of the mainframe as DeviceLogger.poll """
+    def __init__(self,period,mainframe):
+        super().__init__(period,Clock())
+        self.mainframe = mainframe
+        self.board = BaseBoard({"SLOT":0,"CHANNELS":[0]},mainframe.handle,mainframe.backend)
+    def poll(self):
+        self.board.handle = self.mainframe.handle
+        return self.board.monitor_arrays(["VMon"])
+
+def wait_for(condition,timeout=5.):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+@pytest.fixture
+def running_scheduler():
+    ## simulated mainframe polled every 10 ms by a PollScheduler thread, short backoff
+    terminateEvent = threading.Event()
+    with BaseMainframe({**mainframe_cfg(),"RETRY_BASE_DELAY":0.01,"RETRY_MAX_DELAY":0.04}) as mainframe:
+        poll_scheduler = PollScheduler(threading.Lock(),terminateEvent,mainframe=mainframe,reconnect_after=2)
+        device = BoardDevice(0.01,mainframe)
+        poll_scheduler.add_device("A",device)
+        thread = threading.Thread(target=poll_scheduler.run)
+        thread.start()
+        try:
+            wait_for(lambda: len(device.processed) > 0)
+            yield poll_scheduler,mainframe,device
+        finally:
+            terminateEvent.set()
+            thread.join()
+
+def test_relogin_after_failures(running_scheduler,monkeypatch):
+    poll_scheduler,mainframe,device = running_scheduler
+    relogins = [] ## consecutive failures at each re-login
+    reconnect = mainframe.reconnect
+    def counting_reconnect():
+        relogins.append(mainframe.breaker.failures)
+        return reconnect()
+    monkeypatch.setattr(mainframe,"reconnect",counting_reconnect)
+    handle = mainframe.handle
+    mainframe.backend.drop_sessions("simulated")
+    wait_for(lambda: mainframe.handle != handle and mainframe.breaker.failures == 0)
+    assert relogins == [2] ## once, after reconnect_after failures
+    n_processed = len(device.processed)
+    wait_for(lambda: len(device.processed) > n_processed) ## polling again on the new session
+
+def test_circuit_opens_and_closes(running_scheduler):
+    poll_scheduler,mainframe,device = running_scheduler
+    crate = SimulatedBackend.crate("simulated")
+    crate.error_rate = 1. ## every call fails, logins too
+    wait_for(lambda: mainframe.breaker.is_open)
+    assert mainframe.breaker.n_opened == 1
+    n_processed = len(device.processed)
+    time.sleep(0.05)
+    assert len(device.processed) == n_processed
+    crate.error_rate = 0.
+    wait_for(lambda: len(device.processed) > n_processed)
+    assert not mainframe.breaker.is_open and mainframe.breaker.n_opened == 1
@@ -0,0 +1,79 @@
+import pytest
+from simulator import SimulatedBackend
+from caen_classes import BaseMainframe, GemBoard
+from setpoints import apply_setpoints
+from tests.conftest import mainframe_cfg as simulated_cfg
+
+def mainframe_cfg(address,**simulation):
+    ## channels on at 600 V, fast ramps
+    return simulated_cfg(address,**{"INITIAL":{"V0Set":600,"Pw":1,"RUp":1000,"RDWn":1000},**simulation})
+
+def gem_cfg(layer):
+    return {"BOARD":{"SLOT":0,"LAYER":layer},"isGEMDetector":True,"Monitorables":["VMon"],"HoldOffTime":1}
+
+def test_set_Ieq_not_interactive():
+    with BaseMainframe(mainframe_cfg("simulated")) as mainframe:
+        board = GemBoard({"SLOT":0,"LAYER":1},mainframe.handle,mainframe.backend)
+        [ board.quantity_dtype(quantity) for quantity in ("VMon","Pw","V0Set") ] ## probed on first use
+        n_calls = SimulatedBackend.crate("simulated").n_calls
+        targets = board.set_Ieq(700)
+        assert SimulatedBackend.crate("simulated").n_calls - n_calls == 2 + 7 ## monitor (VMon,Pw) + one write per distinct V0Set
+        assert [ mainframe.backend.get_channel_parameter(mainframe.handle,0,ch,"V0Set") for ch in range(7) ] == [ targets[ch] for ch in range(7) ]
+        assert all( board.channel_IEq(ch,targets[ch]) in (699,700) for ch in range(7) )
+
+def test_bulk_write():
+    with BaseMainframe(mainframe_cfg("simulated")) as mainframe:
+        board = GemBoard({"SLOT":0,"LAYER":2},mainframe.handle,mainframe.backend)
+        board.quantity_dtype("V0Set")
+        n_calls = SimulatedBackend.crate("simulated").n_calls
+        board.set_channels_value("V0Set",{ ch:500 for ch in range(7,14) })
+        assert SimulatedBackend.crate("simulated").n_calls - n_calls == 1
+        with pytest.raises(ValueError):
+            board.set_channels_value("V0Set",{0:500}) ## not a channel of the layer
+
+def test_bulk_write_fallback():
+    with BaseMainframe(mainframe_cfg("simulated",BULK_SUPPORTED=False)) as mainframe:
+        board = GemBoard({"SLOT":0,"LAYER":1},mainframe.handle,mainframe.backend)
+        board.set_channels_value("Pw",{ ch:0 for ch in range(7) })
+        assert [ mainframe.backend.get_channel_parameter(mainframe.handle,0,ch,"Pw") for ch in range(7) ] == [0]*7
+
+def test_apply_setpoints():
+    cfg = {"a":{"MAINFRAME":mainframe_cfg("a"),"configs":{"A1":gem_cfg(1),"A2":gem_cfg(2)}},
+           "b":{"MAINFRAME":mainframe_cfg("b"),"configs":{"B1":gem_cfg(1)}}}
+    results = apply_setpoints(cfg,{"A1":{"Ieq":700},"A2":{"V0Set":{7:500,8:500},"Pw":{9:0}},"B1":{"I0Set":10.}},timeout=5,poll_interval=0.05)
+    assert [ (r.setup,r.channel,r.quantity) for r in results if r.setup == "A2" ] == [("A2",7,"V0Set"),("A2",8,"V0Set"),("A2",9,"Pw")]
+    assert len(results) == 7 + 3 + 7
+    assert all( r.status == "reached" for r in results )
+    assert all( abs(r.readback - r.target) <= 2 for r in results if r.quantity == "V0Set" )
+
+def test_setpoints_timeout_and_errors():
+    cfg = {"slow":{"MAINFRAME":mainframe_cfg("slow",INITIAL={"V0Set":600,"Pw":1,"RUp":1}),"configs":{"S":gem_cfg(1)}},
+           "down":{"MAINFRAME":mainframe_cfg("down",ERROR_RATE=1),"configs":{"D":gem_cfg(1)}}}
+    results = apply_setpoints(cfg,{"S":{"V0Set":{0:700}},"D":{"Pw":1}},timeout=0.2,poll_interval=0.05)
+    status = { r.setup:r.status for r in results }
+    assert status == {"S":"timeout","D":"error"}
+    with pytest.raises(ValueError):
+        apply_setpoints(cfg,{"S":{"VMon":1}})
+    SimulatedBackend.reset()
+    planned = apply_setpoints(cfg,{"S":{"V0Set":{0:700}}},dry_run=True)
+    assert planned[0].status == "planned" and planned[0].readback == 600
+
+def test_setpoints_checked_before_writing():
+    cfg = {"a":{"MAINFRAME":mainframe_cfg("a"),"configs":{"A1":gem_cfg(1)}},
+           "b":{"MAINFRAME":mainframe_cfg("b"),"configs":{"B1":{**gem_cfg(1),"isGEMDetector":False,"BOARD":{"SLOT":0,"CHANNELS":[0,1]}}}}}
+    for targets in ({"A1":{"V0Set":500},"B1":{"Ieq":700}}, ## not a GEM detector
+                    {"A1":{"V0Set":{7:500}}}, ## not a channel of the layer
+                    {"B1":{"Pw":{2:0}}},
+                    {"A1":{"V0Set":"500"}}):
+        with pytest.raises(ValueError):
+            apply_setpoints(cfg,targets,timeout=1,poll_interval=0.05)
+    assert "a" not in SimulatedBackend._crates and "b" not in SimulatedBackend._crates ## no mainframe contacted
+
+def test_setpoints_board_errors_kept():
+    ## the board of B1 is not a GEM board: error result for B1, the writes on the other mainframe are reported
+    cfg = {"a":{"MAINFRAME":mainframe_cfg("a"),"configs":{"A1":gem_cfg(1)}},
+           "b":{"MAINFRAME":mainframe_cfg("b",BOARDS={0:{"MODEL":"A1520","CHANNELS":14}}),"configs":{"B1":gem_cfg(1)}}}
+    results = apply_setpoints(cfg,{"A1":{"V0Set":500},"B1":{"Ieq":700}},timeout=5,poll_interval=0.05)
+    assert [ r.status for r in results if r.setup == "A1" ] == ["reached"]*7
+    assert [ (r.channel,r.status) for r in results if r.setup == "B1" ] == [(-1,"error")]
+    assert "GEM" in results[-1].error
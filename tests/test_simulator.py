@@ -0,0 +1,129 @@
+import pytest
+import threading
+import numpy as np
+from simulator import SimulatedBackend
+from backends import BackendError, SubscriptionNotSupported
+from caen_classes import BaseMainframe, BaseBoard, GemBoard
+from event_acquisition import EventAcquisition
+from tests.conftest import mainframe_cfg
+
+def test_gem_board_monitor():
+    with BaseMainframe(mainframe_cfg(LATENCY=0,INITIAL={"V0Set":600,"Pw":1})) as mainframe:
+        board = GemBoard({"SLOT":0,"LAYER":2},mainframe.handle,mainframe.backend)
+        board.set_monitorables(["VMon","Pw","Ieq"])
+        monitored_data = board.monitor()
+    assert list(monitored_data.keys()) == list(range(7,14))
+    assert monitored_data[7]["Pw"] == 1
+    assert monitored_data[7]["VMon"] == pytest.approx(600,abs=1)
+    assert monitored_data[7]["Ieq"] == board.channel_IEq(7,monitored_data[7]["VMon"])
+
+def test_bulk_read_single_call():
+    with BaseMainframe(mainframe_cfg(LATENCY=0)) as mainframe:
+        board = BaseBoard({"SLOT":0,"CHANNELS":[0,1,2,3]},mainframe.handle,mainframe.backend)
+        board.fetch_quantity("VMon") ## first read probes the value type
+        crate = SimulatedBackend.crate("simulated")
+        n_calls = crate.n_calls
+        values = board.fetch_quantity("VMon")
+        assert len(values) == 4
+        assert crate.n_calls - n_calls == 1
+
+def test_derived_quantities_no_extra_reads():
+    with BaseMainframe(mainframe_cfg(LATENCY=0,INITIAL={"V0Set":600,"Pw":1})) as mainframe:
+        board = GemBoard({"SLOT":0,"LAYER":1},mainframe.handle,mainframe.backend)
+        board.monitor_arrays(["VMon","Ieq"]) ## first read probes the value type
+        crate = SimulatedBackend.crate("simulated")
+        for quantities in (["VMon","Ieq"],["Ieq"]):
+            n_calls = crate.n_calls
+            monitored_arrays = board.monitor_arrays(quantities)
+            assert crate.n_calls - n_calls == 1 ## VMon read once, with a single call
+            assert list(monitored_arrays) == quantities
+        assert monitored_arrays["Ieq"].dtype == np.int64
+
+def test_bulk_read_fallback():
+    with BaseMainframe(mainframe_cfg(LATENCY=0,BULK_SUPPORTED=False)) as mainframe:
+        board = BaseBoard({"SLOT":0,"CHANNELS":[0,1,2,3]},mainframe.handle,mainframe.backend)
+        assert len(board.fetch_quantity("Pw")) == 4
+        assert "Pw" in board._bulk_rejected
+        assert board.fetch_quantity("Pw").tolist() == [0,0,0,0]
+
+def test_bulk_read_transient_error(monkeypatch):
+    ## a communication error on the multi-channel read is retried per channel, the next read is a single call again
+    failures = [BackendError("communication error")]
+    bulk_read = SimulatedBackend.get_channels_parameter
+    def flaky_read(self,*args,**kwargs):
+        if failures: raise failures.pop()
+        return bulk_read(self,*args,**kwargs)
+    monkeypatch.setattr(SimulatedBackend,"get_channels_parameter",flaky_read)
+    with BaseMainframe(mainframe_cfg(LATENCY=0)) as mainframe:
+        board = BaseBoard({"SLOT":0,"CHANNELS":[0,1,2,3]},mainframe.handle,mainframe.backend)
+        assert len(board.fetch_quantity("VMon")) == 4 and not failures
+        assert board._bulk_rejected == set() and board.calls_per_poll(["VMon"]) == 1
+        n_calls = SimulatedBackend.crate("simulated").n_calls
+        board.fetch_quantity("VMon")
+        assert SimulatedBackend.crate("simulated").n_calls - n_calls == 1
+
+def test_errors_and_lost_sessions():
+    backend = SimulatedBackend({"LATENCY":0,"ERROR_RATE":1.})
+    with pytest.raises(BackendError):
+        backend.init_system("SY4527","TCPIP","simulated","user","password")
+    backend = SimulatedBackend({"LATENCY":0})
+    handle = backend.init_system("SY4527","TCPIP","other","user","password")
+    backend.drop_sessions("other")
+    with pytest.raises(BackendError):
+        backend.get_crate_map(handle)
+
+def test_metadata_cache(tmp_path):
+    cache_path = str(tmp_path / "metadata.json")
+    with BaseMainframe(mainframe_cfg(metadata_cache=cache_path,LATENCY=0)) as mainframe:
+        board = GemBoard({"SLOT":0,"LAYER":1},mainframe.handle,mainframe.backend,mainframe.get_crate_map(),mainframe.metadata_cache)
+        assert sorted(board.channel_names_map) == list(range(7)) ## only the configured channels are mapped
+    with BaseMainframe(mainframe_cfg(metadata_cache=cache_path,LATENCY=0)) as mainframe:
+        crate = SimulatedBackend.crate("simulated")
+        n_calls = crate.n_calls
+        cached_board = GemBoard({"SLOT":0,"LAYER":1},mainframe.handle,mainframe.backend,mainframe.get_crate_map(),mainframe.metadata_cache)
+        assert crate.n_calls - n_calls == 1 ## the crate map only
+        assert cached_board.channel_names_map == board.channel_names_map
+
+def test_reconnect_after_lost_session():
+    with BaseMainframe(mainframe_cfg(LATENCY=0)) as mainframe:
+        board = BaseBoard({"SLOT":0,"CHANNELS":[0]},mainframe.handle,mainframe.backend)
+        mainframe.backend.drop_sessions("simulated")
+        with pytest.raises(BackendError):
+            board.monitor_arrays(["VMon"])
+        board.handle = mainframe.reconnect()
+        assert board.monitor_arrays(["VMon"])["VMon"].tolist() == [0.]
+
+class EventDevice:
+    """ minimal device for EventAcquisition """
+    def __init__(self,board):
+        self.board = board
+        self.cfg = {"Monitorables":["VMon","Pw","Ieq"]}
+        self.period = 60.
+        self.n_polls = 0
+        self.samples = []
+    def process(self,sample):
+        self.samples.append(sample.arrays())
+
+def test_event_acquisition():
+    with BaseMainframe(mainframe_cfg(LATENCY=0,INITIAL={"V0Set":600,"Pw":1})) as mainframe:
+        device = EventDevice(GemBoard({"SLOT":0,"LAYER":1},mainframe.handle,mainframe.backend))
+        acquisition = EventAcquisition(threading.Lock(),threading.Event(),mainframe)
+        acquisition.add_device("device",device)
+        with acquisition.lock:
+            acquisition.subscribe()
+        acquisition.resync(["device"])
+        assert list(device.samples[-1]) == ["VMon","Pw","Ieq"]
+        crate = SimulatedBackend.crate("simulated")
+        n_calls = crate.n_calls
+        mainframe.backend.set_channel_parameter(mainframe.handle,0,2,"Pw",0)
+        events = mainframe.backend.get_events(mainframe.handle,1.)
+        assert (0,2,"Pw",0) in events
+        assert acquisition.apply(events) == {"device"}
+        acquisition.process("device",0.)
+        assert device.samples[-1]["Pw"].tolist() == [1,1,0,1,1,1,1]
+        assert crate.n_calls - n_calls == 1 ## only the set: the change came as an event
+
+def test_events_not_supported():
+    with BaseMainframe(mainframe_cfg(LATENCY=0,EVENTS_SUPPORTED=False)) as mainframe:
+        with pytest.raises(SubscriptionNotSupported):
+            mainframe.backend.subscribe_channel_parameters(mainframe.handle,0,[0],["VMon"])
@@ -0,0 +1,31 @@
+import numpy as np
+from snapshot import SharedSnapshot, device_schema
+
+def test_publish_and_read(tmp_path):
+    schema = {"devices":[{"name":"board_0","channels":[0,1,2],"quantities":["VMon","Pw"]},
+                         {"name":"board_1","channels":[7],"quantities":["IMon"]}]}
+    writer = SharedSnapshot(f"gemcaen_test_{tmp_path.name}",schema,create=True)
+    try:
+        reader = SharedSnapshot(writer.name) ## schema read from the shared memory
+        assert reader.devices == ["board_0","board_1"]
+        writer.publish("board_0",{"VMon":np.array([1.,2.,3.]),"Pw":np.array([1,0,1])},100.)
+        timestamp,arrays = reader.read("board_0")
+        assert timestamp == 100.
+        assert arrays["VMon"].tolist() == [1.,2.,3.]
+        assert arrays["Pw"].tolist() == [1.,0.,1.]
+        assert np.isnan(reader.read("board_1")[1]["IMon"]).all()
+        ## a writer killed while writing leaves an odd sequence: the next publish recovers it
+        writer._blocks["board_1"][0][0] += 1
+        writer.publish("board_1",{"IMon":np.array([5.])},101.)
+        assert reader.read("board_1")[1]["IMon"].tolist() == [5.]
+        reader.close()
+    finally:
+        writer.close()
+        writer.unlink()
+
+def test_device_schema():
+    ## a GEM setup polls the channels of its layer, also if it lists CHANNELS
+    gem_cfg = {"isGEMDetector":True,"Monitorables":["VMon","Ieq"],"BOARD":{"SLOT":0,"LAYER":2,"CHANNELS":[18]}}
+    assert device_schema("ME0",gem_cfg) == {"name":"ME0","channels":list(range(7,14)),"quantities":["VMon","Ieq"]}
+    lv_cfg = {"isGEMDetector":False,"Monitorables":["VMon"],"BOARD":{"SLOT":5,"CHANNELS":[18]}}
+    assert device_schema("LV",lv_cfg)["channels"] == [18]
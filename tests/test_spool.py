@@ -0,0 +1,31 @@
+from spool import Spool
+
+def test_append_replay_and_restart(tmp_path):
+    spool = Spool(tmp_path,segment_bytes=100)
+    spool.append("bucket",[f"m f={i} {i}" for i in range(10)])
+    spool.append("bucket",[f"m f={i} {i}" for i in range(10,20)])
+    entries,cursor = spool.read(5)
+    assert [ line for _,line in entries ] == [f"m f={i} {i}" for i in range(5)]
+    spool.commit(cursor)
+    ## a new spool on the same folder resumes from the saved cursor
+    spool = Spool(tmp_path,segment_bytes=100)
+    replayed = []
+    while spool.pending_bytes:
+        entries,cursor = spool.read(3)
+        replayed += [ line for _,line in entries ]
+        spool.commit(cursor)
+    assert replayed == [f"m f={i} {i}" for i in range(5,20)]
+
+def test_eviction(tmp_path):
+    spool = Spool(tmp_path,max_bytes=200,segment_bytes=50)
+    for i in range(20):
+        spool.append("bucket",[f"m f={i} {i}"])
+    assert spool.total_bytes <= 200 + 50
+    assert spool.n_evicted > 0
+    replayed = []
+    while spool.pending_bytes:
+        entries,cursor = spool.read(100)
+        replayed += entries
+        spool.commit(cursor)
+    assert replayed[-1] == ("bucket","m f=19 19")
+    assert len(replayed) + spool.n_evicted == 20
@@ -0,0 +1,64 @@
+import json
+import numpy as np
+import socket
+import status_server
+from status_server import start_server, stop_server, query, status_table, ieq_table
+from sample import Sample, SampleSchema
+
+def test_status_server(tmp_path):
+    path = tmp_path / "status.sock"
+    status_server.register("ME0","simulated",0,[0,1],["L1_G3BOT","L1_G3TOP"])
+    status_server.register("LV","simulated",5,[18],["CH18"])
+    sample = Sample(SampleSchema([0,1],["VMon","Pw","Ieq"],integer=["Pw","Ieq"]))
+    sample.set("VMon",[600.,np.nan]), sample.set("Pw",[1,0]), sample.set("Ieq",[960,1142])
+    sample.timestamp = 1000.
+    status_server.publish("ME0",sample)
+    sample.set("VMon",0.) ## the next poll refills the buffer
+    server = start_server(path)
+    try:
+        assert start_server(path) is None ## one server per socket
+        devices = query(path)
+        assert devices["ME0"]["quantities"]["VMon"] == [600.,None] and devices["ME0"]["timestamp"] == 1000.
+        assert devices["LV"]["timestamp"] is None and devices["LV"]["slot"] == 5
+        assert list(query(path,["LV"])) == ["LV"]
+        cols,rows = status_table(devices["ME0"],["VMon","IMon"])
+        assert cols == ["Ch_Number","Ch_Name","VMon","IMon"] and rows[1] == [1,"L1_G3TOP","",""]
+        assert ieq_table(devices["ME0"])[1][0] == ["L1_G3BOT",600.,960,1]
+        status_server.unregister("LV")
+        assert list(query(path)) == ["ME0"]
+    finally:
+        stop_server(server)
+        status_server.unregister("ME0")
+    assert not path.exists()
+    assert query(path) == {}
+
+def test_stale_socket(tmp_path):
+    ## socket file left by a killed logger, and workers sockets found next to the main one
+    path = tmp_path / "status.sock"
+    stale = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    stale.bind(str(path))
+    stale.close()
+    server = start_server(path)
+    worker = start_server(f"{path}.gemcaen_simulated")
+    try:
+        status_server.register("ME0","simulated",0,[0],["L1_G3BOT"])
+        assert list(query(path)) == ["ME0"]
+    finally:
+        stop_server(server)
+        stop_server(worker)
+        status_server.unregister("ME0")
+
+def test_invalid_requests(tmp_path):
+    path = tmp_path / "status.sock"
+    server = start_server(path)
+    try:
+        for request in (b"not json",b"[]",b'"x"',b"1",b'{"devices":"ME0"}',b'{"devices":[1]}'):
+            with socket.socket(socket.AF_UNIX,socket.SOCK_STREAM) as client:
+                client.settimeout(2.)
+                client.connect(str(path))
+                client.sendall(request + b"\n")
+                response = json.loads(b"".join(iter(lambda: client.recv(65536),b"")))
+            assert list(response) == ["error"], request
+        assert query(path) == {} ## still serving
+    finally:
+        stop_server(server)
@@ -0,0 +1,109 @@
+import os
+import signal
+import threading
+import time
+import numpy as np
+import influx_writer
+import metrics
+from config_parser import diff_configs
+from snapshot import SharedSnapshot, snapshot_name
+from supervisor import MainframeSupervisor
+from tests.conftest import mainframe_cfg
+
+INFLUXDB = {"DB_BUCKET":"test","ORG":"test","TOKEN":"token","URL":"http://supervisor.test","SPOOL_DIR":False}
+
+class NullWriter:
+    def write(self,bucket,records,timestamp=None): pass
+    def close(self): pass
+
+def setup_cfg(address,monitorables,devices=("ME0",)):
+    ## load_config output of one simulated mainframe
+    configs = { device_name:{"Monitorables":monitorables,"HoldOffTime":0.1,"isGEMDetector":True,"MAINFRAME":mainframe_cfg(address),
+                             "BOARD":{"SLOT":0,"LAYER":1 + index},"influxDB":INFLUXDB} for index,device_name in enumerate(devices) }
+    return {address:{"MAINFRAME":mainframe_cfg(address),"configs":configs}}
+
+def wait_for(condition,timeout=10.):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+def published(address,device_name,quantity):
+    ## latest value of quantity in the snapshot, attached again as the supervisor may have replaced it
+    reader = SharedSnapshot(snapshot_name(address))
+    try:
+        if device_name not in reader.devices: return False
+        _,arrays = reader.read(device_name)
+        return quantity in arrays and not np.isnan(arrays[quantity]).all()
+    finally:
+        reader.close()
+
+def test_reconfigure_keeps_worker():
+    address = "supervisor_reconfigure"
+    cfg = setup_cfg(address,["VMon"])
+    influx_writer.set_writer(INFLUXDB,NullWriter()) ## inherited by the workers
+    supervisor = MainframeSupervisor(cfg,threading.Event())
+    try:
+        supervisor.start()
+        wait_for(lambda: published(address,"ME0","VMon"))
+        pid = supervisor.workers[address]["process"].pid
+        ## new quantity and new device: new snapshot layout, same worker and session
+        new_cfg = setup_cfg(address,["VMon","IMon"],devices=("ME0","ME0_2"))
+        supervisor.reconfigure(new_cfg,diff_configs(cfg,new_cfg))
+        assert supervisor.workers[address]["snapshot"].devices == ["ME0","ME0_2"]
+        wait_for(lambda: published(address,"ME0","IMon") and published(address,"ME0_2","IMon"))
+        supervisor.check()
+        assert supervisor.workers[address]["process"].pid == pid and supervisor.workers[address]["restarts"] == 0
+        ## same layout: the configs are only sent
+        snapshot = supervisor.workers[address]["snapshot"]
+        changed_cfg = setup_cfg(address,["VMon","IMon"],devices=("ME0","ME0_2"))
+        changed_cfg[address]["configs"]["ME0"]["HoldOffTime"] = 0.2
+        supervisor.reconfigure(changed_cfg,diff_configs(new_cfg,changed_cfg))
+        assert supervisor.workers[address]["snapshot"] is snapshot
+        time.sleep(0.5)
+        assert supervisor.workers[address]["process"].pid == pid and supervisor.workers[address]["process"].is_alive()
+    finally:
+        supervisor.stop()
+        influx_writer.close_writers()
+
+def check_until(supervisor,condition,timeout=10.):
+    ## runs the checks of the supervisor loop till condition holds
+    deadline = time.monotonic() + timeout
+    while True:
+        supervisor.check()
+        if condition(): return
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.02)
+
+def restarts_metric(address):
+    line = next(( line for line in metrics.REGISTRY.render().splitlines() if line.startswith(f'gemcaen_worker_restarts_total{{mainframe="{address}"}}') ),None)
+    return int(line.rsplit(" ",1)[1]) if line is not None else 0
+
+def test_worker_respawned():
+    address = "supervisor_respawn"
+    cfg = setup_cfg(address,["VMon"])
+    influx_writer.set_writer(INFLUXDB,NullWriter())
+    supervisor = MainframeSupervisor(cfg,threading.Event(),hang_timeout=1.,base_delay=0.01,max_delay=0.05)
+    worker = None
+    try:
+        supervisor.start()
+        worker = supervisor.workers[address]
+        wait_for(lambda: published(address,"ME0","VMon"))
+        n_restarts = restarts_metric(address)
+        ## killed: restarted at the next checks, after the backoff
+        pid = worker["process"].pid
+        os.kill(pid,signal.SIGKILL)
+        check_until(supervisor,lambda: worker["process"] is not None and worker["process"].pid != pid)
+        assert worker["restarts"] == 1 and worker["breaker"].failures == 1
+        assert restarts_metric(address) == n_restarts + 1
+        wait_for(lambda: not np.isnan(worker["snapshot"].heartbeat)) ## the new worker polls
+        ## stalled: no heartbeat for hang_timeout seconds, killed and restarted
+        pid = worker["process"].pid
+        os.kill(pid,signal.SIGSTOP)
+        check_until(supervisor,lambda: worker["process"] is not None and worker["process"].pid != pid)
+        assert worker["restarts"] == 2 and restarts_metric(address) == n_restarts + 2
+        wait_for(lambda: published(address,"ME0","VMon") and time.time() - worker["snapshot"].heartbeat < 1.)
+    finally:
+        if worker is not None and worker["process"] is not None and worker["process"].is_alive(): os.kill(worker["process"].pid,signal.SIGCONT)
+        supervisor.stop()
+        influx_writer.close_writers()